@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+"""Measures the time and peak memory of pipeline generation for large synthetic configs.
+
+Usage:
+  benchmarks/generator.py                     report every scenario
+  benchmarks/generator.py --check             also fail if a scenario regressed past the stored baseline
+  benchmarks/generator.py --update-baseline   store the current results as the baseline
+
+Everything runs in-process against a fixed environment, no network or docker is needed. Timings are compared as
+multiples of a fixed calibration workload run in the same process, so the baseline holds across machines.
+"""
+import argparse
+import io
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+from typing import Any, Callable, Dict, List
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "pipeline"))
+
+# pylint: disable=wrong-import-position
+from options import process_config
+from pipeline import generate, write_pipeline
+
+BASELINE_PATH: str = os.path.join(os.path.dirname(os.path.abspath(__file__)), "generator-baseline.json")
+
+ENVIRON: Dict[str, str] = {
+    "BUILDKITE_PIPELINE_NAME": "benchmark",
+    "BUILDKITE_COMMIT": "0123456789abcdef0123456789abcdef01234567",
+    "BUILDKITE_BRANCH": "main",
+    "BUILDKITE_BUILD_NUMBER": "1",
+}
+
+
+def plugins(count: int) -> List[Dict[str, Any]]:
+    """Additional plugins with a realistic amount of configuration each"""
+    return [
+        {f"example/plugin-{i}#v1.0.0": {"option": f"value-{i}", "list": [f"item-{j}" for j in range(5)]}}
+        for i in range(count)
+    ]
+
+
+def build_args(count: int) -> str:
+    """A comma-delimited list of build args, half of them passed through from the environment"""
+    return ",".join(f"ARG_{i}={i}" if i % 2 else f"ARG_{i}" for i in range(count))
+
+
+SCENARIOS: Dict[str, Dict[str, Any]] = {
+    "single-image": {
+        "push-branches": "main",
+    },
+    "many-build-args": {
+        "push-branches": "main",
+        "build-args": build_args(500),
+    },
+    "many-plugins": {
+        "push-branches": "main",
+        "additional-plugins": plugins(100),
+    },
+    "many-images": {
+        "push-branches": "main",
+        "build-args": build_args(50),
+        "additional-plugins": plugins(10),
+        "images": [
+            {"image-name": f"service-{i}", "context-path": f"services/{i}", "npm-cache": str(i % 2 == 0).lower()}
+            for i in range(200)
+        ],
+    },
+    "many-images-packed": {
+        "push-branches": "main",
+        "build-args": build_args(50),
+        "additional-plugins": plugins(10),
+        "images-per-job": 8,
+        "images": [
+            {"image-name": f"service-{i}", "context-path": f"services/{i}", "composer-cache": "true"}
+            for i in range(200)
+        ],
+    },
+}
+
+
+def calibration_workload() -> None:
+    """Fixed work of the kind generation does, formatting and filtering strings and building dicts, lists and JSON"""
+    steps = []
+    for i in range(2000):
+        tag = "".join([c for c in f"feature/branch-{i}".replace("/", "-") if c.isalnum() or c in ["_", "-", "."]])
+        step = {"key": f"step-{i}", "command": [f"docker buildx build --tag image:{tag}-{j}" for j in range(10)]}
+        steps.append(step | {"agents": {"queue": "docker"}})
+    json.dumps(steps)
+
+
+def fastest(function: Callable[[], Any], repeats: int) -> float:
+    """The fastest of several runs in seconds, the least noisy estimate of the cost of the code itself"""
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def peak_memory(function: Callable[[], Any]) -> int:
+    """Peak bytes allocated by Python while running a function"""
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def measure(plugin_config: Dict[str, Any], repeats: int) -> Dict[str, float]:
+    """Time each phase of generation for a plugin configuration, and the peak memory of all of them together"""
+    environ = ENVIRON | {"BUILDKITE_PLUGIN_CONFIGURATION": json.dumps(plugin_config)}
+    config = process_config(environ)
+    pipeline = generate(config)
+
+    def run_all():
+        write_pipeline(generate(process_config(environ)), io.StringIO(), "json")
+
+    return {
+        "process-config-ms": fastest(lambda: process_config(environ), repeats) * 1000,
+        "generate-ms": fastest(lambda: generate(config), repeats) * 1000,
+        "write-json-ms": fastest(lambda: write_pipeline(pipeline, io.StringIO(), "json"), repeats) * 1000,
+        "write-yaml-ms": fastest(lambda: write_pipeline(pipeline, io.StringIO(), "yaml"), repeats) * 1000,
+        "peak-memory-kib": peak_memory(run_all) / 1024,
+    }
+
+
+def relative(results: Dict[str, Dict[str, float]], calibration_ms: float) -> Dict[str, Dict[str, float]]:
+    """Timings as multiples of the calibration workload, which cancels out most of the speed of the machine"""
+    converted: Dict[str, Dict[str, float]] = {}
+    for scenario, metrics in results.items():
+        converted[scenario] = {}
+        for metric, value in metrics.items():
+            if metric.endswith("-ms"):
+                converted[scenario][metric[: -len("-ms")] + "-x"] = value / calibration_ms
+            else:
+                converted[scenario][metric] = value
+    return converted
+
+
+def regressions(
+    results: Dict[str, Dict[str, float]],
+    baseline: Dict[str, Dict[str, float]],
+    tolerance: float,
+    min_delta_x: float,
+) -> List[str]:
+    """Describe every relative measurement that is worse than its baseline by more than the tolerance"""
+    found = []
+    for scenario, metrics in results.items():
+        for metric, value in metrics.items():
+            if metric not in baseline.get(scenario, {}):
+                continue
+            expected = baseline[scenario][metric]
+            # Tiny absolute differences are timer noise rather than regressions
+            if metric.endswith("-x") and value - expected < min_delta_x:
+                continue
+            if value > expected * (1 + tolerance):
+                found.append(f"{scenario} {metric}: {value:.3f} vs baseline {expected:.3f}")
+    return found
+
+
+def main() -> int:
+    """Run the scenarios, print a table and compare against the baseline"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeats", type=int, default=3, help="runs of each phase, the fastest is reported")
+    parser.add_argument("--check", action="store_true", help="exit non-zero if a scenario regressed past the baseline")
+    parser.add_argument("--update-baseline", action="store_true", help=f"write the results to {os.path.basename(BASELINE_PATH)}")
+    parser.add_argument("--tolerance", type=float, default=0.5, help="allowed fractional increase over the baseline (default: 0.5)")
+    parser.add_argument("--min-delta-ms", type=float, default=2.0, help="timing increases smaller than this are ignored (default: 2)")
+    parser.add_argument("scenarios", nargs="*", default=list(SCENARIOS), help="scenarios to run (default: all)")
+    args = parser.parse_args()
+
+    calibration_ms = fastest(calibration_workload, max(args.repeats, 5)) * 1000
+    results: Dict[str, Dict[str, float]] = {}
+    for scenario in args.scenarios:
+        results[scenario] = measure(SCENARIOS[scenario], args.repeats)
+
+    metrics = list(next(iter(results.values())))
+    print(f'{"scenario":<20}' + "".join(f"{metric:>18}" for metric in metrics))
+    for scenario, values in results.items():
+        print(f"{scenario:<20}" + "".join(f"{values[metric]:>18.2f}" for metric in metrics))
+    print(f"calibration workload: {calibration_ms:.2f} ms, the baseline stores timings as multiples of it")
+
+    if args.update_baseline:
+        with open(BASELINE_PATH, "w", encoding="utf8") as file:
+            json.dump(
+                {
+                    scenario: {metric: round(value, 4) for metric, value in values.items()}
+                    for scenario, values in relative(results, calibration_ms).items()
+                },
+                file,
+                indent=2,
+                sort_keys=True,
+            )
+            file.write("\n")
+        print(f"Baseline written to {BASELINE_PATH}")
+        return 0
+
+    if args.check:
+        with open(BASELINE_PATH, encoding="utf8") as file:
+            baseline = json.load(file)
+        found = regressions(relative(results, calibration_ms), baseline, args.tolerance, args.min_delta_ms / calibration_ms)
+        for regression in found:
+            print(f"Regression: {regression}", file=sys.stderr)
+        return 1 if found else 0
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,74 @@
+#!/bin/bash
+# Measures the wall-clock time of hooks/command with a stubbed buildkite-agent.
+#
+# Usage: benchmarks/hook-startup.sh [runs]
+#
+# Scenarios:
+#   legacy-venv  the previous behaviour: a fresh virtualenv and pip install on every run
+#   yaml-cached  output-format: yaml, reusing the virtualenv cached by requirements hash
+#   json         output-format: json, no third-party dependencies
+#   json-stream  output-format: json with upload-mode: stream
+set -euo pipefail
+
+PLUGIN_DIR="$(cd "$(dirname "${BASH_SOURCE[0]}")/.." && pwd)"
+RUNS="${1:-5}"
+
+work_dir="$(mktemp -d)"
+trap 'rm -rf "${work_dir}"' EXIT
+
+mkdir -p "${work_dir}/bin" "${work_dir}/checkout"
+echo "FROM scratch" > "${work_dir}/checkout/Dockerfile"
+cat > "${work_dir}/bin/buildkite-agent" <<'STUB'
+#!/bin/bash
+# Stub agent: echo the pipeline for `pipeline upload --dry-run`, drain a streamed upload, ignore everything else
+if [[ "$1 $2" == "pipeline upload" && "${3:-}" == "--dry-run" ]]; then
+  cat "$4"
+elif [[ "$1 $2" == "pipeline upload" && -z "${4:-}" ]]; then
+  cat > /dev/null
+fi
+STUB
+chmod +x "${work_dir}/bin/buildkite-agent"
+
+export PATH="${work_dir}/bin:${PATH}"
+export BUILDKITE_PIPELINE_NAME="benchmark"
+export BUILDKITE_COMMIT="0123456789abcdef"
+export BUILDKITE_BRANCH="main"
+export BUILDKITE_BUILD_NUMBER="1"
+export BUILDKITE_PLUGIN_CONFIGURATION='{"push-branches": "main"}'
+export BUILD_AND_PUSH_VENV_CACHE_DIR="${work_dir}/venvs"
+
+legacy_hook() {
+  python3 -m venv .venv
+  # shellcheck disable=SC1091
+  . .venv/bin/activate
+  pip3 install --quiet -r "${PLUGIN_DIR}/requirements.txt"
+  python3 "${PLUGIN_DIR}/pipeline/pipeline.py"
+  deactivate
+  rm -rf .venv
+}
+
+time_runs() {
+  local scenario="$1" start end total=0
+  shift
+  for _ in $(seq "${RUNS}"); do
+    start="$(date +%s%N)"
+    "$@" > /dev/null
+    end="$(date +%s%N)"
+    total=$((total + end - start))
+  done
+  printf '%-12s %8d ms/run (%d runs)\n' "${scenario}" $((total / RUNS / 1000000)) "${RUNS}"
+}
+
+cd "${work_dir}/checkout"
+
+time_runs legacy-venv legacy_hook
+
+# Prime the cached virtualenv so only the warm path is measured
+BUILDKITE_PLUGIN_BUILD_AND_PUSH_OUTPUT_FORMAT=yaml "${PLUGIN_DIR}/hooks/command" > /dev/null
+BUILDKITE_PLUGIN_BUILD_AND_PUSH_OUTPUT_FORMAT=yaml time_runs yaml-cached "${PLUGIN_DIR}/hooks/command"
+
+BUILDKITE_PLUGIN_BUILD_AND_PUSH_OUTPUT_FORMAT=json time_runs json "${PLUGIN_DIR}/hooks/command"
+
+BUILDKITE_PLUGIN_CONFIGURATION='{"push-branches": "main", "upload-mode": "stream"}' \
+  BUILDKITE_PLUGIN_BUILD_AND_PUSH_UPLOAD_MODE=stream \
+  time_runs json-stream "${PLUGIN_DIR}/hooks/command"
@@ -0,0 +1,33 @@
+"""A minimal client for the agents endpoint of the Buildkite REST API"""
+import json
+import re
+import urllib.request
+
+from typing import Any, Dict, List, Optional
+
+API_URL = "https://api.buildkite.com/v2"
+
+NEXT_LINK_PATTERN = re.compile(r'<([^>]+)>;\s*rel="next"')
+
+
+def connected_agents(organization: str, token: str, api_url: str = API_URL) -> List[Dict[str, Any]]:
+    """Every agent connected to an organisation, following the API's pagination"""
+    agents: List[Dict[str, Any]] = []
+    url: Optional[str] = f"{api_url}/organizations/{organization}/agents?per_page=100"
+    while url:
+        request = urllib.request.Request(url, headers={"Authorization": f"Bearer {token}"})
+        with urllib.request.urlopen(request, timeout=10) as response:
+            agents.extend(json.load(response))
+            match = NEXT_LINK_PATTERN.search(response.headers.get("Link", ""))
+        url = match.group(1) if match else None
+    return [agent for agent in agents if agent.get("connection_state") == "connected"]
+
+
+def agent_tags(agent: Dict[str, Any]) -> Dict[str, str]:
+    """An agent's tags, which the API lists as key=value strings"""
+    return dict(tag.split("=", 1) for tag in agent.get("meta_data", []) if "=" in tag)
+
+
+def idle_agent_tags(agents: List[Dict[str, Any]]) -> List[Dict[str, str]]:
+    """The tags of each agent that isn't running a job"""
+    return [agent_tags(agent) for agent in agents if not agent.get("job")]
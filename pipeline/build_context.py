@@ -0,0 +1,182 @@
+"""Helpers for working out which files docker will send as the build context"""
+import fnmatch
+import hashlib
+import os
+import re
+
+from typing import Dict, Iterable, Iterator, List, Pattern, Tuple
+
+
+def read_dockerignore(dockerfile_path: str, context_path: str) -> List[str]:
+    """Load the ignore patterns BuildKit would use, preferring <Dockerfile>.dockerignore over <context>/.dockerignore"""
+    for path in [f"{dockerfile_path}.dockerignore", os.path.join(context_path, ".dockerignore")]:
+        if os.path.isfile(path):
+            with open(path, encoding="utf8") as file:
+                return file.read().splitlines()
+    return []
+
+
+def _translate_star(pattern: str, i: int) -> Tuple[str, int]:
+    """The regex for the `*` or `**` at i, with the index of the last character it uses"""
+    if pattern[i + 1 : i + 2] != "*":
+        return "[^/]*", i
+    if pattern[i + 2 : i + 3] == "/":
+        # `**/` matches zero or more directories
+        return "(.*/)?", i + 2
+    return ".*", i + 1
+
+
+def _translate_class(pattern: str, i: int) -> Tuple[str, int]:
+    """The regex for the `[...]` character class at i, with the index of its closing bracket, a lone `[` is literal"""
+    end = pattern.find("]", i + 1)
+    if end == -1:
+        return re.escape("["), i
+    klass = pattern[i + 1 : end]
+    if klass.startswith(("!", "^")):
+        klass = "^" + klass[1:]
+    return f"[{klass}]", end
+
+
+def _translate(pattern: str) -> str:
+    """Translate a .dockerignore pattern into a regex, following the semantics of moby's patternmatcher"""
+    regex = ""
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if char == "*":
+            fragment, i = _translate_star(pattern, i)
+            regex += fragment
+        elif char == "?":
+            regex += "[^/]"
+        elif char == "[":
+            fragment, i = _translate_class(pattern, i)
+            regex += fragment
+        elif char == "\\" and i + 1 < len(pattern):
+            i += 1
+            regex += re.escape(pattern[i])
+        else:
+            regex += re.escape(char)
+        i += 1
+    return f"^{regex}$"
+
+
+def compile_dockerignore(patterns: Iterable[str]) -> List[Tuple[bool, Pattern]]:
+    """Compile .dockerignore lines into (is_exception, regex) rules in file order"""
+    rules: List[Tuple[bool, Pattern]] = []
+    for line in patterns:
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        exception = line.startswith("!")
+        if exception:
+            line = line[1:].strip()
+        line = os.path.normpath(line).replace(os.sep, "/").lstrip("/")
+        if line in ("", "."):
+            continue
+        rules.append((exception, re.compile(_translate(line))))
+    return rules
+
+
+def is_ignored(path: str, rules: List[Tuple[bool, Pattern]]) -> bool:
+    """Whether a context-relative path is excluded, a pattern matching any parent directory also matches the path"""
+    parts = path.split("/")
+    candidates = ["/".join(parts[: i + 1]) for i in range(len(parts))]
+    ignored = False
+    for exception, regex in rules:
+        if any(regex.match(candidate) for candidate in candidates):
+            ignored = not exception
+    return ignored
+
+
+def context_files(context_path: str, patterns: Iterable[str]) -> Iterator[str]:
+    """Yield the context-relative paths of every file sent to the builder, in a stable order"""
+    rules = compile_dockerignore(patterns)
+    # Excluded directories can only be skipped wholesale when nothing can re-include a file inside them
+    can_prune = not any(exception for exception, _ in rules)
+
+    for root, dirs, files in os.walk(context_path):
+        relative_root = os.path.relpath(root, context_path).replace(os.sep, "/")
+        prefix = "" if relative_root == "." else f"{relative_root}/"
+        dirs.sort()
+        if can_prune:
+            dirs[:] = [name for name in dirs if not is_ignored(f"{prefix}{name}", rules)]
+        # Symlinked directories are sent as links rather than followed
+        links = [name for name in dirs if os.path.islink(os.path.join(root, name))]
+        dirs[:] = [name for name in dirs if name not in links]
+        for name in sorted(files + links):
+            path = f"{prefix}{name}"
+            if not is_ignored(path, rules):
+                yield path
+
+
+def context_sizes(context_path: str, patterns: Iterable[str]) -> List[Tuple[str, int]]:
+    """The size in bytes of every file sent to the builder"""
+    return [
+        (path, os.lstat(os.path.join(context_path, path)).st_size)
+        for path in context_files(context_path, patterns)
+    ]
+
+
+def largest_paths(sizes: List[Tuple[str, int]], depth: int = 2, count: int = 10) -> List[Tuple[str, int]]:
+    """The paths taking up the most space, with everything below `depth` directories counted towards its parent"""
+    totals: Dict[str, int] = {}
+    for path, size in sizes:
+        parts = path.split("/")
+        key = "/".join(parts[:depth]) + ("/" if len(parts) > depth else "")
+        totals[key] = totals.get(key, 0) + size
+    return sorted(totals.items(), key=lambda item: (-item[1], item[0]))[:count]
+
+
+def unused_paths(sizes: List[Tuple[str, int]], sources: Iterable[str]) -> List[Tuple[str, int]]:
+    """Top level entries of the context that no source path can match, largest first"""
+    sources = list(sources)
+    if "" in sources:
+        # Something copies the whole context
+        return []
+    source_roots = [source.split("/")[0] for source in sources]
+
+    totals: Dict[str, int] = {}
+    for path, size in sizes:
+        parts = path.split("/")
+        entry = parts[0] + ("/" if len(parts) > 1 else "")
+        totals[entry] = totals.get(entry, 0) + size
+
+    unused = [
+        (entry, size)
+        for entry, size in totals.items()
+        if entry != ".dockerignore"
+        and not any(fnmatch.fnmatchcase(entry.rstrip("/"), root) for root in source_roots)
+    ]
+    return sorted(unused, key=lambda item: (-item[1], item[0]))
+
+
+def fingerprint(
+    dockerfile_path: str, context_path: str, extra: Iterable[str] = ()
+) -> str:
+    """A deterministic hash of the Dockerfile, the effective build context and any extra build inputs"""
+    digest = hashlib.sha256()
+
+    def update(*values: bytes) -> None:
+        for value in values:
+            digest.update(len(value).to_bytes(8, "big"))
+            digest.update(value)
+
+    with open(dockerfile_path, "rb") as file:
+        update(b"dockerfile", file.read())
+
+    for path in context_files(context_path, read_dockerignore(dockerfile_path, context_path)):
+        full_path = os.path.join(context_path, path)
+        if os.path.islink(full_path):
+            update(b"link", path.encode(), os.readlink(full_path).encode())
+            continue
+        file_digest = hashlib.sha256()
+        with open(full_path, "rb") as file:
+            for chunk in iter(lambda: file.read(1024 * 1024), b""):
+                file_digest.update(chunk)
+        executable = b"x" if os.access(full_path, os.X_OK) else b"-"
+        update(b"file", path.encode(), executable, file_digest.digest())
+
+    for value in extra:
+        update(b"extra", value.encode())
+
+    return digest.hexdigest()
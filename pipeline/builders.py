@@ -0,0 +1,186 @@
+"""The BuildKit builders steps build with, and which agents they run on to reuse a builder's cache"""
+import hashlib
+import json
+import os
+import re
+import shlex
+import sys
+
+from typing import List, Dict, Any, Mapping, Optional
+
+from agents import connected_agents, idle_agent_tags
+
+# Seconds to wait for a remote builder to respond before falling back to a local one
+REMOTE_BUILDER_TIMEOUT: int = 30
+
+# Seconds a build step pinned to its shard may wait for an agent of the shard before it's built on any agent instead
+AFFINITY_FALLBACK_WAIT: int = 60
+
+
+def resolve_builder_affinity(
+    config: Dict[str, Any],
+    environ: Optional[Mapping[str, str]] = None,
+    agents: Optional[List[Dict[str, Any]]] = None,
+) -> None:
+    """Find the idle agents, so build steps are only routed to their shard when an agent there can start them straight away"""
+    if environ is None:
+        environ = os.environ
+
+    if agents is None:
+        token = environ.get("BUILD_AND_PUSH_BUILDKITE_API_TOKEN", "")
+        if not token:
+            print("BUILD_AND_PUSH_BUILDKITE_API_TOKEN isn't set, build steps can run on any agent", file=sys.stderr)
+            return
+        try:
+            agents = connected_agents(environ["BUILDKITE_ORGANIZATION_SLUG"], token)
+        except (OSError, KeyError, ValueError) as error:
+            print(f"Unable to list agents, build steps can run on any agent: {error}", file=sys.stderr)
+            return
+
+    config["idle-agents"] = idle_agent_tags(agents)
+
+
+def affinity_shard(key: str, config: Dict[str, Any]) -> str:
+    """The shard of agents a build step prefers, stable across builds of the same pipeline"""
+    digest = hashlib.sha256(f'{config["pipeline-name"]}/{key}'.encode()).hexdigest()
+    return str(int(digest, 16) % config["builder-affinity-shards"])
+
+
+def affinity_fallback_key(key: str) -> str:
+    """Key of the step standing in for a pinned build step, building off shard if no agent of the shard picked it up"""
+    return f"{key}-fallback"
+
+
+def add_builder_affinity(step: Dict[str, Any], platform: str, config: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Pin the step to its shard when an idle agent there can take it, and report whether the step ran there with a warm builder.
+
+    Returns the steps falling back to any agent of the queue when the pinned step isn't picked up in time: a watchdog
+    cancelling it, and a copy of it that builds once it's cancelled"""
+    tag = config["builder-affinity-tag"]
+    shard = affinity_shard(step["key"], config)
+
+    # The agent exposes its tags as BUILDKITE_AGENT_META_DATA_<TAG>
+    tag_variable = "BUILDKITE_AGENT_META_DATA_" + re.sub(r"[^A-Z0-9]", "_", tag.upper())
+    step["command"][0:0] = [
+        f'BP_AFFINITY=$$([[ "$${{{tag_variable}:-}}" == "{shard}" ]] && echo hit || echo miss)',
+        f"BP_BUILDER=$$(docker buildx inspect {local_builder_name(config)} >/dev/null 2>&1 && echo warm || echo cold)",
+        f'echo "Builder affinity {platform}: $$BP_AFFINITY for shard {shard} on $${{BUILDKITE_AGENT_NAME:-unknown}}, $$BP_BUILDER builder"',
+    ]
+
+    # A step waiting on other steps could find the agent busy again by the time it's ready
+    preferred = step["agents"] | {tag: shard}
+    idle_agent = None if "depends_on" in step else next(
+        (tags for tags in config["idle-agents"] or [] if all(tags.get(name) == value for name, value in preferred.items())),
+        None,
+    )
+    if idle_agent is None:
+        return []
+    # Each idle agent can only take one step
+    config["idle-agents"].remove(idle_agent)
+
+    key = step["key"]
+    watchdog = {
+        "label": f":hourglass: Wait for builder affinity shard {shard} ({platform})",
+        "key": f"{key}-watchdog",
+        "agents": step["agents"],
+        "command": [
+            f'for attempt in $$(seq {AFFINITY_FALLBACK_WAIT}); do if buildkite-agent meta-data exists "{key}-started"; then exit 0; fi; sleep 1; done',
+            f'echo "No agent of shard {shard} picked up {key}, building on any agent"',
+            f'buildkite-agent meta-data set "{key}-fallback" true',
+            f'buildkite-agent step cancel --step "{key}" || echo "Unable to cancel {key}, waiting for it to build on shard {shard}"',
+        ],
+    }
+    fallback = step | {
+        "label": f'{step["label"]} (off shard)',
+        "key": affinity_fallback_key(key),
+        "depends_on": [{"step": key, "allow_failure": True}],
+        "command": [
+            f'if [[ "$$(buildkite-agent step get outcome --step "{key}")" == "passed" ]]; then echo "Built on shard {shard}"; exit 0; fi',
+            f'if ! buildkite-agent meta-data exists "{key}-fallback"; then echo "{key} failed on shard {shard}"; exit 1; fi',
+            *step["command"],
+        ],
+    }
+    step["agents"] = preferred
+    step["command"][0:0] = [f'buildkite-agent meta-data set "{key}-started" true']
+    return [watchdog, fallback]
+
+
+def add_affinity_fallbacks(steps: List[Dict[str, Any]], build_keys: List[str]) -> None:
+    """Make steps depending on a pinned build step wait for its fallback instead, which passes once either has built the images"""
+    pinned_keys = [key for key in build_keys if affinity_fallback_key(key) in build_keys]
+    for step in [member for step in steps for member in [step, *step.get("steps", [])]]:
+        dependencies = step.get("depends_on")
+        if not isinstance(dependencies, list) or step.get("key") in map(affinity_fallback_key, pinned_keys):
+            continue
+        rewritten: List[Any] = []
+        for dependency in dependencies:
+            if isinstance(dependency, dict) and dependency["step"] in pinned_keys:
+                dependency = dependency | {"step": affinity_fallback_key(dependency["step"])}
+            elif dependency in pinned_keys:
+                dependency = affinity_fallback_key(dependency)
+            if dependency not in rewritten:
+                rewritten.append(dependency)
+        step["depends_on"] = rewritten
+
+
+def buildkitd_config(config: Dict[str, Any]) -> str:
+    """buildkitd.toml for the local builder, empty when every setting is left at BuildKit's default"""
+    lines: List[str] = []
+    if config["buildkitd-max-parallelism"] or config["buildkitd-gc-keep-storage"] or config["buildkitd-gc-keep-duration"]:
+        lines.append("[worker.oci]")
+    if config["buildkitd-max-parallelism"]:
+        lines.append(f'  max-parallelism = {config["buildkitd-max-parallelism"]}')
+    if config["buildkitd-gc-keep-storage"] or config["buildkitd-gc-keep-duration"]:
+        # A gc policy replaces BuildKit's defaults, records past the duration go first then the oldest until under the limit
+        lines.append("  gc = true")
+        if config["buildkitd-gc-keep-duration"]:
+            lines.extend(["  [[worker.oci.gcpolicy]]", "    all = true", f'    keepDuration = {config["buildkitd-gc-keep-duration"] * 3600}'])
+        if config["buildkitd-gc-keep-storage"]:
+            lines.extend(["  [[worker.oci.gcpolicy]]", "    all = true", f'    keepBytes = {config["buildkitd-gc-keep-storage"] * 1024 * 1024}'])
+    for registry, hosts in sorted(config["buildkitd-registry-mirrors"].items()):
+        lines.extend([f"[registry.{json.dumps(registry)}]", f"  mirrors = {json.dumps(hosts)}"])
+    return "\n".join(lines)
+
+
+def local_builder_name(config: Dict[str, Any]) -> str:
+    """Name of the builder started on each agent, its buildkitd config is part of the name so changing it creates a new builder"""
+    buildkitd_toml = buildkitd_config(config)
+    if not buildkitd_toml:
+        return "builder"
+    return f"builder-{hashlib.sha256(buildkitd_toml.encode()).hexdigest()[0:8]}"
+
+
+def builder_command(platform: str, config: Dict[str, Any]) -> str:
+    """Select the buildx builder, creating it if this agent doesn't have one yet"""
+    name = local_builder_name(config)
+    create = f"docker buildx create --bootstrap --name {name} --use --driver docker-container --driver-opt image=moby/buildkit:{config['buildkit-version']}"
+    buildkitd_toml = buildkitd_config(config)
+    if buildkitd_toml:
+        # Outside the checkout so the file never ends up in a build context
+        config_file = f"$${{TMPDIR:-/tmp}}/{name}.toml"
+        # Builders of earlier settings would otherwise keep their cache on the agent's disk
+        prune = f"(docker buildx ls --format '{{{{.Name}}}}' | grep '^builder-' | grep -vx {name} | xargs -r -n 1 docker buildx rm --keep-state=false || true)"
+        create = f"(printf '%s\\n' {shlex.quote(buildkitd_toml)} > {config_file} && {prune} && {create} --config {config_file})"
+    local_builder = f"docker buildx use {name} || {create}"
+
+    remote = config["remote-builders"].get(platform)
+    if not remote:
+        return local_builder
+
+    if isinstance(remote, str):
+        remote = {"endpoint": remote}
+    driver_opts = ",".join(
+        f"{option}={remote[option]}"
+        for option in ["cacert", "cert", "key", "servername"]
+        if option in remote
+    )
+    driver_opts_stub = f" --driver-opt {driver_opts}" if driver_opts else ""
+
+    # The endpoint is part of the name so changing it creates a new builder rather than reusing the old connection
+    remote_name = f'remote-{platform}-{hashlib.sha256(json.dumps(remote, sort_keys=True).encode()).hexdigest()[0:8]}'
+    return (
+        f"(docker buildx inspect {remote_name} >/dev/null 2>&1 || docker buildx create --name {remote_name} --driver remote{driver_opts_stub} {remote['endpoint']})"
+        f" && timeout {REMOTE_BUILDER_TIMEOUT} docker buildx inspect --bootstrap {remote_name} >/dev/null 2>&1"
+        f" && docker buildx use {remote_name}"
+        f' || (echo "Remote builder {remote["endpoint"]} is unavailable, falling back to a local builder" && ({local_builder}))'
+    )
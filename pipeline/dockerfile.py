@@ -0,0 +1,232 @@
+"""A small Dockerfile parser, covering what the plugin needs to know about the files a build uses"""
+import json
+import re
+import shlex
+
+from typing import Dict, Iterable, List, Mapping, NamedTuple, Optional, Tuple
+
+from interpolate import interpolate_string, InterpolationError
+
+HEREDOC_PATTERN = re.compile(r"<<(-?)([\"']?)([A-Za-z_][A-Za-z0-9_]*)\2")
+DIRECTIVE_PATTERN = re.compile(r"^#\s*([A-Za-z]+)\s*=\s*(\S+)\s*$")
+FLAGS_PATTERN = re.compile(r"^((?:--\S+\s+)*)(.*)$", re.DOTALL)
+
+
+class Instruction(NamedTuple):
+    """An instruction with its continuation lines joined, heredoc bodies are left out"""
+
+    name: str
+    arguments: str
+    line: int
+
+
+def parse(text: str) -> List[Instruction]:
+    """Split a Dockerfile into instructions, following BuildKit's handling of escapes, comments and heredocs"""
+    lines = text.splitlines()
+    escape = "\\"
+
+    # Parser directives are only recognised in the leading comment block
+    for line in lines:
+        match = DIRECTIVE_PATTERN.match(line)
+        if not match:
+            break
+        if match.group(1).lower() == "escape":
+            escape = match.group(2)
+
+    instructions: List[Instruction] = []
+    index = 0
+    while index < len(lines):
+        start = index
+        line = lines[index].strip()
+        index += 1
+        if not line or line.startswith("#"):
+            continue
+
+        parts: List[str] = []
+        while True:
+            if line.endswith(escape):
+                parts.append(line[: -len(escape)])
+                # Comments and blank lines inside a continuation are dropped rather than ending it
+                while index < len(lines) and (not lines[index].strip() or lines[index].strip().startswith("#")):
+                    index += 1
+                if index >= len(lines):
+                    break
+                line = lines[index].strip()
+                index += 1
+                continue
+            parts.append(line)
+            break
+
+        logical = " ".join(part.strip() for part in parts)
+        name, _, arguments = logical.partition(" ")
+
+        for strip_tabs, _, terminator in HEREDOC_PATTERN.findall(arguments):
+            while index < len(lines):
+                body = lines[index].lstrip("\t") if strip_tabs else lines[index]
+                index += 1
+                if body == terminator:
+                    break
+
+        instructions.append(Instruction(name.upper(), arguments.strip(), start + 1))
+
+    return instructions
+
+
+def split_flags(arguments: str) -> Tuple[List[str], List[str]]:
+    """Separate the leading --flags of an instruction from its arguments, which may be in JSON form"""
+    match = FLAGS_PATTERN.match(arguments)
+    flags, remainder = match.group(1).split(), match.group(2)
+
+    if remainder.startswith("["):
+        try:
+            values = json.loads(remainder)
+            if isinstance(values, list) and all(isinstance(value, str) for value in values):
+                return flags, values
+        except json.JSONDecodeError:
+            pass
+
+    try:
+        return flags, shlex.split(remainder)
+    except ValueError:
+        return flags, remainder.split()
+
+
+def flag_value(flags: List[str], name: str) -> Optional[str]:
+    """The value of a --name=value flag"""
+    for flag in flags:
+        key, _, value = flag.partition("=")
+        if key == f"--{name}":
+            return value
+    return None
+
+
+def context_sources(instructions: List[Instruction]) -> List[str]:
+    """Paths in the build context read by COPY, ADD and RUN bind mounts, relative to the context root"""
+    sources: List[str] = []
+    for instruction in instructions:
+        if instruction.name in ("COPY", "ADD"):
+            flags, values = split_flags(instruction.arguments)
+            # Copies from another stage, image or named build context don't read the main context
+            if flag_value(flags, "from") is not None:
+                continue
+            for source in values[:-1]:
+                if source.startswith("<<") or re.match(r"^[a-z]+://|^git@", source):
+                    continue
+                sources.append(source)
+        elif instruction.name == "RUN":
+            for mount in re.findall(r"--mount=(\S+)", instruction.arguments):
+                options = dict(option.partition("=")[::2] for option in mount.split(","))
+                if options.get("type", "bind") == "bind" and "from" not in options:
+                    sources.append(options.get("source", options.get("src", ".")))
+
+    return [normalise_source(source) for source in sources]
+
+
+def normalise_source(source: str) -> str:
+    """A source path relative to the context root, "" meaning the whole context"""
+    source = re.sub(r"^(\./|/)+", "", source.strip())
+    source = source.rstrip("/")
+    return "" if source in ("", ".") else source
+
+
+# Build args BuildKit consumes without a matching ARG instruction
+PREDEFINED_ARGS: List[str] = [
+    "HTTP_PROXY",
+    "http_proxy",
+    "HTTPS_PROXY",
+    "https_proxy",
+    "FTP_PROXY",
+    "ftp_proxy",
+    "NO_PROXY",
+    "no_proxy",
+    "ALL_PROXY",
+    "all_proxy",
+    "SOURCE_DATE_EPOCH",
+]
+
+
+class ArgDeclaration(NamedTuple):
+    """An ARG instruction, stage is None for args declared before the first FROM"""
+
+    name: str
+    stage: Optional[str]
+    line: int
+    # Instructions after the declaration in the same stage, every one of them is invalidated when the value changes
+    following: int
+
+
+def declared_args(instructions: List[Instruction]) -> List[ArgDeclaration]:
+    """Every ARG declaration, by stage"""
+    declarations: List[ArgDeclaration] = []
+    stage: Optional[str] = None
+    stage_count = 0
+    # Index of the next FROM after each instruction, to count what follows an ARG within its stage
+    stage_ends: List[int] = [0] * len(instructions)
+    end = len(instructions)
+    for index in reversed(range(len(instructions))):
+        stage_ends[index] = end
+        if instructions[index].name == "FROM":
+            end = index
+
+    for index, instruction in enumerate(instructions):
+        if instruction.name == "FROM":
+            _, values = split_flags(instruction.arguments)
+            stage = values[2] if len(values) >= 3 and values[1].upper() == "AS" else str(stage_count)
+            stage_count += 1
+            continue
+        if instruction.name != "ARG":
+            continue
+        try:
+            words = shlex.split(instruction.arguments)
+        except ValueError:
+            words = instruction.arguments.split()
+        for word in words:
+            declarations.append(
+                ArgDeclaration(word.split("=", 1)[0], stage, instruction.line, stage_ends[index] - index - 1)
+            )
+
+    return declarations
+
+
+def consumes_arg(name: str, declared: Iterable[str]) -> bool:
+    """Whether a build arg has any effect on a build declaring the given ARG names"""
+    return name in PREDEFINED_ARGS or name.startswith("BUILDKIT_") or name in declared
+
+
+def base_images(instructions: List[Instruction], build_args: Optional[Mapping[str, str]] = None) -> List[str]:
+    """Images the stages are built FROM, leaving out earlier stages and scratch
+
+    ARGs declared before the first FROM are substituted, with their value from build_args or their default.
+    """
+    build_args = build_args or {}
+    global_args: Dict[str, str] = {}
+    stages: List[str] = []
+    images: List[str] = []
+    for instruction in instructions:
+        if instruction.name == "ARG" and not stages:
+            try:
+                words = shlex.split(instruction.arguments)
+            except ValueError:
+                words = instruction.arguments.split()
+            for word in words:
+                name, has_default, default = word.partition("=")
+                if name in build_args:
+                    global_args[name] = build_args[name]
+                elif has_default:
+                    global_args[name] = default
+            continue
+        if instruction.name != "FROM":
+            continue
+
+        _, values = split_flags(instruction.arguments)
+        if not values:
+            continue
+        try:
+            image = interpolate_string(values[0], global_args)
+        except InterpolationError:
+            image = values[0]
+        if image.lower() not in stages and image != "scratch" and image not in images:
+            images.append(image)
+        stages.append(values[2].lower() if len(values) >= 3 and values[1].upper() == "AS" else "")
+
+    return images
@@ -0,0 +1,19 @@
+"""Where images are pushed, and a registry client authenticated against it"""
+import subprocess
+
+from registry import RegistryClient
+
+ECR_ACCOUNT: str = "362995399210"
+ECR_REGION: str = "ap-southeast-2"
+ECR_REGISTRY: str = f"{ECR_ACCOUNT}.dkr.ecr.{ECR_REGION}.amazonaws.com"
+
+
+def ecr_registry_client() -> RegistryClient:
+    """Create a registry client authenticated against the ECR registry images are pushed to"""
+    password = subprocess.run(
+        ["aws", "ecr", "get-login-password", "--region", ECR_REGION],
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout.strip()
+    return RegistryClient(ECR_REGISTRY, "AWS", password)
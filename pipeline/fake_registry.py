@@ -0,0 +1,193 @@
+"""An in-memory stand-in for a registry:2 server, used by the tests"""
+import base64
+import hashlib
+import json
+import re
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+
+PATH_PATTERN = re.compile(r"^/v2/(?P<name>.+)/(?P<kind>manifests|blobs|tags)/(?P<reference>[^/?]*)")
+
+
+def digest(content: bytes) -> str:
+    """Content digest in the form used by registries"""
+    return f"sha256:{hashlib.sha256(content).hexdigest()}"
+
+
+class FakeRegistry:
+    """Serves the subset of the distribution API the plugin uses, recording every request it receives"""
+
+    def __init__(
+        self,
+        username: Optional[str] = None,
+        password: Optional[str] = None,
+        immutable: bool = False,
+        redirect_blobs: bool = False,
+    ):
+        self.username = username
+        self.password = password
+        # Like an ECR repository with immutable tags, an existing tag can't be pointed at different content
+        self.immutable = immutable
+        # Like ECR, blob requests are redirected to storage that doesn't take the registry's credentials
+        self.redirect_blobs = redirect_blobs
+        # (repository, reference) => (media type, content), references are both tags and digests
+        self.manifests: Dict[Tuple[str, str], Tuple[str, bytes]] = {}
+        self.blobs: Dict[Tuple[str, str], bytes] = {}
+        self.requests: List[Tuple[str, str]] = []
+        self.connections = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True
+        )
+
+    @property
+    def host(self) -> str:
+        """host:port the registry is listening on"""
+        return f"127.0.0.1:{self._server.server_address[1]}"
+
+    def __enter__(self) -> "FakeRegistry":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *_) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def put_manifest(self, repository: str, tag: str, manifest: Dict[str, Any]) -> str:
+        """Store a manifest under a tag (and its digest), returning the digest"""
+        content = json.dumps(manifest).encode()
+        manifest_digest = digest(content)
+        media_type = manifest.get("mediaType", "application/vnd.oci.image.manifest.v1+json")
+        self.manifests[(repository, tag)] = (media_type, content)
+        self.manifests[(repository, manifest_digest)] = (media_type, content)
+        return manifest_digest
+
+    def put_blob(self, repository: str, content: bytes) -> str:
+        """Store a blob, returning its digest"""
+        blob_digest = digest(content)
+        self.blobs[(repository, blob_digest)] = content
+        return blob_digest
+
+    def get_manifest(self, repository: str, reference: str) -> Dict[str, Any]:
+        """Load a stored manifest"""
+        return json.loads(self.manifests[(repository, reference)][1])
+
+    def _handler(self):
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            """Request handler bound to this registry"""
+
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                super().setup()
+                with registry._lock:
+                    registry.connections += 1
+
+            def log_message(self, *_):
+                pass
+
+            def _reply(self, status: int, body: bytes = b"", headers: Optional[Dict[str, str]] = None):
+                self.send_response(status)
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                if self.command != "HEAD":
+                    self.wfile.write(body)
+
+            def _authorised(self) -> bool:
+                if registry.username is None:
+                    return True
+                expected = base64.b64encode(
+                    f"{registry.username}:{registry.password}".encode()
+                ).decode()
+                if self.headers.get("Authorization") == f"Basic {expected}":
+                    return True
+                self._reply(401, headers={"WWW-Authenticate": 'Basic realm="fake-registry"'})
+                return False
+
+            def _dispatch(self):
+                body = b""
+                if "Content-Length" in self.headers:
+                    body = self.rfile.read(int(self.headers["Content-Length"]))
+                with registry._lock:
+                    registry.requests.append((self.command, self.path))
+                storage = re.match(r"^/storage/(?P<name>.+)/(?P<reference>[^/]+)$", self.path)
+                if storage:
+                    if "Authorization" in self.headers:
+                        self._reply(400, b"Only one auth mechanism allowed")
+                        return
+                    self._blob(*storage.group("name", "reference"))
+                    return
+                if not self._authorised():
+                    return
+                if self.path == "/v2/":
+                    self._reply(200, b"{}")
+                    return
+                match = PATH_PATTERN.match(self.path)
+                if not match:
+                    self._reply(404)
+                    return
+                name, kind, reference = match.group("name", "kind", "reference")
+                getattr(self, f"_{kind}")(name, reference, body)
+
+            def _manifests(self, name: str, reference: str, body: bytes):
+                if self.command == "PUT":
+                    media_type = self.headers.get("Content-Type", "")
+                    manifest_digest = digest(body)
+                    existing = registry.manifests.get((name, reference))
+                    if registry.immutable and existing is not None and existing[1] != body:
+                        self._reply(400, b'{"errors": [{"code": "TAG_INVALID"}]}')
+                        return
+                    registry.manifests[(name, reference)] = (media_type, body)
+                    registry.manifests[(name, manifest_digest)] = (media_type, body)
+                    self._reply(201, headers={"Docker-Content-Digest": manifest_digest})
+                    return
+                if (name, reference) not in registry.manifests:
+                    self._reply(404, b'{"errors": [{"code": "MANIFEST_UNKNOWN"}]}')
+                    return
+                if self.command == "DELETE":
+                    del registry.manifests[(name, reference)]
+                    self._reply(202)
+                    return
+                media_type, content = registry.manifests[(name, reference)]
+                self._reply(
+                    200,
+                    content,
+                    {"Content-Type": media_type, "Docker-Content-Digest": digest(content)},
+                )
+
+            def _blobs(self, name: str, reference: str, _body: bytes):
+                if registry.redirect_blobs:
+                    self._reply(307, headers={"Location": f"/storage/{name}/{reference}"})
+                    return
+                self._blob(name, reference)
+
+            def _blob(self, name: str, reference: str):
+                if (name, reference) not in registry.blobs:
+                    self._reply(404, b'{"errors": [{"code": "BLOB_UNKNOWN"}]}')
+                    return
+                content = registry.blobs[(name, reference)]
+                # Only suffix ranges are needed, as used to read the size trailer of a gzipped layer
+                match = re.match(r"^bytes=-(\d+)$", self.headers.get("Range", ""))
+                if match:
+                    self._reply(206, content[-int(match.group(1)):])
+                    return
+                self._reply(200, content)
+
+            def _tags(self, name: str, _reference: str, _body: bytes):
+                tags = sorted(
+                    reference
+                    for repository, reference in registry.manifests
+                    if repository == name and not reference.startswith("sha256:")
+                )
+                self._reply(200, json.dumps({"name": name, "tags": tags}).encode())
+
+            do_GET = do_HEAD = do_PUT = do_DELETE = _dispatch
+
+        return Handler
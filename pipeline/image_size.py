@@ -0,0 +1,202 @@
+"""Compare the size of pushed images with a baseline, run by hooks/command for steps generated with image size checks
+
+Each entry of the `image-sizes` plugin option names a repository, the tag of each platform's image, the tags to use as
+a baseline in order of preference and the budgets to enforce. Sizes are read from the registry: the compressed size
+from the manifest and the uncompressed size of gzipped layers from the size trailer at the end of each layer.
+"""
+import json
+import os
+import subprocess
+import sys
+
+from typing import Any, Dict, List, Optional, Tuple
+
+from ecr import ecr_registry_client
+from registry import INDEX_MEDIA_TYPES, RegistryClient, RegistryError
+
+GZIP_LAYER_SUFFIXES: Tuple[str, ...] = ("+gzip", ".tar.gzip")
+TAR_LAYER_SUFFIXES: Tuple[str, ...] = (".tar",)
+
+
+def format_size(size: float) -> str:
+    """A byte count in the largest unit that keeps it above 1"""
+    for unit in ["B", "KB", "MB", "GB"]:
+        if size < 1024 or unit == "GB":
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+    raise AssertionError("unreachable")
+
+
+def same_platform(first: Dict[str, Any], second: Dict[str, Any]) -> bool:
+    """Whether two OCI platforms match, a variant only counts when both have one"""
+    if (first.get("os"), first.get("architecture")) != (second.get("os"), second.get("architecture")):
+        return False
+    return not (first.get("variant") and second.get("variant")) or first["variant"] == second["variant"]
+
+
+def image_manifest(
+    client: RegistryClient, repository: str, reference: str, platform: Optional[Dict[str, Any]] = None
+) -> Optional[Dict[str, Any]]:
+    """The image manifest behind a tag, picking the entry for a platform out of an index and skipping attestations"""
+    media_type, content = client.get_manifest(repository, reference)
+    manifest = json.loads(content)
+    if media_type not in INDEX_MEDIA_TYPES:
+        return manifest
+
+    entries = [
+        entry
+        for entry in manifest["manifests"]
+        if entry.get("platform", {}).get("os", "unknown") != "unknown"
+        and (platform is None or same_platform(entry["platform"], platform))
+    ]
+    if not entries:
+        return None
+    return json.loads(client.get_manifest(repository, entries[0]["digest"])[1])
+
+
+def uncompressed_size(client: RegistryClient, repository: str, layer: Dict[str, Any]) -> Optional[int]:
+    """Size of a layer once extracted, None when its compression doesn't record it"""
+    media_type = layer["mediaType"]
+    if media_type.endswith(GZIP_LAYER_SUFFIXES):
+        # A gzip stream ends with the size of its uncompressed data, modulo 4 GiB
+        return int.from_bytes(client.blob_tail(repository, layer["digest"], 4), "little")
+    if media_type.endswith(TAR_LAYER_SUFFIXES):
+        return layer["size"]
+    return None
+
+
+def image_stats(client: RegistryClient, repository: str, manifest: Dict[str, Any]) -> Dict[str, Any]:
+    """Compressed size, uncompressed size and layer count of an image"""
+    layers = manifest["layers"]
+    sizes = [uncompressed_size(client, repository, layer) for layer in layers]
+    return {
+        "size": manifest["config"]["size"] + sum(layer["size"] for layer in layers),
+        "uncompressed": None if None in sizes else sum(sizes),
+        "layers": len(layers),
+    }
+
+
+def image_platform(client: RegistryClient, repository: str, manifest: Dict[str, Any]) -> Dict[str, Any]:
+    """The platform an image was built for, from its config"""
+    config = json.loads(client.get_blob(repository, manifest["config"]["digest"]))
+    platform = {"os": config["os"], "architecture": config["architecture"]}
+    if config.get("variant"):
+        platform["variant"] = config["variant"]
+    return platform
+
+
+def baseline_stats(
+    client: RegistryClient, repository: str, tags: List[str], platform: Dict[str, Any]
+) -> Tuple[Optional[str], Optional[Dict[str, Any]]]:
+    """Stats of the platform's image behind the first baseline tag that has one"""
+    for tag in tags:
+        if not client.manifest_exists(repository, tag):
+            continue
+        manifest = image_manifest(client, repository, tag, platform)
+        if manifest is not None:
+            return tag, image_stats(client, repository, manifest)
+    return None, None
+
+
+def over_budget(stats: Dict[str, Any], baseline: Optional[Dict[str, Any]], spec: Dict[str, Any]) -> List[str]:
+    """Describe each budget an image exceeds"""
+    exceeded: List[str] = []
+    budgets = spec["budgets"]
+    if budgets["size"] and stats["size"] > budgets["size"] * 1024 * 1024:
+        exceeded.append(f'compressed size {format_size(stats["size"])} is over the budget of {budgets["size"]} MB')
+    if budgets["layers"] and stats["layers"] > budgets["layers"]:
+        exceeded.append(f'{stats["layers"]} layers is over the budget of {budgets["layers"]}')
+    if baseline is None:
+        return exceeded
+    if budgets["size-growth"] and stats["size"] > baseline["size"] * (1 + budgets["size-growth"] / 100):
+        growth = (stats["size"] - baseline["size"]) / baseline["size"] * 100
+        exceeded.append(f'compressed size grew {growth:.1f}%, over the budget of {budgets["size-growth"]}%')
+    if budgets["layer-growth"] and stats["layers"] - baseline["layers"] > budgets["layer-growth"]:
+        exceeded.append(f'{stats["layers"] - baseline["layers"]} more layers, over the budget of {budgets["layer-growth"]}')
+    return exceeded
+
+
+def check_image(spec: Dict[str, Any], client: RegistryClient) -> Tuple[List[Dict[str, Any]], List[str]]:
+    """Measure each platform's image and its baseline, returning a row per platform and the budgets exceeded"""
+    repository = spec["repository"]
+    rows: List[Dict[str, Any]] = []
+    failures: List[str] = []
+    for platform in spec["platforms"]:
+        manifest = image_manifest(client, repository, platform["tag"])
+        if manifest is None:
+            raise RegistryError("GET", f'{repository}:{platform["tag"]}', 404, b"no image manifest")
+        stats = image_stats(client, repository, manifest)
+        baseline_tag, baseline = baseline_stats(
+            client, repository, spec["baselines"], image_platform(client, repository, manifest)
+        )
+        rows.append({"platform": platform["name"], "stats": stats, "baseline-tag": baseline_tag, "baseline": baseline})
+        failures.extend(f'{platform["name"]}: {reason}' for reason in over_budget(stats, baseline, spec))
+    return rows, failures
+
+
+def format_change(value: Optional[int], baseline: Optional[int], size: bool = True) -> str:
+    """The difference from a baseline value, as a size or count and a percentage"""
+    if value is None or baseline is None:
+        return "-"
+    difference = value - baseline
+    sign = "+" if difference >= 0 else "-"
+    amount = format_size(abs(difference)) if size else str(abs(difference))
+    percentage = f" ({sign}{abs(difference) / baseline * 100:.1f}%)" if baseline else ""
+    return f"{sign}{amount}{percentage}"
+
+
+def annotation(spec: Dict[str, Any], rows: List[Dict[str, Any]], failures: List[str]) -> str:
+    """Markdown table of each platform's sizes and their change from the baseline"""
+    baseline_tags = sorted({row["baseline-tag"] for row in rows if row["baseline-tag"]})
+    summary = f'**Image size of {spec["image-name"]}**'
+    summary += f' compared with `{"`, `".join(baseline_tags)}`' if baseline_tags else ", no baseline image found"
+
+    lines = [
+        summary,
+        "",
+        "| Platform | Compressed | Change | Uncompressed | Change | Layers | Change |",
+        "| --- | --- | --- | --- | --- | --- | --- |",
+    ]
+    for row in rows:
+        stats, baseline = row["stats"], row["baseline"] or {}
+        uncompressed = "unknown" if stats["uncompressed"] is None else format_size(stats["uncompressed"])
+        lines.append(
+            f'| {row["platform"]} '
+            f'| {format_size(stats["size"])} | {format_change(stats["size"], baseline.get("size"))} '
+            f'| {uncompressed} | {format_change(stats["uncompressed"], baseline.get("uncompressed"))} '
+            f'| {stats["layers"]} | {format_change(stats["layers"], baseline.get("layers"), size=False)} |'
+        )
+    if failures:
+        lines.extend(["", "Over budget:", "", *[f"- {failure}" for failure in failures]])
+    return "\n".join(lines)
+
+
+def main(client: Optional[RegistryClient] = None) -> int:
+    """Check every image in the step's plugin configuration, annotating the build with the results"""
+    specs = json.loads(os.environ["BUILDKITE_PLUGIN_CONFIGURATION"])["image-sizes"]
+
+    failed = False
+    with client or ecr_registry_client() as registry:
+        for spec in specs:
+            try:
+                rows, failures = check_image(spec, registry)
+            except RegistryError as error:
+                print(f'Unable to read the size of {spec["image-name"]}: {error}', file=sys.stderr)
+                failed = True
+                continue
+
+            markdown = annotation(spec, rows, failures)
+            print(markdown)
+            subprocess.run(
+                ["buildkite-agent", "annotate", "--style", "error" if failures else "info", "--context", spec["context"]],
+                input=markdown,
+                text=True,
+                check=False,
+            )
+            failed = failed or bool(failures)
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,99 @@
+"""Environment interpolation matching what `buildkite-agent pipeline upload` applies to a pipeline"""
+import re
+
+from typing import Any, Callable, Dict, Mapping, Optional
+
+NAME = r"[A-Za-z_][A-Za-z0-9_]*"
+EXPRESSION_PATTERN = re.compile(
+    rf"\$\$|\\\$|\$(?P<bare>{NAME})|\$\{{(?P<name>{NAME})(?P<operator>:-|-|:\?|\?|:)?(?P<argument>[^}}]*)\}}"
+)
+
+
+class InterpolationError(ValueError):
+    """A required variable, from ${NAME:?message} or ${NAME?message}, isn't set"""
+
+
+def substring(value: str, argument: str) -> str:
+    """${NAME:offset} and ${NAME:offset:length}, a negative offset counts from the end"""
+    offset, _, length = argument.partition(":")
+    start = int(offset.strip() or 0)
+    start = max(len(value) + start, 0) if start < 0 else start
+    if not length:
+        return value[start:]
+    count = int(length.strip())
+    return value[start : start + count] if count >= 0 else value[start:count]
+
+
+def plain(name: str, argument: str, environ: Mapping[str, str]) -> Optional[str]:
+    """${NAME}, anything else after the name isn't an expression the agent understands and is left alone"""
+    return None if argument else environ.get(name, "")
+
+
+def default_if_empty(name: str, argument: str, environ: Mapping[str, str]) -> Optional[str]:
+    """${NAME:-default}"""
+    return environ.get(name) or interpolate_string(argument, environ)
+
+
+def default_if_unset(name: str, argument: str, environ: Mapping[str, str]) -> Optional[str]:
+    """${NAME-default}"""
+    return environ[name] if name in environ else interpolate_string(argument, environ)
+
+
+def required_non_empty(name: str, argument: str, environ: Mapping[str, str]) -> Optional[str]:
+    """${NAME:?message}"""
+    if not environ.get(name):
+        raise InterpolationError(f"{name}: {argument or 'not set'}")
+    return environ[name]
+
+
+def required_set(name: str, argument: str, environ: Mapping[str, str]) -> Optional[str]:
+    """${NAME?message}"""
+    if name not in environ:
+        raise InterpolationError(f"{name}: {argument or 'not set'}")
+    return environ[name]
+
+
+def substring_of(name: str, argument: str, environ: Mapping[str, str]) -> Optional[str]:
+    """${NAME:offset:length}, left alone when the offset or length isn't a number"""
+    try:
+        return substring(environ.get(name, ""), argument)
+    except ValueError:
+        return None
+
+
+# Expands a ${NAME...} expression by its operator, None leaves the expression as it is
+OPERATORS: Dict[str, Callable[[str, str, Mapping[str, str]], Optional[str]]] = {
+    "": plain,
+    ":-": default_if_empty,
+    "-": default_if_unset,
+    ":?": required_non_empty,
+    "?": required_set,
+    ":": substring_of,
+}
+
+
+def interpolate_string(value: str, environ: Mapping[str, str]) -> str:
+    """Expand $NAME and ${NAME...} references, with $$ and \\$ left as a literal $"""
+
+    def expand(match: "re.Match[str]") -> str:
+        if match.group(0) in ("$$", "\\$"):
+            return "$"
+        if match.group("bare"):
+            return environ.get(match.group("bare"), "")
+
+        name, operator, argument = match.group("name", "operator", "argument")
+        expanded = OPERATORS[operator or ""](name, argument, environ)
+        return match.group(0) if expanded is None else expanded
+
+    return EXPRESSION_PATTERN.sub(expand, value)
+
+
+def interpolate(value: Any, environ: Mapping[str, str]) -> Any:
+    """Interpolate every string in a pipeline, keys included"""
+    if isinstance(value, str):
+        return interpolate_string(value, environ)
+    if isinstance(value, list):
+        return [interpolate(item, environ) for item in value]
+    if isinstance(value, dict):
+        return {interpolate(key, environ): interpolate(item, environ) for key, item in value.items()}
+    return value
@@ -0,0 +1,83 @@
+"""Create the tags of the manifest step in-process, run by hooks/command for steps generated with `manifest-client: registry`
+
+Each entry of the `manifest` plugin option names a repository, the source images (tags within it) and the tags to
+create. The index is built from the source manifests once and written under every tag over a single connection.
+Tags to replace are removed beforehand with one `aws ecr batch-delete-image` call.
+"""
+import json
+import os
+import subprocess
+import sys
+
+from typing import Any, Callable, Dict, List, Optional
+
+from ecr import ECR_ACCOUNT, ecr_registry_client
+from registry import RegistryClient, RegistryError
+
+
+def delete_tags(repository: str, tags: List[str]) -> None:
+    """Untag images in ECR in a single request, tags that don't exist are skipped"""
+    result = subprocess.run(
+        [
+            "aws", "ecr", "batch-delete-image",
+            "--registry-id", ECR_ACCOUNT,
+            "--repository-name", repository,
+            "--image-ids", *[f"imageTag={tag}" for tag in tags],
+        ],
+        check=False,
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        print(f"Unable to remove {', '.join(tags)} from {repository}, continuing: {result.stderr.strip()}", file=sys.stderr)
+
+
+def create_tags(
+    spec: Dict[str, Any],
+    client: RegistryClient,
+    delete: Optional[Callable[[str, List[str]], None]] = None,
+) -> List[str]:
+    """Tag the index of a spec's sources, returning the required tags that couldn't be created"""
+    repository = spec["repository"]
+    try:
+        media_type, content = client.build_index(repository, spec["sources"])
+    except RegistryError as error:
+        print(f"Unable to read the images to tag from {repository}: {error}", file=sys.stderr)
+        return [f'{repository}:{tag["tag"]}' for tag in spec["tags"] if not tag["optional"]]
+
+    # Existing tags are only removed once the source images have been read, so a failed lookup leaves them in place
+    replace = [tag["tag"] for tag in spec["tags"] if tag["replace"]]
+    if replace:
+        (delete or delete_tags)(repository, replace)
+
+    failed: List[str] = []
+    for tag in spec["tags"]:
+        try:
+            digest = client.put_manifest(repository, tag["tag"], media_type, content)
+            print(f'Tagged {repository}:{tag["tag"]} ({digest})')
+        except RegistryError as error:
+            if tag["optional"]:
+                print(f'Unable to create {repository}:{tag["tag"]}, continuing: {error}', file=sys.stderr)
+                continue
+            print(f'Unable to create {repository}:{tag["tag"]}: {error}', file=sys.stderr)
+            failed.append(f'{repository}:{tag["tag"]}')
+    return failed
+
+
+def main(client: Optional[RegistryClient] = None) -> int:
+    """Create the tags of every image in the step's plugin configuration"""
+    specs = json.loads(os.environ["BUILDKITE_PLUGIN_CONFIGURATION"])["manifest"]
+
+    failed: List[str] = []
+    with client or ecr_registry_client() as registry:
+        for spec in specs:
+            failed.extend(create_tags(spec, registry))
+
+    if failed:
+        print(f"Failed to create {', '.join(failed)}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,193 @@
+"""Steps run once every platform is built: the image size check and the multi-platform manifests"""
+from typing import List, Dict, Any, Tuple
+
+from ecr import ECR_ACCOUNT
+from options import image_size_checked, platform_names, sanitise_image_tag
+from steps import fingerprint_tag, gzip_variant, phase_timing_setup, scan_step_key, timed
+
+
+def create_image_size_step(configs: List[Dict[str, Any]], dependencies: List[str]) -> Dict[str, Any]:
+    """Create a step stub comparing the size of each pushed image with the image of the branches it caches from"""
+    specs: List[Dict[str, Any]] = []
+    for config in configs:
+        image_tag = sanitise_image_tag(config["image-tag"])
+        specs.append(
+            {
+                "image-name": config["image-name"],
+                "repository": f'{config["repository-namespace"]}/{config["image-name"]}' if config["repository-namespace"] else config["image-name"],
+                "context": f'{config["group-key"]}-image-size{"-" + config["image-key"] if config["image-key"] else ""}',
+                "platforms": [
+                    {"name": platform, "tag": f"multi-platform-{image_tag}-{platform}"}
+                    for platform in platform_names(config)
+                ],
+                "baselines": [f"cache_{sanitise_image_tag(branch)}" for branch in config["cache-from-branches"]],
+                "budgets": {
+                    "size": config["image-size-budget"],
+                    "size-growth": config["image-size-growth-budget"],
+                    "layers": config["image-layer-budget"],
+                    "layer-growth": config["image-layer-growth-budget"],
+                },
+            }
+        )
+
+    return {
+        "label": ":straight_ruler: Check image sizes",
+        "key": f'{configs[0]["group-key"]}-image-size',
+        "depends_on": dependencies,
+        "plugins": [{configs[0]["plugin-ref"]: {"image-sizes": specs}}, *configs[0]["additional-plugins"]],
+    }
+
+
+def rewrites_size_baseline(config: Dict[str, Any]) -> bool:
+    """Whether the manifest step replaces a tag the image size check compares with, as it does on the default branch"""
+    baselines = {f"cache_{sanitise_image_tag(branch)}" for branch in config["cache-from-branches"]}
+    return any(tag["tag"] in baselines for tag in manifest_tags(config))
+
+
+def manifest_tags(config: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Tags the manifest step creates in order, whether an existing tag is removed first and whether failing to create it is harmless"""
+    tags: List[Dict[str, Any]] = [
+        {"tag": sanitise_image_tag(config["image-tag"]), "replace": config["mutate-image-tag"], "optional": False},
+    ]
+
+    if config["additional-tag"]:
+        tags.append({"tag": sanitise_image_tag(config["additional-tag"]), "replace": config["mutate-image-tag"], "optional": False})
+
+    # Registry cache is exported by the build steps themselves, the cache_branch index is then only kept as the
+    # baseline of the image size check
+    if config["current-branch"] != "" and (config["cache-export"] != "registry" or image_size_checked(config)):
+        # Always remove the cache_branch tagged image so we can update it in immutable repositories as cache for the next build
+        tags.append({"tag": f'cache_{sanitise_image_tag(config["current-branch"])}', "replace": True, "optional": False})
+
+    if config["cache-from-ancestors"] and config["cache-export"] != "registry":
+        # Commit cache tags never move, so an existing one in an immutable repository is left alone
+        tags.append({"tag": f'cache_{config["current-commit"]}', "replace": False, "optional": True})
+
+    if config["fingerprint"] and not config["prebuilt-images"]:
+        # Fingerprint tags are content addressed, losing a race to create one in an immutable repository is harmless
+        tags.append({"tag": fingerprint_tag(config), "replace": False, "optional": True})
+
+    return tags
+
+
+def create_oci_manifest_step(config: Dict[str, Any]) -> Dict[str, Any]:
+    """Create a step stub to create a container manifest and push it to ECR"""
+    image_tag = sanitise_image_tag(config["image-tag"])
+
+    images: List[str] = [
+        f'{config["fully-qualified-image-name"]}:multi-platform-{image_tag}-{platform}'
+        for platform in platform_names(config)
+    ]
+    dependencies: List[str] = [
+        f'{config["group-key"]}-build-push-{platform}'
+        for platform in platform_names(config)
+    ]
+    label = ":docker: Create container manifest"
+
+    if config["scan-image"] and config["block-on-container-scan"]:
+        dependencies.extend(
+            scan_step_key(platform, config)
+            for platform in platform_names(config)
+        )
+
+    if config["prebuilt-images"]:
+        # Nothing is built, the tags are created from images pushed by an earlier build
+        images = config["prebuilt-images"]
+        dependencies = []
+        label = ":docker: Tag existing container image"
+
+    step: Dict[str, Any] = {
+        "label": label,
+        "depends_on": dependencies,
+        "key": f'{config["group-key"]}-manifest',
+        "plugins": [],
+    }
+
+    # Each index is created from its platform images under every one of its tags
+    indexes: List[Tuple[List[str], List[Dict[str, Any]]]] = [(images, manifest_tags(config))]
+    if gzip_variant(config) and not config["prebuilt-images"]:
+        indexes.append(
+            (
+                [f"{image}-gzip" for image in images],
+                [
+                    {"tag": f"{sanitise_image_tag(tag)}-gzip", "replace": config["mutate-image-tag"], "optional": False}
+                    for tag in (config["image-tag"], config["additional-tag"])
+                    if tag
+                ],
+            )
+        )
+
+    repository = f'{config["repository-namespace"]}/{config["image-name"]}' if config["repository-namespace"] else config["image-name"]
+    if config["manifest-client"] == "registry" and config["plugin-ref"]:
+        # The plugin's own hook builds the index once and writes every tag over one registry connection
+        step["plugins"].append(
+            {
+                config["plugin-ref"]: {
+                    "manifest": [
+                        {
+                            "repository": repository,
+                            "sources": [image.rsplit(":", 1)[1] for image in sources],
+                            "tags": tags,
+                        }
+                        for sources, tags in indexes
+                    ],
+                },
+            }
+        )
+    else:
+        step["command"] = []
+        for sources, tags in indexes:
+            for tag in tags:
+                if tag["replace"]:
+                    step["command"].append(
+                        f'aws ecr batch-delete-image --registry-id {ECR_ACCOUNT} --repository-name {repository} --image-ids imageTag={tag["tag"]} || true'
+                    )
+                step["command"].append(
+                    f'docker buildx imagetools create -t {config["fully-qualified-image-name"]}:{tag["tag"]} {" ".join(sources)}{" || true" if tag["optional"] else ""}'
+                )
+
+    if config["phase-timings"] and "command" in step:
+        step["command"] = [
+            *phase_timing_setup("all"),
+            *[
+                timed("untag" if command.startswith("aws ecr batch-delete-image") else "manifest", command, config)
+                for command in step["command"]
+            ],
+        ]
+
+    if len(config["additional-plugins"]) > 0:
+        for plugin in config["additional-plugins"]:
+            step["plugins"].append(plugin)
+
+    return step
+
+
+def create_shared_manifest_step(
+    configs: List[Dict[str, Any]], dependencies: List[Any]
+) -> Dict[str, Any]:
+    """Create a single step stub tagging the manifests of every image built by the group"""
+    image_steps = [create_oci_manifest_step(config) for config in configs]
+    if len(image_steps) == 1:
+        return image_steps[0] | {"depends_on": dependencies}
+
+    if "command" not in image_steps[0]:
+        # Every image is tagged by one run of the plugin's manifest hook
+        manifest_plugin, *additional_plugins = image_steps[0]["plugins"]
+        ref = next(iter(manifest_plugin))
+        specs = [spec for image_step in image_steps for spec in image_step["plugins"][0][ref]["manifest"]]
+        return image_steps[0] | {
+            "label": ":docker: Create container manifests",
+            "depends_on": dependencies,
+            "plugins": [{ref: {"manifest": specs}}, *additional_plugins],
+        }
+
+    commands: List[str] = []
+    for image_step in image_steps:
+        # Phase timing setup is the same for every image
+        commands.extend(command for command in image_step["command"] if command not in commands)
+
+    return image_steps[0] | {
+        "label": ":docker: Create container manifests",
+        "depends_on": dependencies,
+        "command": commands,
+    }
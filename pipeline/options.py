@@ -0,0 +1,619 @@
+"""The plugin's options, read from the plugin configuration and the build environment"""
+import json
+import os
+import sys
+import time
+
+from typing import List, Dict, Any, Mapping, Optional, Tuple
+
+from ecr import ECR_REGISTRY
+from package_caches import process_package_caches
+
+# renovate: datasource=github-releases depName=moby/buildkit
+BUILDKIT_VERSION: str = "v0.12.3"
+
+PLUGIN_NAME: str = "build-and-push"
+
+BUILD_PLATFORMS: Dict[str, str] = {
+    # platform => buildkite agent name, used unless `platforms` is configured
+    "arm": "docker-arm",
+    "x86": "docker",
+}
+
+# dry-run: write pipeline.yaml for hooks/command to interpolate, archive and upload in separate agent calls
+# stream: interpolate here and write the final pipeline to stdout for a single `pipeline upload`
+UPLOAD_MODES: List[str] = ["dry-run", "stream"]
+
+CACHE_EXPORTS: List[str] = ["none", "inline", "registry"]
+CACHE_EXPORT_MODES: List[str] = ["min", "max"]
+
+PUSH_MODES: List[str] = ["load", "direct"]
+
+# Layer compression of pushed images, anything but gzip needs the builder to push them itself
+COMPRESSIONS: List[str] = ["gzip", "zstd", "estargz"]
+
+CONTEXT_BUDGET_ACTIONS: List[str] = ["warn", "fail"]
+
+# none: every image is scanned
+# local: results are kept on the agent that scanned the image, s3: in a bucket shared by every agent
+SCAN_CACHES: List[str] = ["none", "local", "s3"]
+
+# cli: aws and docker buildx imagetools commands per tag
+# registry: the plugin's hook creates the index once in-process and writes every tag over one connection
+MANIFEST_CLIENTS: List[str] = ["cli", "registry"]
+
+# Options that can be set per entry of `images`, everything else is shared by all images
+IMAGE_OPTIONS: List[str] = [
+    "dockerfile-path",
+    "context-path",
+    "image-name",
+    "image-tag",
+    "additional-tag",
+    "build-args",
+    "repository-namespace",
+    "composer-cache",
+    "npm-cache",
+    "yarn-cache",
+    "package-caches",
+    "secrets",
+    "secrets-as-build-args",
+    "image-size-budget",
+    "image-layer-budget",
+]
+
+# Budgets that turn on the image size check, and fail it when exceeded
+IMAGE_SIZE_BUDGETS: List[str] = [
+    "image-size-budget",
+    "image-size-growth-budget",
+    "image-layer-budget",
+    "image-layer-growth-budget",
+]
+
+
+def config_definition(environ: Mapping[str, str]) -> Dict[str, Any]:
+    """The type and default of every option, some defaults come from the build environment"""
+    return {
+        "dockerfile-path": {
+            "type": "string",
+            "default": "Dockerfile",
+        },
+        "context-path": {
+            "type": "string",
+            "default": ".",
+        },
+        "image-name": {
+            "type": "string",
+            "default": environ["BUILDKITE_PIPELINE_NAME"],
+        },
+        "image-tag": {
+            "type": "string",
+            "default": environ["BUILDKITE_COMMIT"][0:10],
+        },
+        "additional-tag": {
+            "type": "string",
+            "default": None,
+        },
+        "build-args": {
+            "type": "list",
+            "default": [],
+        },
+        "build-arm": {
+            "type": "bool",
+            "default": True,
+        },
+        "build-x86": {
+            "type": "bool",
+            "default": True,
+        },
+        "scan-image": {
+            "type": "bool",
+            "default": True,
+        },
+        "scan-cache": {
+            "type": "string",
+            "default": "none",
+        },
+        "scan-cache-location": {
+            "type": "string",
+            "default": "",
+        },
+        "scan-cache-ttl": {
+            "type": "int",
+            "default": 24,
+        },
+        "group-key": {
+            "type": "string",
+            "default": "build-and-push",
+        },
+        "always-pull": {
+            "type": "bool",
+            "default": True,
+        },
+        "composer-cache": {
+            "type": "bool",
+            "default": False,
+        },
+        "npm-cache": {
+            "type": "bool",
+            "default": False,
+        },
+        "yarn-cache": {
+            "type": "bool",
+            "default": False,
+        },
+        "package-caches": {
+            "type": "package-caches",
+            "default": [],
+        },
+        "platforms": {
+            "type": "platforms",
+            "default": [],
+        },
+        "context-analysis": {
+            "type": "bool",
+            "default": False,
+        },
+        "context-size-budget": {
+            "type": "int",
+            "default": 0,
+        },
+        "context-budget-action": {
+            "type": "string",
+            "default": "warn",
+        },
+        "build-args-filter": {
+            "type": "bool",
+            "default": True,
+        },
+        "reproducible-build-date": {
+            "type": "bool",
+            "default": False,
+        },
+        "secrets": {
+            "type": "list",
+            "default": ["GITHUB_TOKEN"],
+        },
+        "secrets-as-build-args": {
+            "type": "bool",
+            "default": False,
+        },
+        "push-branches": {
+            "type": "list",
+            "default": [],
+        },
+        "repository-namespace": {
+            "type": "string",
+            "default": "catch",
+        },
+        "mutate-image-tag": {
+            "type": "bool",
+            "default": False,
+        },
+        "additional-plugins": {
+            "type": "json",
+            "default": [],
+        },
+        "output-format": {
+            "type": "string",
+            "default": "json",
+        },
+        "upload-mode": {
+            "type": "string",
+            "default": "dry-run",
+        },
+        "archive-pipeline": {
+            "type": "bool",
+            "default": True,
+        },
+        "skip-unchanged-builds": {
+            "type": "bool",
+            "default": False,
+        },
+        "promote-tag-builds": {
+            "type": "bool",
+            "default": False,
+        },
+        "compression": {
+            "type": "string",
+            "default": "gzip",
+        },
+        "compression-level": {
+            "type": "int",
+            "default": 0,
+        },
+        "force-compression": {
+            "type": "bool",
+            "default": False,
+        },
+        "gzip-variant": {
+            "type": "bool",
+            "default": False,
+        },
+        "manifest-client": {
+            "type": "string",
+            "default": "cli",
+        },
+        "cache-export": {
+            "type": "string",
+            "default": "none",
+        },
+        "cache-export-mode": {
+            "type": "string",
+            "default": "max",
+        },
+        "push-mode": {
+            "type": "string",
+            "default": "load",
+        },
+        "images": {
+            "type": "json",
+            "default": [],
+        },
+        "images-per-job": {
+            "type": "int",
+            "default": 0,
+        },
+        "order-base-images": {
+            "type": "bool",
+            "default": True,
+        },
+        "image-size-check": {
+            "type": "bool",
+            "default": False,
+        },
+        "image-size-budget": {
+            "type": "int",
+            "default": 0,
+        },
+        "image-size-growth-budget": {
+            "type": "int",
+            "default": 0,
+        },
+        "image-layer-budget": {
+            "type": "int",
+            "default": 0,
+        },
+        "image-layer-growth-budget": {
+            "type": "int",
+            "default": 0,
+        },
+        "remote-builders": {
+            "type": "json",
+            "default": {},
+        },
+        "buildkitd-gc-keep-storage": {
+            "type": "int",
+            "default": 0,
+        },
+        "buildkitd-gc-keep-duration": {
+            "type": "int",
+            "default": 0,
+        },
+        "buildkitd-registry-mirrors": {
+            "type": "json",
+            "default": {},
+        },
+        "buildkitd-max-parallelism": {
+            "type": "int",
+            "default": 0,
+        },
+        "builder-affinity-shards": {
+            "type": "int",
+            "default": 0,
+        },
+        "builder-affinity-tag": {
+            "type": "string",
+            "default": "build-cache-shard",
+        },
+        "cache-from-branches": {
+            "type": "list",
+            "default": [],
+        },
+        "cache-from-ancestors": {
+            "type": "int",
+            "default": 0,
+        },
+        "cache-from-limit": {
+            "type": "int",
+            "default": 4,
+        },
+        "phase-timings": {
+            "type": "bool",
+            "default": False,
+        },
+    }
+
+
+def process_bool(value: str) -> bool:
+    """A boolean option given as a string"""
+    return value.lower() == "true"
+
+
+def process_list(value: str) -> List[str]:
+    """A comma-delimited list option"""
+    return value.split(",")
+
+
+def process_value(definition: Dict[str, Any], value: Any) -> Any:
+    """An option's value converted to its type"""
+    if definition["type"] == "bool" and isinstance(value, str):
+        return process_bool(value)
+    if definition["type"] == "package-caches":
+        return process_package_caches(value)
+    if definition["type"] == "platforms":
+        return process_platforms(value)
+    if definition["type"] == "list" and isinstance(value, str):
+        return process_list(value)
+    if definition["type"] == "int" and isinstance(value, str):
+        return int(value)
+    return value
+
+
+def process_platforms(value: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """The platforms option, OCI platforms mapped to a queue or settings"""
+    platforms: List[Dict[str, Any]] = []
+    for oci_platform, entry in value.items():
+        if not 2 <= len(oci_platform.split("/")) <= 3 or "" in oci_platform.split("/"):
+            raise ValueError(f"Invalid platform {oci_platform}, expected os/architecture[/variant]")
+        if isinstance(entry, str):
+            entry = {"queue": entry}
+        if not entry.get("queue"):
+            raise ValueError(f"Platform {oci_platform} is missing a queue")
+        build_args = entry.get("build-args", [])
+        platforms.append(
+            {
+                # Short names keep step keys and tags readable, the OS is left out as everything is built for linux
+                "name": sanitise_step_key(
+                    entry.get("name") or oci_platform.removeprefix("linux/").replace("/", "-")
+                ),
+                "platform": oci_platform,
+                "queue": entry["queue"],
+                "resource-class": entry.get("resource-class"),
+                "build-args": process_list(build_args) if isinstance(build_args, str) else build_args,
+            }
+        )
+
+    names = [platform["name"] for platform in platforms]
+    if len(set(names)) != len(names):
+        raise ValueError("Each entry of platforms must have a distinct name")
+    return platforms
+
+
+# Options limited to a fixed set of values
+OPTION_CHOICES: Dict[str, List[str]] = {
+    "cache-export": CACHE_EXPORTS,
+    "cache-export-mode": CACHE_EXPORT_MODES,
+    "push-mode": PUSH_MODES,
+    "upload-mode": UPLOAD_MODES,
+    "compression": COMPRESSIONS,
+    "manifest-client": MANIFEST_CLIENTS,
+    "scan-cache": SCAN_CACHES,
+    "context-budget-action": CONTEXT_BUDGET_ACTIONS,
+}
+
+
+def validate_config(config: Dict[str, Any]) -> None:
+    """Reject options with unknown values or that conflict with each other, and normalise buildkitd-registry-mirrors"""
+    for name, choices in OPTION_CHOICES.items():
+        if config[name] not in choices:
+            raise ValueError(f'Unknown {name} {config[name]}, expected one of {", ".join(choices)}')
+
+    if config["compression"] != "gzip" and config["push-mode"] != "direct":
+        # docker image push always recompresses layers with gzip
+        raise ValueError(f'compression {config["compression"]} needs push-mode direct')
+    for name in ["compression-level", "force-compression"]:
+        if config[name] and config["push-mode"] != "direct":
+            raise ValueError(f"{name} needs push-mode direct")
+    if config["gzip-variant"] and config["compression"] == "gzip":
+        print("gzip-variant has no effect when compression is gzip, the images are already gzip", file=sys.stderr)
+
+    mirrors = config["buildkitd-registry-mirrors"]
+    if not isinstance(mirrors, dict) or not all(isinstance(hosts, (str, list)) for hosts in mirrors.values()):
+        raise ValueError("buildkitd-registry-mirrors must map registries to a mirror or a list of mirrors")
+    config["buildkitd-registry-mirrors"] = {
+        registry: [hosts] if isinstance(hosts, str) else hosts for registry, hosts in mirrors.items()
+    }
+
+    if config["scan-cache"] == "s3" and not config["scan-cache-location"].startswith("s3://"):
+        raise ValueError("scan-cache s3 needs an s3:// scan-cache-location")
+
+
+def process_image_config(image_config: Dict[str, Any], build_time: int) -> Dict[str, Any]:
+    """Fill in the settings derived from an image's own options, for the top-level image and each of images"""
+    # Secrets are only passed as build args for Dockerfiles that still read them from an ARG
+    secret_build_args = [
+        secret_id if secret_id == env else f"{secret_id}=$${env}"
+        for secret_id, env in secret_sources(image_config)
+    ] if image_config["secrets-as-build-args"] else []
+    image_config["build-args"] = [
+        *image_config["build-args"],
+        *secret_build_args,
+        "BUILDKITE_COMMIT",
+        "BUILDKITE_JOB_ID",
+        f"BUILD_DATE={build_time}",
+    ]
+
+    ecr_repository_namespace_joiner = (
+        f'{image_config["repository-namespace"]}/' if image_config["repository-namespace"] else ""
+    )
+
+    image_config[
+        "fully-qualified-image-name"
+    ] = f'{ECR_REGISTRY}/{ecr_repository_namespace_joiner}{image_config["image-name"]}'
+
+    # Populated by resolve_unchanged_build() when a previous build can be reused
+    image_config["fingerprint"] = None
+    image_config["prebuilt-images"] = []
+    # Populated by resolve_build_args() from the Dockerfile and git history
+    image_config["dockerfile-args"] = None
+    image_config["source-date-epoch"] = None
+    # Populated by resolve_base_images() with each FROM reference to another of the images, by its image-key
+    image_config["base-images"] = {}
+    # Set by generate() for each platform with the pushed image to use for each of those references
+    image_config["base-image-contexts"] = {}
+
+    return image_config
+
+
+def process_images(config: Dict[str, Any], definition: Dict[str, Any], build_time: int) -> List[Dict[str, Any]]:
+    """The config of each entry of images, the top-level config with the entry's options applied"""
+    images: List[Dict[str, Any]] = []
+    for entry in config["images"]:
+        unknown_options = sorted(set(entry) - set(IMAGE_OPTIONS))
+        if unknown_options:
+            raise ValueError(f'Unknown images option(s) {", ".join(unknown_options)}, expected any of {", ".join(IMAGE_OPTIONS)}')
+
+        image_config = config | {
+            name: process_value(definition[name], value)
+            for name, value in entry.items()
+        }
+        image_config["images"] = []
+        # Distinguishes the steps and meta-data of images that share a group
+        image_config["image-key"] = sanitise_step_key(image_config["image-name"])
+        images.append(process_image_config(image_config, build_time))
+
+    image_keys = [image["image-key"] for image in images]
+    if len(set(image_keys)) != len(image_keys):
+        raise ValueError("Each entry of images must have a distinct image-name")
+    return images
+
+
+def process_config(environ: Optional[Mapping[str, str]] = None) -> Dict[str, Any]:
+    """Process buildkite plugin environment variables into a config dict"""
+    if environ is None:
+        environ = os.environ
+
+    definition = config_definition(environ)
+
+    if "BUILDKITE_PLUGIN_CONFIGURATION" not in environ:
+        print("BUILDKITE_PLUGIN_CONFIGURATION environment variable not set, assuming no plugin configuration has been provided", file=sys.stderr)
+
+    config = json.loads(environ.get("BUILDKITE_PLUGIN_CONFIGURATION", "{}"))
+
+    for name, value in definition.items():
+        if name not in config:
+            config[name] = value.get("default", None)
+            continue
+
+        config[name] = process_value(value, config[name])
+
+    validate_config(config)
+
+    # Everything the step generators need from the build environment is captured here so that
+    # generate() is a pure function of the config
+    config["current-branch"] = environ.get("BUILDKITE_BRANCH", "")
+    config["current-tag"] = environ.get("BUILDKITE_TAG", "")
+    config["current-commit"] = environ["BUILDKITE_COMMIT"]
+    config["pipeline-name"] = environ["BUILDKITE_PIPELINE_NAME"]
+    config["build-number"] = environ.get("BUILDKITE_BUILD_NUMBER", "")
+    config["plugin-ref"] = plugin_ref(environ)
+    # Populated by resolve_builder_affinity() with the tags of the agents that are free to take a build, each pinned build step takes one
+    config["idle-agents"] = None
+    if config["manifest-client"] == "registry" and not config["plugin-ref"]:
+        print("Unable to find this plugin in BUILDKITE_PLUGINS, the manifest step will use the cli manifest-client", file=sys.stderr)
+    config["block-on-container-scan"] = (
+        environ.get("BLOCK_BUILD_AND_PUSH_ON_SCAN", "false").lower() == "true"
+    )
+    config["buildkit-version"] = environ.get(
+        "BUILD_AND_PUSH_BUILDKIT_VERSION", BUILDKIT_VERSION
+    )
+
+    config["group-key"] = sanitise_step_key(config["group-key"])
+
+    process_cache_sources(config, environ)
+
+    config["push-to-ecr"] = (
+        not config["push-branches"]
+        or config["current-branch"] in config["push-branches"]
+        or config["current-branch"] == config["current-tag"]
+    )
+
+    build_time = int(time.time())
+    images = process_images(config, definition, build_time)
+    config = process_image_config(config, build_time)
+    config["image-key"] = ""
+    config["images"] = images
+
+    if any(image_size_checked(image) for image in images or [config]) and not config["plugin-ref"]:
+        print("Unable to find this plugin in BUILDKITE_PLUGINS, image sizes won't be checked", file=sys.stderr)
+
+    return config
+
+
+def process_cache_sources(config: Dict[str, Any], environ: Mapping[str, str]) -> None:
+    """Fill in the branches cache is imported from, the default branch and the branch a pull request merges into"""
+    # Buildkite sets this to "false" rather than leaving it empty for builds that aren't pull requests
+    pull_request_base_branch = environ.get("BUILDKITE_PULL_REQUEST_BASE_BRANCH", "")
+    config["pull-request-base-branch"] = "" if pull_request_base_branch == "false" else pull_request_base_branch
+
+    if not config["cache-from-branches"]:
+        default_branch = environ.get("BUILDKITE_PIPELINE_DEFAULT_BRANCH", "")
+        config["cache-from-branches"] = [default_branch] if default_branch else ["main", "master"]
+
+    # Populated by resolve_cache_ancestor() with the nearest ancestor commit that exported cache
+    config["cache-ancestor"] = None
+
+
+def plugin_ref(environ: Mapping[str, str]) -> Optional[str]:
+    """How the running step refers to this plugin, including its version, so generated steps can use the same one"""
+    try:
+        plugins = json.loads(environ.get("BUILDKITE_PLUGINS", "[]"))
+    except json.JSONDecodeError:
+        return None
+    for plugin in plugins:
+        for ref in plugin:
+            name = ref.split("#", 1)[0].rstrip("/").rsplit("/", 1)[-1].lower()
+            if name.removesuffix(".git") in ("build-and-push", "build-and-push-buildkite-plugin"):
+                return ref
+    return None
+
+
+def secret_sources(config: Dict[str, Any]) -> List[Tuple[str, str]]:
+    """(id, environment variable) of each secret, entries are either NAME or ID=NAME"""
+    sources: List[Tuple[str, str]] = []
+    for entry in config["secrets"]:
+        secret_id, _, env = entry.strip().partition("=")
+        if secret_id:
+            sources.append((secret_id, env or secret_id))
+    return sources
+
+
+def build_platforms(config: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """The platforms images are built for, from `platforms` or the build-<platform> options when it isn't set"""
+    if config["platforms"]:
+        return config["platforms"]
+    return [
+        {"name": name, "platform": None, "queue": queue, "resource-class": None, "build-args": []}
+        for name, queue in BUILD_PLATFORMS.items()
+        if config[f"build-{name}"]
+    ]
+
+
+def platform_names(config: Dict[str, Any]) -> List[str]:
+    """Names of the platforms images are built for, as used in step keys and tags"""
+    return [platform["name"] for platform in build_platforms(config)]
+
+
+def platform_settings(platform: str, config: Dict[str, Any]) -> Dict[str, Any]:
+    """Settings of a platform by name"""
+    for settings in build_platforms(config):
+        if settings["name"] == platform:
+            return settings
+    return {"name": platform, "platform": None, "queue": BUILD_PLATFORMS.get(platform), "resource-class": None, "build-args": []}
+
+
+def sanitise_step_key(key: str) -> str:
+    """Step keys only accept alphanumeric characters, underscores, dashes and colons"""
+    return "".join([c for c in key if c.isalnum() or c in ["_", "-", ":"]])
+
+
+def sanitise_image_tag(tag: str) -> str:
+    """Image tags only accept alphanumeric characters, underscores, periods and dashes"""
+    # Replace slashes with dashes to keep hierarchy
+    tag = tag.replace("/", "-")
+    return "".join([c for c in tag if c.isalnum() or c in ["_", "-", "."]])
+
+
+def image_size_checked(config: Dict[str, Any]) -> bool:
+    """Whether an image's size is checked, setting any budget turns the check on"""
+    return config["image-size-check"] or any(config[budget] for budget in IMAGE_SIZE_BUDGETS)
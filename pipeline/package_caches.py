@@ -0,0 +1,52 @@
+"""Package manager caches restored into the build context with the cache plugin"""
+import json
+
+from typing import List, Dict, Any
+
+CACHE_PLUGIN: str = "cache#v1.3.0"
+
+# Built-in package caches: the manifest files whose contents key the cache, and the directory restored into the
+# build context. A Dockerfile mounts the directory from the `<name>-cache` build context.
+PACKAGE_CACHES: Dict[str, Dict[str, Any]] = {
+    "composer": {"manifest": ["composer.lock"], "path": ".composer-cache"},
+    "npm": {"manifest": ["package-lock.json"], "path": ".npm-cache"},
+    "yarn": {"manifest": ["yarn.lock"], "path": ".yarn-cache"},
+    "pip": {"manifest": ["requirements.txt"], "path": ".pip-cache"},
+    "go": {"manifest": ["go.sum"], "path": ".go-cache"},
+    "maven": {"manifest": ["pom.xml"], "path": ".maven-cache"},
+    "gradle": {"manifest": ["build.gradle", "settings.gradle"], "path": ".gradle-cache"},
+    "cargo": {"manifest": ["Cargo.lock"], "path": ".cargo-cache"},
+}
+
+
+def process_package_caches(value: Any) -> List[Dict[str, Any]]:
+    """Package caches named by a built-in or given in full, with built-in settings filled in"""
+    entries = value.split(",") if isinstance(value, str) else value
+    caches: List[Dict[str, Any]] = []
+    for entry in entries:
+        if isinstance(entry, str):
+            if entry not in PACKAGE_CACHES:
+                raise ValueError(f'Unknown package cache {entry}, expected one of {", ".join(PACKAGE_CACHES)} or a cache definition')
+            entry = {"name": entry}
+        # A definition named after a built-in overrides its settings
+        cache = {**PACKAGE_CACHES.get(entry.get("name", ""), {}), **entry}
+        missing = [option for option in ["name", "manifest", "path"] if not cache.get(option)]
+        if missing:
+            raise ValueError(f'Package cache {json.dumps(entry)} is missing {", ".join(missing)}')
+        if isinstance(cache["manifest"], str):
+            cache["manifest"] = [cache["manifest"]]
+        caches.append(cache)
+    return caches
+
+
+def package_caches(config: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Package caches a build restores, from `package-caches` and the older per-ecosystem booleans"""
+    caches: List[Dict[str, Any]] = [
+        {"name": name, **PACKAGE_CACHES[name]}
+        for name in ["composer", "npm", "yarn"]
+        if config[f"{name}-cache"]
+    ]
+    for cache in config["package-caches"]:
+        caches = [existing for existing in caches if existing["name"] != cache["name"]]
+        caches.append(cache)
+    return caches
@@ -1,168 +1,492 @@
 """A Buildkite plugin to build and push container images to ECR"""
 import json
 import os
-import time
+import subprocess
+import sys
+
+from typing import List, Dict, Any, Mapping, Optional, TextIO, Tuple
+
+try:
+    import yaml
+except ImportError:
+    # PyYAML is only required for the `yaml` output format, JSON output needs nothing outside the standard library
+    yaml = None
+
+from build_context import context_sizes, fingerprint, largest_paths, read_dockerignore, unused_paths
+from builders import add_affinity_fallbacks, add_builder_affinity, builder_command, resolve_builder_affinity
+from dockerfile import base_images, consumes_arg, context_sources, declared_args, parse as parse_dockerfile
+from ecr import ecr_registry_client
+from image_size import format_size
+from interpolate import interpolate
+from manifest_steps import create_image_size_step, create_shared_manifest_step, rewrites_size_baseline
+from options import build_platforms, IMAGE_SIZE_BUDGETS, image_size_checked, platform_names, platform_settings, process_config, sanitise_image_tag, sanitise_step_key, secret_sources
+from package_caches import CACHE_PLUGIN, package_caches
+from registry import RegistryClient, RegistryError
+from scan_steps import create_scan_step, scan_commands
+from steps import finish_platform_step, fingerprint_tag, gzip_variant, image_meta_data_key, step_agents, timed
+
+OUTPUT_FORMATS: List[str] = ["json", "yaml"]
+
+ARCHIVED_PIPELINE_FILE = "build_pipeline.yaml"
+
+# Build args whose values change between otherwise identical builds, these are left out of build fingerprints
+VOLATILE_BUILD_ARGS: List[str] = [
+    "GITHUB_TOKEN",
+    "BUILDKITE_COMMIT",
+    "BUILDKITE_JOB_ID",
+    "BUILD_DATE",
+]
+
+
+def build_fingerprint(
+    config: Dict[str, Any], environ: Optional[Mapping[str, str]] = None
+) -> str:
+    """Hash the inputs of an image build: the Dockerfile, the context after .dockerignore, non-volatile build args and platforms"""
+    if environ is None:
+        environ = os.environ
+
+    secret_ids = [secret_id for secret_id, _ in secret_sources(config)]
+    extra: List[str] = []
+    for build_arg in config["build-args"]:
+        name, has_value, value = build_arg.partition("=")
+        if name in VOLATILE_BUILD_ARGS or name in secret_ids:
+            continue
+        # Build args without a value are passed through from the environment of the build step
+        extra.append(f"build-arg:{name}={value if has_value else environ.get(name, '')}")
+
+    if config["compression"] != "gzip" or config["compression-level"] or config["force-compression"]:
+        extra.append(f'compression:{config["compression"]}:{config["compression-level"]}:{config["force-compression"]}')
+
+    for platform in build_platforms(config):
+        extra.append(f'platform:{platform["name"]}')
+        if platform["platform"]:
+            extra.append(f'oci-platform:{platform["name"]}={platform["platform"]}')
+            extra.extend(f'build-arg:{platform["name"]}:{build_arg}' for build_arg in platform["build-args"])
+
+    return fingerprint(config["dockerfile-path"], config["context-path"], extra)
+
+
+def resolve_unchanged_build(
+    config: Dict[str, Any],
+    client: Optional[RegistryClient] = None,
+    environ: Optional[Mapping[str, str]] = None,
+) -> None:
+    """Fingerprint the build and, if an image with that fingerprint has already been pushed, reuse it instead of rebuilding"""
+    try:
+        config["fingerprint"] = build_fingerprint(config, environ)
+    except OSError as error:
+        print(f"Unable to fingerprint the build, building as normal: {error}", file=sys.stderr)
+        return
+
+    tag = fingerprint_tag(config)
+    repository = config["fully-qualified-image-name"].split("/", 1)[1]
+    try:
+        with client or ecr_registry_client() as registry:
+            exists = registry.manifest_exists(repository, tag)
+    except (OSError, subprocess.CalledProcessError, RegistryError) as error:
+        print(f"Unable to look up {tag}, building as normal: {error}", file=sys.stderr)
+        return
+
+    if exists:
+        print(f"Found an existing image for {tag}, skipping the build", file=sys.stderr)
+        config["prebuilt-images"] = [f'{config["fully-qualified-image-name"]}:{tag}']
+
+
+def commit_platform_images(config: Dict[str, Any]) -> List[str]:
+    """The per-platform images a build of the current commit with the default image-tag pushes"""
+    commit_tag = sanitise_image_tag(config["current-commit"][0:10])
+    return [
+        f'{config["fully-qualified-image-name"]}:multi-platform-{commit_tag}-{platform}'
+        for platform in platform_names(config)
+    ]
 
-from typing import List, Dict, Any
 
-import yaml
+def resolve_promotion(config: Dict[str, Any], client: Optional[RegistryClient] = None) -> None:
+    """On a tag build, reuse the images an earlier build of the same commit pushed for every platform instead of rebuilding"""
+    images = commit_platform_images(config)
+    repository = config["fully-qualified-image-name"].split("/", 1)[1]
+    try:
+        with client or ecr_registry_client() as registry:
+            missing = [image for image in images if not registry.manifest_exists(repository, image.rsplit(":", 1)[1])]
+    except (OSError, subprocess.CalledProcessError, RegistryError) as error:
+        print(f"Unable to look up images of {config['current-commit']}, building as normal: {error}", file=sys.stderr)
+        return
 
-# renovate: datasource=github-releases depName=moby/buildkit
-BUILDKIT_VERSION: str = os.environ.get("BUILD_AND_PUSH_BUILDKIT_VERSION", "v0.12.3")
+    if missing:
+        print(f'No existing image for {", ".join(missing)}, building as normal', file=sys.stderr)
+        return
 
-ECR_ACCOUNT: str = "362995399210"
-ECR_REGION: str = "ap-southeast-2"
-CURRENT_BRANCH: str = os.environ.get("BUILDKITE_BRANCH", "")
-CURRENT_TAG: str = os.environ.get("BUILDKITE_TAG", "")
+    print(f"Found existing images of {config['current-commit']}, promoting them instead of building", file=sys.stderr)
+    config["prebuilt-images"] = images
 
-PLUGIN_NAME: str = "build-and-push"
 
-BUILD_PLATFORMS: Dict[str, str] = {
-    # platform => buildkite agent name
-    "arm": "docker-arm",
-    "x86": "docker",
-}
+def analyse_build_context(config: Dict[str, Any]) -> Dict[str, Any]:
+    """Measure the context sent to the builder after .dockerignore, and find top level entries the Dockerfile never reads"""
+    sizes = context_sizes(
+        config["context-path"], read_dockerignore(config["dockerfile-path"], config["context-path"])
+    )
+    with open(config["dockerfile-path"], encoding="utf8") as file:
+        sources = context_sources(parse_dockerfile(file.read()))
+
+    return {
+        "size": sum(size for _, size in sizes),
+        "files": len(sizes),
+        "largest": largest_paths(sizes),
+        "unused": unused_paths(sizes, sources),
+    }
 
-BLOCK_ON_CONTAINER_SCAN = (
-    os.environ.get("BLOCK_BUILD_AND_PUSH_ON_SCAN", "false").lower() == "true"
-)
 
-UNIX_BUILD_TIME = int(time.time())
+def context_annotation(report: Dict[str, Any], config: Dict[str, Any]) -> str:
+    """Markdown summarising a build context analysis"""
+    budget = config["context-size-budget"] * 1024 * 1024
+    summary = f'**Build context for {config["image-name"]}**: {format_size(report["size"])} in {report["files"]} files'
+    if budget:
+        summary += f" (budget {format_size(budget)})"
 
+    lines = [summary, "", "| Path | Size |", "| --- | --- |"]
+    lines.extend(f"| `{path}` | {format_size(size)} |" for path, size in report["largest"])
+
+    if report["unused"]:
+        lines.extend(
+            [
+                "",
+                f'Not read by any `COPY`, `ADD` or bind mount in `{config["dockerfile-path"]}`, consider adding to `.dockerignore`:',
+                "",
+                "```",
+                *[f"/{entry.rstrip('/')}" for entry, _ in report["unused"]],
+                "```",
+            ]
+        )
+    return "\n".join(lines)
 
-def process_config() -> Dict[str, Any]:
-    """Process buildkite plugin environment variables into a config dict"""
-    config_definition: Dict[str, Any] = {
-        "dockerfile-path": {
-            "type": "string",
-            "default": "Dockerfile",
-        },
-        "context-path": {
-            "type": "string",
-            "default": ".",
-        },
-        "image-name": {
-            "type": "string",
-            "default": os.environ["BUILDKITE_PIPELINE_NAME"],
-        },
-        "image-tag": {
-            "type": "string",
-            "default": os.environ["BUILDKITE_COMMIT"][0:10],
-        },
-        "additional-tag": {
-            "type": "string",
-            "default": None,
-        },
-        "build-args": {
-            "type": "list",
-            "default": [],
-        },
-        "build-arm": {
-            "type": "bool",
-            "default": True,
-        },
-        "build-x86": {
-            "type": "bool",
-            "default": True,
-        },
-        "scan-image": {
-            "type": "bool",
-            "default": True,
-        },
-        "group-key": {
-            "type": "string",
-            "default": "build-and-push",
-        },
-        "always-pull": {
-            "type": "bool",
-            "default": True,
-        },
-        "composer-cache": {
-            "type": "bool",
-            "default": False,
-        },
-        "npm-cache": {
-            "type": "bool",
-            "default": False,
-        },
-        "yarn-cache": {
-            "type": "bool",
-            "default": False,
-        },
-        "push-branches": {
-            "type": "list",
-            "default": [],
-        },
-        "repository-namespace": {
-            "type": "string",
-            "default": "catch",
-        },
-        "mutate-image-tag": {
-            "type": "bool",
-            "default": False,
-        },
-        "additional-plugins": {
-            "type": "json",
-            "default": [],
-        },
-    }
 
-    def process_bool(value: str) -> bool:
-        return value.lower() == "true"
+def check_build_context(config: Dict[str, Any]) -> bool:
+    """Annotate the build with an analysis of an image's build context, returning False if the build should fail"""
+    try:
+        report = analyse_build_context(config)
+    except OSError as error:
+        print(f"Unable to analyse the build context: {error}", file=sys.stderr)
+        return True
 
-    def process_list(value: str) -> List[str]:
-        return value.split(",")
+    budget = config["context-size-budget"] * 1024 * 1024
+    over_budget = bool(budget) and report["size"] > budget
+    style = "info"
+    if over_budget:
+        style = "error" if config["context-budget-action"] == "fail" else "warning"
+
+    subprocess.run(
+        [
+            "buildkite-agent", "annotate",
+            "--style", style,
+            "--context", f'{config["group-key"]}-context-{sanitise_step_key(config["image-name"])}',
+        ],
+        input=context_annotation(report, config),
+        text=True,
+        check=False,
+    )
+    return not (over_budget and config["context-budget-action"] == "fail")
+
+
+def context_commit_time(config: Dict[str, Any]) -> str:
+    """Unix time of the last commit that changed the Dockerfile or build context, stable across commits that don't touch them"""
+    paths = [os.path.abspath(config["dockerfile-path"]), os.path.abspath(config["context-path"])]
+    return subprocess.run(
+        ["git", "log", "-1", "--format=%ct", "--", *paths],
+        check=True,
+        capture_output=True,
+        text=True,
+        cwd=os.path.dirname(paths[0]),
+    ).stdout.strip()
+
+
+def resolve_build_args(config: Dict[str, Any]) -> None:
+    """Read the ARGs the Dockerfile declares and the reproducible build date, and annotate args that still invalidate the cache"""
+    try:
+        with open(config["dockerfile-path"], encoding="utf8") as file:
+            declarations = declared_args(parse_dockerfile(file.read()))
+    except OSError as error:
+        print(f"Unable to read the Dockerfile, passing every build arg: {error}", file=sys.stderr)
+        return
+
+    if config["build-args-filter"]:
+        config["dockerfile-args"] = sorted({declaration.name for declaration in declarations})
+
+    if config["reproducible-build-date"]:
+        try:
+            config["source-date-epoch"] = context_commit_time(config) or None
+        except (OSError, subprocess.CalledProcessError) as error:
+            print(f"Unable to find the commit time of the build context, using the build time: {error}", file=sys.stderr)
+
+    # Without the compatibility mode secrets no longer reach ARGs, Dockerfiles still declaring them need migrating
+    secret_ids = [] if config["secrets-as-build-args"] else [secret_id for secret_id, _ in secret_sources(config)]
+    secret_args = [declaration for declaration in declarations if declaration.name in secret_ids]
+    volatile = [
+        declaration
+        for declaration in declarations
+        if declaration.stage is not None
+        and declaration.name in VOLATILE_BUILD_ARGS
+        and declaration.name not in secret_ids
+        and not (declaration.name == "BUILD_DATE" and config["source-date-epoch"])
+    ]
+    if not volatile and not secret_args:
+        return
+
+    lines: List[str] = []
+    if volatile:
+        lines.extend([
+            f'**Build args that invalidate the layer cache of {config["image-name"]} on every build**',
+            "",
+            *[
+                f'- `ARG {declaration.name}` in stage `{declaration.stage}` (`{config["dockerfile-path"]}:{declaration.line}`) invalidates the {declaration.following} instruction(s) after it'
+                for declaration in volatile
+            ],
+            "",
+        ])
+    if secret_args:
+        lines.extend([
+            f'**Secrets {config["image-name"]} declares as build args**',
+            "",
+            "These are passed as `--secret` mounts and no longer set the ARG. Read them with `RUN --mount=type=secret,id=<id>`, or set `secrets-as-build-args: true` until the Dockerfile is migrated.",
+            "",
+            *[
+                f'- `ARG {declaration.name}` (`{config["dockerfile-path"]}:{declaration.line}`)'
+                for declaration in secret_args
+            ],
+        ])
+    subprocess.run(
+        [
+            "buildkite-agent", "annotate",
+            "--style", "warning",
+            "--context", f'{config["group-key"]}-build-args-{sanitise_step_key(config["image-name"])}',
+        ],
+        input="\n".join(lines).rstrip(),
+        text=True,
+        check=False,
+    )
 
-    if "BUILDKITE_PLUGIN_CONFIGURATION" not in os.environ:
-        print("BUILDKITE_PLUGIN_CONFIGURATION environment variable not set, assuming no plugin configuration has been provided")
 
-    config = json.loads(os.environ.get("BUILDKITE_PLUGIN_CONFIGURATION", "{}"))
+def image_repository(reference: str) -> str:
+    """An image reference without its tag or digest"""
+    name = reference.split("@", 1)[0]
+    if ":" in name.rsplit("/", 1)[-1]:
+        name = name.rsplit(":", 1)[0]
+    return name
 
-    for name, value in config_definition.items():
-        if name not in config:
-            config[name] = value.get("default", None)
+
+def build_levels(images: List[Dict[str, Any]]) -> List[List[Dict[str, Any]]]:
+    """Group images so each is built after the images it is built FROM, bases of images that aren't listed are ignored"""
+    remaining = {image["image-key"]: image for image in images}
+    levels: List[List[Dict[str, Any]]] = []
+    while remaining:
+        level = [
+            image
+            for image in remaining.values()
+            if not any(base in remaining for base in image["base-images"].values())
+        ]
+        if not level:
+            raise ValueError(f'Images {", ".join(sorted(remaining))} are built FROM each other')
+        levels.append(level)
+        for image in level:
+            del remaining[image["image-key"]]
+    return levels
+
+
+def resolve_base_images(config: Dict[str, Any], environ: Optional[Mapping[str, str]] = None) -> None:
+    """Find the images built FROM another of the images, so they are built after it on the freshly pushed image"""
+    if environ is None:
+        environ = os.environ
+
+    images_by_name = {image["fully-qualified-image-name"]: image for image in config["images"]}
+    for image in config["images"]:
+        try:
+            with open(image["dockerfile-path"], encoding="utf8") as file:
+                instructions = parse_dockerfile(file.read())
+        except OSError as error:
+            print(f'Unable to read the Dockerfile of {image["image-name"]}, building it alongside the other images: {error}', file=sys.stderr)
             continue
 
-        if value["type"] == "bool" and isinstance(config[name], str):
-            config[name] = process_bool(config[name])
-        elif value["type"] == "list" and isinstance(config[name], str):
-            config[name] = process_list(config[name])
+        build_args: Dict[str, str] = {}
+        for build_arg in image["build-args"]:
+            name, has_value, value = build_arg.partition("=")
+            build_args[name] = value if has_value else environ.get(name, "")
 
-    config["build-args"].append("GITHUB_TOKEN")
-    config["build-args"].append("BUILDKITE_COMMIT")
-    config["build-args"].append("BUILDKITE_JOB_ID")
-    config["build-args"].append(f"BUILD_DATE={UNIX_BUILD_TIME}")
+        for reference in base_images(instructions, build_args):
+            base = images_by_name.get(image_repository(reference))
+            if base is not None and base is not image:
+                image["base-images"][reference] = base["image-key"]
 
-    config["group-key"] = sanitise_step_key(config["group-key"])
+    try:
+        build_levels(config["images"])
+    except ValueError as error:
+        print(f"{error}, building them alongside each other", file=sys.stderr)
+        for image in config["images"]:
+            image["base-images"] = {}
 
-    ecr_repository_namespace_joiner = (
-        f'{config["repository-namespace"]}/' if config["repository-namespace"] else ""
-    )
 
-    config[
-        "fully-qualified-image-name"
-    ] = f'{ECR_ACCOUNT}.dkr.ecr.{ECR_REGION}.amazonaws.com/{ecr_repository_namespace_joiner}{config["image-name"]}'
+def base_image_ref(base: Dict[str, Any], platform: str) -> str:
+    """The image a build for a platform uses in place of its base, the base's platform image or the image it reuses"""
+    for image in base["prebuilt-images"]:
+        if len(base["prebuilt-images"]) == 1 or image.endswith(f"-{platform}"):
+            return image
+    return f'{base["fully-qualified-image-name"]}:multi-platform-{sanitise_image_tag(base["image-tag"])}-{platform}'
 
-    config["push-to-ecr"] = (
-        not config["push-branches"]
-        or CURRENT_BRANCH in config["push-branches"]
-        or CURRENT_BRANCH == CURRENT_TAG
-    )
 
-    return config
+def build_args_for(platform: str, config: Dict[str, Any]) -> List[str]:
+    """The build args passed to a platform's build, leaving out any the Dockerfile doesn't declare"""
+    build_args = [*config["build-args"], *platform_settings(platform, config)["build-args"]]
+
+    if config["source-date-epoch"]:
+        build_args = [
+            f'BUILD_DATE={config["source-date-epoch"]}' if build_arg.startswith("BUILD_DATE=") else build_arg
+            for build_arg in build_args
+        ]
+        build_args.append(f'SOURCE_DATE_EPOCH={config["source-date-epoch"]}')
+
+    if config["dockerfile-args"] is not None:
+        build_args = [
+            build_arg
+            for build_arg in build_args
+            if consumes_arg(build_arg.split("=", 1)[0], config["dockerfile-args"])
+        ]
+
+    return build_args
+
+
+def ancestor_commits(count: int, path: str = ".") -> List[str]:
+    """The closest first-parent ancestors of the checked out commit, nearest first"""
+    return subprocess.run(
+        ["git", "rev-list", "--first-parent", f"--max-count={count}", "--skip=1", "HEAD"],
+        check=True,
+        capture_output=True,
+        text=True,
+        cwd=path,
+    ).stdout.split()
+
+
+def commit_cache_tags(commit: str, config: Dict[str, Any]) -> List[str]:
+    """The tags cache for a commit is exported under, one per built platform when exporting to the registry"""
+    if config["cache-export"] == "registry":
+        return [
+            cache_ref(commit, platform, config).rsplit(":", 1)[1]
+            for platform in platform_names(config)
+        ]
+    return [f"cache_{commit}"]
+
+
+def resolve_cache_ancestor(
+    config: Dict[str, Any],
+    client: Optional[RegistryClient] = None,
+    commits: Optional[List[str]] = None,
+) -> None:
+    """Find the nearest ancestor commit that exported cache, so the first build of a branch isn't cold"""
+    try:
+        if commits is None:
+            commits = ancestor_commits(config["cache-from-ancestors"])
+        repository = config["fully-qualified-image-name"].split("/", 1)[1]
+        with client or ecr_registry_client() as registry:
+            for commit in commits:
+                if all(
+                    registry.manifest_exists(repository, tag)
+                    for tag in commit_cache_tags(commit, config)
+                ):
+                    config["cache-ancestor"] = commit
+                    return
+    except (OSError, subprocess.CalledProcessError, RegistryError) as error:
+        print(f"Unable to look up cache from ancestor commits: {error}", file=sys.stderr)
+
+
+def cache_ref(tag: str, platform: str, config: Dict[str, Any]) -> str:
+    """The reference build cache for a tag is imported from, and exported to when exporting to the registry"""
+    if config["cache-export"] == "registry":
+        # Cache manifests are per platform, an index of them can't be used as a cache source
+        return f'{config["fully-qualified-image-name"]}:cache_{tag}-{platform}'
+    return f'{config["fully-qualified-image-name"]}:cache_{tag}'
+
+
+def cache_from_refs(platform: str, config: Dict[str, Any]) -> List[str]:
+    """References a build imports cache from, most likely to match first"""
+    candidates: List[str] = [
+        config["current-branch"],
+        config["pull-request-base-branch"],
+        config["cache-ancestor"] or "",
+        *config["cache-from-branches"],
+        # Only builds without a branch export cache under their image tag
+        config["image-tag"],
+    ]
+
+    cache_from_tags: List[str] = []
+    for candidate in candidates:
+        tag = sanitise_image_tag(candidate)
+        if tag and tag not in cache_from_tags:
+            cache_from_tags.append(tag)
+
+    return [cache_ref(tag, platform, config) for tag in cache_from_tags[0 : config["cache-from-limit"]]]
+
+
+def compression_stub(config: Dict[str, Any]) -> str:
+    """Image exporter attributes for the configured layer compression, empty for the builder's default of gzip"""
+    if config["compression"] == "gzip" and not config["compression-level"] and not config["force-compression"]:
+        return ""
+    stub = f',compression={config["compression"]}'
+    if config["compression"] != "gzip":
+        # zstd and estargz layers can only be described with OCI media types
+        stub += ",oci-mediatypes=true"
+    if config["compression-level"]:
+        stub += f',compression-level={config["compression-level"]}'
+    if config["force-compression"]:
+        # Recompress layers that already exist in another compression, such as those of the base image
+        stub += ",force-compression=true"
+    return stub
+
+
+def cache_to_stub(platform: str, config: Dict[str, Any]) -> str:
+    """The --cache-to argument for a build, if any"""
+    if config["cache-export"] == "inline":
+        return " --cache-to type=inline"
+
+    if config["cache-export"] == "registry":
+        tag = sanitise_image_tag(config["current-branch"] or config["image-tag"])
+        refs = [cache_ref(tag, platform, config)]
+        if config["cache-from-ancestors"]:
+            # Lets builds of descendant commits on other branches find this cache
+            refs.append(cache_ref(config["current-commit"], platform, config))
+        # ECR only accepts cache exported as an OCI image manifest
+        return "".join(
+            f' --cache-to type=registry,ref={ref},mode={config["cache-export-mode"]},image-manifest=true,oci-mediatypes=true'
+            for ref in refs
+        )
+
+    return ""
+
 
+def push_output(platform: str, platform_image: str, config: Dict[str, Any]) -> Tuple[str, List[str]]:
+    """The output arguments of a platform's build for the push-mode, and the commands that push and record the image after it"""
+    # The pushed image's digest is only recorded for the scan step to pull
+    if config["push-to-ecr"] and config["push-mode"] == "direct":
+        metadata_file = f"build-metadata-{platform}.json"
+        output_stub = f"--output type=image,push=true{compression_stub(config)} --metadata-file {metadata_file}"
+        if not config["scan-image"]:
+            return output_stub, []
+        return output_stub, [
+            f"IMAGE_DIGEST=$$(grep -o '\"containerimage.digest\": *\"sha256:[0-9a-f]*\"' {metadata_file} | grep -o 'sha256:[0-9a-f]*')",
+            timed("meta-data", f'buildkite-agent meta-data set {image_meta_data_key(platform, config)} {config["fully-qualified-image-name"]}@$$IMAGE_DIGEST', config),
+        ]
+    if config["push-to-ecr"]:
+        push_steps = [timed("push", f"docker image push {platform_image}", config)]
+        if config["scan-image"]:
+            push_steps.append(
+                timed("meta-data", f"buildkite-agent meta-data set {image_meta_data_key(platform, config)} $$(docker image inspect --format '{{{{index .RepoDigests 0}}}}' {platform_image})", config)
+            )
+        return "--load", push_steps
 
-def sanitise_step_key(key: str) -> str:
-    """Step keys only accept alphanumeric characters, underscores, dashes and colons"""
-    return "".join([c for c in key if c.isalnum() or c in ["_", "-", ":"]])
+    push_steps = ['echo "Not pushing to ECR as branch not listed in push-branches"']
+    if config["push-mode"] == "direct" and not config["scan-image"]:
+        # Nothing needs the image, the build only validates it and exports cache
+        return "--output type=cacheonly", push_steps
+    return "--load", push_steps
 
-def sanitise_image_tag(tag: str) -> str:
-    """Image tags only accept alphanumeric characters, underscores, periods and dashes"""
-    # Replace slashes with dashes to keep hierarchy
-    tag = tag.replace("/", "-")
-    return "".join([c for c in tag if c.isalnum() or c in ["_", "-", "."]])
 
-# pylint: disable=too-many-locals,too-many-branches
+# pylint: disable-next=too-many-locals,too-many-branches
 def create_build_step(
     platform: str, agent: str, config: Dict[str, Any]
 ) -> Dict[str, Any]:
@@ -171,61 +495,53 @@ def create_build_step(
 
     platform_image: str = f'{config["fully-qualified-image-name"]}:multi-platform-{image_tag}-{platform}'
 
-    cache_from_tags: List[str] = sorted(
-        set(
-            [
-                image_tag,
-                sanitise_image_tag(CURRENT_BRANCH),
-                "master",
-                "main",
-            ]
-        )
-    )
     cache_from_images_stub: str = "".join(
-        [
-            f' --cache-from type=registry,ref={config["fully-qualified-image-name"]}:cache_{tag}'
-            for tag in cache_from_tags
-        ]
+        [f" --cache-from type=registry,ref={ref}" for ref in cache_from_refs(platform, config)]
     )
 
+    settings = platform_settings(platform, config)
+
     build_args: str = ""
-    if config["build-args"]:
-        build_args = "--build-arg " + " --build-arg ".join(config["build-args"])
+    passed_build_args = build_args_for(platform, config)
+    if passed_build_args:
+        build_args = "--build-arg " + " --build-arg ".join(passed_build_args)
+
+    secret_stub: str = "".join(
+        f" --secret id={secret_id},env={env}" for secret_id, env in secret_sources(config)
+    )
 
     pull_stub: str = ""
     if config["always-pull"]:
         pull_stub = "--pull"
 
-    push_steps: List[str] = [
-        'echo "Not pushing to ECR as branch not listed in push-branches"'
-    ]
-    if config["push-to-ecr"]:
-        push_steps = [f"docker image push {platform_image}"]
+    platform_stub: str = ""
+    if settings["platform"]:
+        platform_stub = f' --platform {settings["platform"]}'
+
+    output_stub, push_steps = push_output(platform, platform_image, config)
 
-    composer_cache_stub: str = ""
-    if config["composer-cache"]:
-        composer_cache_stub = "--build-context composer-cache=.composer-cache"
+    caches = package_caches(config)
+    package_cache_stub: str = " ".join(
+        [
+            *[f'--build-context {cache["name"]}-cache={cache["path"]}' for cache in caches],
+            # Bases built by this pipeline replace the images their FROM references would pull
+            *[f"--build-context {reference}=docker-image://{image}" for reference, image in config["base-image-contexts"].items()],
+        ]
+    )
 
-    npm_cache_stub: str = ""
-    if config["npm-cache"]:
-        npm_cache_stub = "--build-context npm-cache=.npm-cache"
+    def build_command(output: str, tag: str, cache_to: str) -> str:
+        return f'docker buildx build {output} {pull_stub}{platform_stub} --ssh default{secret_stub} {cache_from_images_stub}{cache_to} {build_args} {package_cache_stub} --tag {tag} -f {config["dockerfile-path"]} {config["context-path"]}'
 
-    yarn_cache_stub: str = ""
-    if config["yarn-cache"]:
-        yarn_cache_stub = "--build-context yarn-cache=.yarn-cache"
+    if gzip_variant(config):
+        # Every layer is already in the builder's cache, so this only recompresses and pushes them
+        push_steps.append(
+            timed("push", build_command("--output type=image,push=true,compression=gzip,force-compression=true", f"{platform_image}-gzip", ""), config)
+        )
 
+    # Pushed images are scanned by their own steps, images that only exist in the local daemon have to be scanned here
     scan_steps: List[str] = []
-    if config["scan-image"]:
-        scan_steps = [
-            "wizcli auth --id $$WIZ_CLIENT_ID --secret $$WIZ_CLIENT_SECRET",
-            f'wizcli docker scan --image {platform_image} -p "Container Scanning" -p "Secret Scanning" --tag pipeline={os.environ["BUILDKITE_PIPELINE_NAME"]} --tag architecture={platform} --tag pipeline_run={os.environ["BUILDKITE_BUILD_NUMBER"]} > out 2>&1 | true; SCAN_STATUS=$${{PIPESTATUS[0]}}',
-            # pylint: disable=anomalous-backslash-in-string
-            f'if [[ ! $$SCAN_STATUS -eq 0 ]]; then echo -e "**Container scan report [{config["image-name"]}:{image_tag}] ({platform})**\n\n<details><summary></summary>\n\n\`\`\`term\n$(cat out**)\`\`\`\n\n</details>" | buildkite-agent annotate --style error --context {"".join(item for item in config["image-name"] if item.isalnum())}-{"".join(item for item in config["image-tag"] if item.isalnum())}-{platform}-security-scan; fi',
-        ]
-        if BLOCK_ON_CONTAINER_SCAN:
-            scan_steps.append(
-                "if [[ ! $$SCAN_STATUS -eq 0 ]]; then exit $$SCAN_STATUS; fi"
-            )
+    if config["scan-image"] and not config["push-to-ecr"]:
+        scan_steps = scan_commands(platform, platform_image, config)
 
     step_label = (
         f":docker: Build and push {platform} image"
@@ -236,14 +552,12 @@ def create_build_step(
         "label": step_label,
         "key": f'{config["group-key"]}-build-push-{platform}',
         "command": [
-            f"docker buildx use builder || docker buildx create --bootstrap --name builder --use --driver docker-container --driver-opt image=moby/buildkit:{BUILDKIT_VERSION}",
-            f'docker buildx build --load {pull_stub} --ssh default {cache_from_images_stub} {build_args} {composer_cache_stub} {npm_cache_stub} {yarn_cache_stub} --tag {platform_image} -f {config["dockerfile-path"]} {config["context-path"]}',
+            timed("builder", builder_command(platform, config), config, shared=True),
+            timed("build", build_command(output_stub, platform_image, cache_to_stub(platform, config)), config),
             *scan_steps,
             *push_steps,
         ],
-        "agents": {
-            "queue": agent,
-        },
+        "agents": step_agents(platform, agent, config),
         "env": {
             "DOCKER_BUILDKIT": "1",
         },
@@ -254,141 +568,247 @@ def create_build_step(
         ],
     }
 
-    if config["composer-cache"]:
-        step["command"].insert(0, "mkdir -p .composer-cache")
-        step["command"].insert(0, 'echo ".composer-cache" >> .dockerignore')
+    for cache in caches:
+        step["command"][0:0] = [
+            f'echo "{cache["path"]}" >> .dockerignore',
+            f'mkdir -p {cache["path"]}',
+        ]
         step["plugins"].append(
             {
-                "cache#v0.6.0": {
+                CACHE_PLUGIN: {
                     "backend": "s3",
-                    "manifest": "composer.lock",
-                    "path": ".composer-cache",
+                    # Several manifests are hashed together into one cache key
+                    "manifest": cache["manifest"][0] if len(cache["manifest"]) == 1 else cache["manifest"],
+                    "path": cache["path"],
                     "restore": "file",
                     "save": "pipeline",
                 },
             }
         )
 
-    if config["npm-cache"]:
-        step["command"].insert(0, "mkdir -p .npm-cache")
-        step["command"].insert(0, 'echo ".npm-cache" >> .dockerignore')
-        step["plugins"].append(
-            {
-                "cache#v0.6.0": {
-                    "backend": "s3",
-                    "manifest": "package-lock.json",
-                    "path": ".npm-cache",
-                    "restore": "file",
-                    "save": "pipeline",
-                },
-            }
+    return finish_platform_step(step, platform, config)
+
+
+def create_packed_build_step(
+    platform: str, agent: str, configs: List[Dict[str, Any]], key: str
+) -> Dict[str, Any]:
+    """Create a step stub building several images for a platform in one job, sharing its checkout and builder"""
+    image_steps = [create_build_step(platform, agent, config) for config in configs]
+    if len(image_steps) == 1:
+        return image_steps[0] | {"key": key}
+
+    builder = timed("builder", builder_command(platform, configs[0]), configs[0], shared=True)
+    setup: List[str] = []
+    builds: List[str] = []
+    plugins: List[Dict[str, Any]] = []
+    for image_step in image_steps:
+        # Package cache preparation runs before the builder is selected, the builds themselves after it
+        builder_index = image_step["command"].index(builder)
+        setup.extend(
+            command
+            for command in image_step["command"][:builder_index]
+            if command not in setup
         )
+        builds.extend(image_step["command"][builder_index + 1 :])
+        plugins.extend(plugin for plugin in image_step["plugins"] if plugin not in plugins)
+
+    names = ", ".join(config["image-name"] for config in configs)
+    return image_steps[0] | {
+        "label": image_steps[0]["label"].replace(" image", f" images ({names})"),
+        "key": key,
+        "command": [*setup, builder, *builds],
+        "plugins": plugins,
+    }
 
-    if config["yarn-cache"]:
-        step["command"].insert(0, "mkdir -p .yarn-cache")
-        step["command"].insert(0, 'echo ".yarn-cache" >> .dockerignore')
-        step["plugins"].append(
+
+def create_platform_jobs(
+    settings: Dict[str, Any], jobs: List[List[Dict[str, Any]]], images_by_key: Dict[str, Dict[str, Any]], config: Dict[str, Any]
+) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """The build step of each job on a platform, after the jobs building their base images, and the scan steps of their images"""
+    platform, agent = settings["name"], settings["queue"]
+    job_keys = [f'{config["group-key"]}-build-push-{platform}'] if len(jobs) == 1 else [
+        f'{config["group-key"]}-build-push-{platform}-{index + 1}' for index in range(len(jobs))
+    ]
+    job_indexes = {image["image-key"]: index for index, job in enumerate(jobs) for image in job}
+
+    build_steps: List[Dict[str, Any]] = []
+    scan_steps: List[Dict[str, Any]] = []
+    for key, job in zip(job_keys, jobs):
+        job = [
+            image | {
+                "base-image-contexts": {
+                    reference: base_image_ref(images_by_key[base], platform)
+                    for reference, base in image["base-images"].items()
+                }
+            }
+            for image in job
+        ]
+        build_step = create_packed_build_step(platform, agent, job, key)
+        base_keys = sorted({
+            job_keys[job_indexes[base]]
+            for image in job
+            for base in image["base-images"].values()
+            if base in job_indexes
+        })
+        if base_keys:
+            build_step["depends_on"] = base_keys
+        # Remote builders keep their cache themselves, whichever agent drives them
+        build_steps.append(build_step)
+        if config["builder-affinity-shards"] and not config["remote-builders"].get(platform):
+            build_steps.extend(add_builder_affinity(build_step, platform, config))
+
+        if config["scan-image"] and config["push-to-ecr"]:
+            scan_steps.extend(create_scan_step(platform, agent, image, key) for image in job)
+    return build_steps, scan_steps
+
+
+def generate(config: Dict[str, Any]) -> Dict[str, Any]:
+    """Generate a pipeline for building, pushing and scanning a multi-platform container image from a processed config"""
+    pipeline: Dict[str, Any] = {}
+    pipeline["steps"] = []
+    pipeline["steps"].append(
+        {
+            "group": ":docker: Build and push images",
+            "key": config["group-key"],
+            "steps": [],
+        }
+    )
+
+    images = config["images"] or [config]
+    images_by_key = {image["image-key"]: image for image in images}
+    images_to_build = [image for image in images if not image["prebuilt-images"]]
+    # Images built FROM another of the images go in later jobs than their base
+    jobs: List[List[Dict[str, Any]]] = []
+    for level in build_levels(images_to_build):
+        images_per_job = config["images-per-job"] or len(level)
+        jobs.extend(level[index : index + images_per_job] for index in range(0, len(level), images_per_job))
+
+    build_keys: List[str] = []
+    scan_steps: List[Dict[str, Any]] = []
+    for settings in build_platforms(config):
+        build_steps, platform_scan_steps = create_platform_jobs(settings, jobs, images_by_key, config)
+        pipeline["steps"][0]["steps"].extend(build_steps)
+        build_keys.extend(step["key"] for step in build_steps)
+        scan_steps.extend(platform_scan_steps)
+
+    # Step keys, or {step, allow_failure} for a step whose failure doesn't hold back tagging
+    dependencies: List[Any] = list(build_keys)
+    if config["scan-image"] and config["block-on-container-scan"]:
+        dependencies.extend(step["key"] for step in scan_steps)
+
+    checked_images = [image for image in images_to_build if image_size_checked(image)]
+    if config["push-to-ecr"] and config["plugin-ref"] and checked_images:
+        pipeline["steps"][0]["steps"].append(create_image_size_step(checked_images, build_keys))
+        if any(image[budget] for image in checked_images for budget in IMAGE_SIZE_BUDGETS):
+            # Images over budget aren't tagged
+            dependencies.append(f'{config["group-key"]}-image-size')
+        elif any(rewrites_size_baseline(image) for image in checked_images):
+            # The sizes are only reported, but the baseline must be read before the manifest step replaces it
+            dependencies.append({"step": f'{config["group-key"]}-image-size', "allow_failure": True})
+
+    if config["push-to-ecr"]:
+        pipeline["steps"][0]["steps"].append(create_shared_manifest_step(images, dependencies))
+
+    if scan_steps and config["block-on-container-scan"]:
+        # Anything depending on the group waits for the scans to pass
+        pipeline["steps"][0]["steps"].extend(scan_steps)
+    elif scan_steps:
+        # Kept out of the group so steps depending on it don't wait for scans that can't fail the build
+        pipeline["steps"].append(
             {
-                "cache#v0.6.0": {
-                    "backend": "s3",
-                    "manifest": "yarn.lock",
-                    "path": ".yarn-cache",
-                    "restore": "file",
-                    "save": "pipeline",
-                },
+                "group": ":mag: Scan images",
+                "key": f'{config["group-key"]}-scan',
+                "steps": scan_steps,
             }
         )
 
-    if len(config["additional-plugins"]) > 0:
-        for plugin in config["additional-plugins"]:
-            step["plugins"].append(plugin)
+    # Pinned build steps may be cancelled in favour of their fallback, which passes whichever of them built the images
+    add_affinity_fallbacks(pipeline["steps"], build_keys)
 
-    return step
+    return pipeline
 
 
-def create_oci_manifest_step(config: Dict[str, Any]) -> Dict[str, Any]:
-    """Create a step stub to create a container manifest and push it to ECR"""
-    image_tag = sanitise_image_tag(config["image-tag"])
+def write_pipeline(pipeline: Dict[str, Any], file: TextIO, output_format: str) -> None:
+    """Serialise a pipeline in a format accepted by `buildkite-agent pipeline upload`"""
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown output-format {output_format}, expected one of {', '.join(OUTPUT_FORMATS)}")
 
-    images: List[str] = [
-        f'{config["fully-qualified-image-name"]}:multi-platform-{image_tag}-{platform}'
-        for platform, _ in BUILD_PLATFORMS.items()
-        if config[f"build-{platform}"]
-    ]
-    dependencies: List[str] = [
-        f'{config["group-key"]}-build-push-{platform}'
-        for platform, _ in BUILD_PLATFORMS.items()
-        if config[f"build-{platform}"]
-    ]
+    if output_format == "yaml" and yaml is not None:
+        yaml.dump(pipeline, file, width=1000)
+        return
 
-    basic_actions = [
-        f'docker buildx imagetools create -t {config["fully-qualified-image-name"]}:{image_tag} {" ".join(images)}',
-    ]
-    if config["mutate-image-tag"]:
-        basic_actions.insert(
-            0,
-            f'aws ecr batch-delete-image --registry-id {ECR_ACCOUNT} --repository-name {config["repository-namespace"]}/{config["image-name"]} --image-ids imageTag={image_tag} || true',
-        )
+    if output_format == "yaml":
+        print("PyYAML is not installed, falling back to JSON output", file=sys.stderr)
 
-    step = {
-        "label": ":docker: Create container manifest",
-        "depends_on": dependencies,
-        "key": f'{config["group-key"]}-manifest',
-        "command": basic_actions,
-        "plugins": [],
-    }
+    # JSON is a subset of YAML so the result is still a valid pipeline.yaml
+    json.dump(pipeline, file, indent=2)
+    file.write("\n")
 
-    if config["additional-tag"]:
-        additional_tag = sanitise_image_tag(config["additional-tag"])
-        if config["mutate-image-tag"]:
-            step["command"].append(
-                f'aws ecr batch-delete-image --registry-id {ECR_ACCOUNT} --repository-name {config["repository-namespace"]}/{config["image-name"]} --image-ids imageTag={additional_tag} || true'
-            )
-        step["command"].append(
-            f'docker buildx imagetools create -t {config["fully-qualified-image-name"]}:{additional_tag} {" ".join(images)}'
-        )
 
-    if CURRENT_BRANCH != "":
-        branch_tag = sanitise_image_tag(CURRENT_BRANCH)
-        # Always remove the cache_branch tagged image so we can update it in immutable repositories as cache for the next build
-        step["command"].append(
-            f'aws ecr batch-delete-image --registry-id {ECR_ACCOUNT} --repository-name {config["repository-namespace"]}/{config["image-name"]} --image-ids imageTag=cache_{branch_tag} || true'
-        )
-        step["command"].append(
-            f'docker buildx imagetools create -t {config["fully-qualified-image-name"]}:cache_{branch_tag} {" ".join(images)}'
-        )
+def pipeline_output() -> TextIO:
+    """Reserve stdout for the pipeline, anything else printed by the plugin or the commands it runs goes to stderr"""
+    sys.stdout.flush()
+    output = os.fdopen(os.dup(sys.stdout.fileno()), "w", encoding="utf8")
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    return output
+
 
-    if len(config["additional-plugins"]) > 0:
-        for plugin in config["additional-plugins"]:
-            step["plugins"].append(plugin)
+def resolve_images(config: Dict[str, Any]) -> None:
+    """Fill in everything the enabled options need to look up in ECR or the repository before generating the pipeline"""
+    if config["promote-tag-builds"] and config["current-tag"] and config["push-to-ecr"]:
+        for image in config["images"] or [config]:
+            resolve_promotion(image)
+
+    if config["images"] and config["order-base-images"] and config["push-to-ecr"]:
+        resolve_base_images(config)
+
+    if config["skip-unchanged-builds"] and config["push-to-ecr"]:
+        images = config["images"] or [config]
+        images_by_key = {image["image-key"]: image for image in images}
+        for image in [image for level in build_levels(images) for image in level]:
+            # An image is only as unchanged as the images it's built FROM
+            if image["prebuilt-images"] or any(not images_by_key[base]["prebuilt-images"] for base in image["base-images"].values()):
+                continue
+            resolve_unchanged_build(image)
+
+    if config["cache-from-ancestors"] > 0:
+        for image in config["images"] or [config]:
+            resolve_cache_ancestor(image)
+
+    if config["build-args-filter"] or config["reproducible-build-date"]:
+        for image in config["images"] or [config]:
+            resolve_build_args(image)
+
+    if config["builder-affinity-shards"]:
+        resolve_builder_affinity(config)
 
-    return step
 
 def main():
-    """Generate and output to stdout a pipeline for building, pushing and scanning a multi-platform container image."""
+    """Generate and output a pipeline for building, pushing and scanning a multi-platform container image."""
     config = process_config()
+    output = pipeline_output() if config["upload-mode"] == "stream" else None
 
-    pipeline = {}
-    pipeline["steps"] = []
-    pipeline["steps"].append(
-        {
-            "group": ":docker: Build and push images",
-            "key": config["group-key"],
-            "steps": [],
-        }
-    )
+    if config["context-analysis"] or config["context-size-budget"]:
+        over_budget = [image["image-name"] for image in config["images"] or [config] if not check_build_context(image)]
+        if over_budget:
+            sys.exit(f'Build context over {config["context-size-budget"]} MB for {", ".join(over_budget)}')
 
-    for platform, agent in BUILD_PLATFORMS.items():
-        if config[f"build-{platform}"]:
-            pipeline["steps"][0]["steps"].append(
-                create_build_step(platform, agent, config)
-            )
+    resolve_images(config)
 
-    if config["push-to-ecr"]:
-        pipeline["steps"][0]["steps"].append(create_oci_manifest_step(config))
+    pipeline = generate(config)
 
-    with open("pipeline.yaml", "w", encoding="utf8") as file:
-        yaml.dump(pipeline, file, width=1000)
+    if output is None:
+        with open("pipeline.yaml", "w", encoding="utf8") as file:
+            write_pipeline(pipeline, file, config["output-format"])
+        return
+
+    # What `pipeline upload --dry-run` would have produced, so it is uploaded with --no-interpolation
+    pipeline = interpolate(pipeline, os.environ)
+    if config["archive-pipeline"]:
+        with open(ARCHIVED_PIPELINE_FILE, "w", encoding="utf8") as file:
+            write_pipeline(pipeline, file, config["output-format"])
+    with output:
+        write_pipeline(pipeline, output, config["output-format"])
 
 
 if __name__ == "__main__":
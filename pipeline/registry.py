@@ -0,0 +1,240 @@
+"""A minimal client for the OCI distribution (docker registry v2) API"""
+import base64
+import hashlib
+import http.client
+import json
+import re
+import urllib.parse
+import urllib.request
+
+from typing import Any, Dict, List, Optional, Tuple
+
+MANIFEST_MEDIA_TYPES = [
+    "application/vnd.oci.image.index.v1+json",
+    "application/vnd.oci.image.manifest.v1+json",
+    "application/vnd.docker.distribution.manifest.list.v2+json",
+    "application/vnd.docker.distribution.manifest.v2+json",
+]
+OCI_INDEX = "application/vnd.oci.image.index.v1+json"
+DOCKER_MANIFEST_LIST = "application/vnd.docker.distribution.manifest.list.v2+json"
+DOCKER_MANIFEST = "application/vnd.docker.distribution.manifest.v2+json"
+INDEX_MEDIA_TYPES = [OCI_INDEX, DOCKER_MANIFEST_LIST]
+
+
+def content_digest(content: bytes) -> str:
+    """Digest of manifest or blob content in the form registries use"""
+    return f"sha256:{hashlib.sha256(content).hexdigest()}"
+
+
+class RegistryError(Exception):
+    """Raised when a registry responds with an unexpected status"""
+
+    def __init__(self, method: str, path: str, status: int, body: bytes):
+        super().__init__(f"{method} {path} returned {status}: {body[:200]!r}")
+        self.status = status
+
+
+class RegistryClient:
+    """Talks to a single registry host, reusing one connection and one authorisation across requests"""
+
+    def __init__(
+        self,
+        host: str,
+        username: Optional[str] = None,
+        password: Optional[str] = None,
+        secure: bool = True,
+    ):
+        self.host = host
+        self.username = username
+        self.password = password
+        self.secure = secure
+        self._connection: Optional[http.client.HTTPConnection] = None
+        self._authorization: Optional[str] = None
+
+    def close(self) -> None:
+        """Close the underlying connection"""
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def __enter__(self) -> "RegistryClient":
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()
+
+    def _connect(self) -> http.client.HTTPConnection:
+        if self._connection is None:
+            connection_class = (
+                http.client.HTTPSConnection if self.secure else http.client.HTTPConnection
+            )
+            self._connection = connection_class(self.host, timeout=30)
+        return self._connection
+
+    def _send(
+        self, method: str, path: str, body: Optional[bytes], headers: Dict[str, str]
+    ) -> Tuple[int, Dict[str, str], bytes]:
+        if self._authorization:
+            headers = {**headers, "Authorization": self._authorization}
+
+        # A kept-alive connection may have been closed by the server since the last request, retry once on a fresh one
+        for attempt in range(2):
+            connection = self._connect()
+            try:
+                connection.request(method, path, body=body, headers=headers)
+                response = connection.getresponse()
+                data = response.read()
+                return (
+                    response.status,
+                    {key.lower(): value for key, value in response.getheaders()},
+                    data,
+                )
+            except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+                self.close()
+                if attempt == 1:
+                    raise
+        raise AssertionError("unreachable")
+
+    def _authenticate(self, challenge: str) -> None:
+        """Answer a WWW-Authenticate challenge with either basic credentials or a bearer token"""
+        scheme, _, params = challenge.partition(" ")
+        basic = None
+        if self.username is not None:
+            basic = base64.b64encode(
+                f"{self.username}:{self.password or ''}".encode()
+            ).decode()
+
+        if scheme.lower() == "basic":
+            if basic is None:
+                raise RegistryError("AUTH", challenge, 401, b"no credentials configured")
+            self._authorization = f"Basic {basic}"
+            return
+
+        options = dict(re.findall(r'(\w+)="([^"]*)"', params))
+        query = urllib.parse.urlencode(
+            {key: value for key, value in options.items() if key in ("service", "scope")}
+        )
+        request = urllib.request.Request(f'{options["realm"]}?{query}')
+        if basic is not None:
+            request.add_header("Authorization", f"Basic {basic}")
+        with urllib.request.urlopen(request, timeout=30) as response:
+            token = json.load(response)
+        self._authorization = f'Bearer {token.get("token") or token["access_token"]}'
+
+    def request(
+        self,
+        method: str,
+        path: str,
+        body: Optional[bytes] = None,
+        headers: Optional[Dict[str, str]] = None,
+    ) -> Tuple[int, Dict[str, str], bytes]:
+        """Send a request, authenticating and retrying once if the registry asks for credentials"""
+        headers = headers or {}
+        status, response_headers, data = self._send(method, path, body, headers)
+        if status == 401 and "www-authenticate" in response_headers:
+            self._authenticate(response_headers["www-authenticate"])
+            status, response_headers, data = self._send(method, path, body, headers)
+        return status, response_headers, data
+
+    def manifest_exists(self, repository: str, reference: str) -> bool:
+        """Check whether a tag or digest exists in a repository"""
+        path = f"/v2/{repository}/manifests/{reference}"
+        status, _, data = self.request(
+            "HEAD", path, headers={"Accept": ", ".join(MANIFEST_MEDIA_TYPES)}
+        )
+        if status == 200:
+            return True
+        if status == 404:
+            return False
+        raise RegistryError("HEAD", path, status, data)
+
+    def get_manifest(self, repository: str, reference: str) -> Tuple[str, bytes]:
+        """Fetch a manifest by tag or digest, returning its media type and exact content"""
+        path = f"/v2/{repository}/manifests/{reference}"
+        status, headers, data = self.request(
+            "GET", path, headers={"Accept": ", ".join(MANIFEST_MEDIA_TYPES)}
+        )
+        if status != 200:
+            raise RegistryError("GET", path, status, data)
+        media_type = headers.get("content-type", "").split(";")[0] or json.loads(data).get("mediaType", "")
+        return media_type, data
+
+    def _get_blob(self, path: str, headers: Dict[str, str]) -> Tuple[int, bytes]:
+        """Fetch a blob, following the redirect to storage that registries such as ECR answer blob requests with"""
+        status, response_headers, data = self.request("GET", path, headers=headers)
+        if status in (301, 302, 303, 307, 308) and "location" in response_headers:
+            scheme = "https" if self.secure else "http"
+            location = urllib.parse.urljoin(f"{scheme}://{self.host}{path}", response_headers["location"])
+            # Storage URLs are pre-signed, the registry's authorisation isn't sent to them
+            with urllib.request.urlopen(urllib.request.Request(location, headers=headers), timeout=30) as response:
+                status, data = response.status, response.read()
+        return status, data
+
+    def get_blob(self, repository: str, digest: str) -> bytes:
+        """Fetch a blob by digest"""
+        path = f"/v2/{repository}/blobs/{digest}"
+        status, data = self._get_blob(path, {})
+        if status != 200:
+            raise RegistryError("GET", path, status, data)
+        return data
+
+    def blob_tail(self, repository: str, digest: str, count: int) -> bytes:
+        """The last bytes of a blob"""
+        path = f"/v2/{repository}/blobs/{digest}"
+        status, data = self._get_blob(path, {"Range": f"bytes=-{count}"})
+        if status == 206:
+            return data
+        if status == 200:
+            # Ranges are optional, a registry may send the whole blob
+            return data[-count:]
+        raise RegistryError("GET", path, status, data)
+
+    def put_manifest(self, repository: str, reference: str, media_type: str, content: bytes) -> str:
+        """Store a manifest under a tag, returning its digest"""
+        path = f"/v2/{repository}/manifests/{reference}"
+        status, _, data = self.request("PUT", path, content, {"Content-Type": media_type})
+        if status not in (200, 201):
+            raise RegistryError("PUT", path, status, data)
+        return content_digest(content)
+
+    def platform_descriptors(self, repository: str, media_type: str, content: bytes) -> List[Dict[str, Any]]:
+        """Index entries for each platform image of a manifest, attestations included, reading an image's platform from its config"""
+        manifest = json.loads(content)
+        if media_type in INDEX_MEDIA_TYPES:
+            return manifest["manifests"]
+
+        config = json.loads(self.get_blob(repository, manifest["config"]["digest"]))
+        platform = {"architecture": config["architecture"], "os": config["os"]}
+        for field in ("variant", "os.version"):
+            if config.get(field):
+                platform[field] = config[field]
+        return [
+            {
+                "mediaType": media_type,
+                "digest": content_digest(content),
+                "size": len(content),
+                "platform": platform,
+            }
+        ]
+
+    def build_index(self, repository: str, references: List[str]) -> Tuple[str, bytes]:
+        """Combine images and indexes in a repository into one index, as `docker buildx imagetools create` does"""
+        manifests = [self.get_manifest(repository, reference) for reference in references]
+        if len(manifests) == 1 and manifests[0][0] in INDEX_MEDIA_TYPES:
+            # Tagging a single index reuses it as is, so every tag shares its digest
+            return manifests[0]
+
+        descriptors: List[Dict[str, Any]] = []
+        for media_type, content in manifests:
+            for descriptor in self.platform_descriptors(repository, media_type, content):
+                if descriptor["digest"] not in (existing["digest"] for existing in descriptors):
+                    descriptors.append(descriptor)
+
+        # A Docker manifest list can only reference Docker manifests, anything else needs an OCI index
+        media_type = (
+            DOCKER_MANIFEST_LIST
+            if all(descriptor["mediaType"] == DOCKER_MANIFEST for descriptor in descriptors)
+            else OCI_INDEX
+        )
+        index = {"schemaVersion": 2, "mediaType": media_type, "manifests": descriptors}
+        return media_type, json.dumps(index, indent=2).encode()
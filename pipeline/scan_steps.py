@@ -0,0 +1,108 @@
+"""Container scans of built images, in their own steps or in the build step"""
+from typing import List, Dict, Any, Optional, Tuple
+
+from options import sanitise_image_tag
+from steps import finish_platform_step, image_meta_data_key, scan_step_key, step_agents, timed
+
+DEFAULT_LOCAL_SCAN_CACHE: str = "$${HOME}/.cache/build-and-push/scans"
+# wizcli exit statuses of scans that completed, passing (0) or with policy violations (4). Other statuses are errors
+# such as failing to authenticate, which are never reused.
+CACHED_SCAN_STATUSES: List[int] = [0, 4]
+
+
+def scan_cache_commands(scan_key: str, config: Dict[str, Any]) -> Tuple[List[str], List[str]]:
+    """Commands restoring a previous scan of the same image, setting SCAN_CACHED, and saving a completed scan for later builds"""
+    location = config["scan-cache-location"] or DEFAULT_LOCAL_SCAN_CACHE
+    if config["scan-cache"] == "s3":
+        fetch = f'aws s3 cp --recursive --quiet "{location}/$$SCAN_KEY" scan-cache'
+        store = f'aws s3 cp --recursive --quiet scan-cache "{location}/$$SCAN_KEY"'
+    else:
+        fetch = f'cp -R "{location}/$$SCAN_KEY/." scan-cache'
+        store = f'mkdir -p "{location}/$$SCAN_KEY" && cp scan-cache/out scan-cache/status "{location}/$$SCAN_KEY/" && cp scan-cache/scanned_at "{location}/$$SCAN_KEY/"'
+
+    ttl = config["scan-cache-ttl"] * 3600
+    statuses = " ".join(str(status) for status in CACHED_SCAN_STATUSES)
+    lookup = [
+        f"SCAN_KEY={scan_key}",
+        "SCAN_CACHED=",
+        "rm -rf scan-cache && mkdir scan-cache",
+        f"if {fetch} 2>/dev/null && [[ -f scan-cache/scanned_at ]] && (( $$(date +%s) - $$(cat scan-cache/scanned_at) < {ttl} )); then "
+        "SCAN_CACHED=1; SCAN_STATUS=$$(cat scan-cache/status); cp scan-cache/out out; "
+        'echo "Reusing the scan of $$SCAN_KEY from $$(( ($$(date +%s) - $$(cat scan-cache/scanned_at)) / 60 )) minutes ago"; fi',
+    ]
+    save = [
+        f'if [[ -z "$$SCAN_CACHED" && " {statuses} " == *" $$SCAN_STATUS "* ]]; then '
+        f'rm -rf scan-cache && mkdir scan-cache && cp out scan-cache/out && echo "$$SCAN_STATUS" > scan-cache/status && date +%s > scan-cache/scanned_at && ({store}) '
+        '|| echo "Unable to save the scan of $$SCAN_KEY"; fi',
+    ]
+    return lookup, save
+
+
+def scan_commands(
+    platform: str, image: str, config: Dict[str, Any], scan_key: Optional[str] = None, pull: Optional[str] = None
+) -> List[str]:
+    """Commands to scan an image and annotate the build with any findings, pulling it first when it isn't in the local docker daemon
+
+    With a scan cache, the image's digest (or ID) keys the result so an image already scanned isn't pulled or scanned again.
+    """
+    image_tag = sanitise_image_tag(config["image-tag"])
+    scan = [
+        timed("scan", command, config)
+        for command in [
+            "wizcli auth --id $$WIZ_CLIENT_ID --secret $$WIZ_CLIENT_SECRET",
+            f'wizcli docker scan --image {image} -p "Container Scanning" -p "Secret Scanning" --tag pipeline={config["pipeline-name"]} --tag architecture={platform} --tag pipeline_run={config["build-number"]} > out 2>&1 | true; SCAN_STATUS=$${{PIPESTATUS[0]}}',
+        ]
+    ]
+    if pull:
+        scan.insert(0, timed("pull", pull, config))
+
+    commands = scan
+    if config["scan-cache"] != "none":
+        lookup, save = scan_cache_commands(scan_key or f"$$(docker image inspect --format '{{{{.Id}}}}' {image})", config)
+        commands = [*lookup, *[f'if [[ -z "$$SCAN_CACHED" ]]; then {command}; fi' for command in scan], *save]
+
+    commands.append(
+        timed(
+            "scan",
+            # pylint: disable=anomalous-backslash-in-string
+            f'if [[ ! $$SCAN_STATUS -eq 0 ]]; then echo -e "**Container scan report [{config["image-name"]}:{image_tag}] ({platform})**\n\n<details><summary></summary>\n\n\`\`\`term\n$(cat out**)\`\`\`\n\n</details>" | buildkite-agent annotate --style error --context {"".join(item for item in config["image-name"] if item.isalnum())}-{"".join(item for item in config["image-tag"] if item.isalnum())}-{platform}-security-scan; fi',
+            config,
+        )
+    )
+    if config["block-on-container-scan"]:
+        commands.append(
+            "if [[ ! $$SCAN_STATUS -eq 0 ]]; then exit $$SCAN_STATUS; fi"
+        )
+    return commands
+
+
+def create_scan_step(
+    platform: str, agent: str, config: Dict[str, Any], build_key: Optional[str] = None
+) -> Dict[str, Any]:
+    """Create a step stub to scan a pushed platform image, pulling it by the digest its build step recorded"""
+    label = f":mag: Scan {platform} image"
+    if config["image-key"]:
+        label = f':mag: Scan {config["image-name"]} {platform} image'
+
+    step = {
+        "label": label,
+        "key": scan_step_key(platform, config),
+        "depends_on": [build_key or f'{config["group-key"]}-build-push-{platform}'],
+        "command": [
+            f"IMAGE=$$(buildkite-agent meta-data get {image_meta_data_key(platform, config)})",
+            # The image is recorded by digest, which keys any cached scan of it
+            *scan_commands(platform, "$$IMAGE", config, scan_key="$${IMAGE##*@}", pull="docker pull --quiet $$IMAGE"),
+        ],
+        "agents": step_agents(platform, agent, config),
+        "plugins": [
+            {
+                "CatchoftheDay/set-environment#v1.1.0": {},
+            },
+        ],
+    }
+
+    if not config["block-on-container-scan"]:
+        # A scan that can't fail the build shouldn't fail it by not getting as far as scanning either
+        step["soft_fail"] = True
+
+    return finish_platform_step(step, platform, config)
@@ -0,0 +1,219 @@
+"""Estimate the wall-clock time and agent time of generated pipelines from historical step durations
+
+Usage: python3 pipeline/simulate.py --durations durations.json [--percentile 0.5] [--json] <pipeline file>...
+
+Durations are a JSON object of step keys, or fnmatch patterns tried in file order, to seconds or a list of
+past durations in seconds. Every step starts as soon as its dependencies finish, as if agents were always free.
+"""
+import argparse
+import fnmatch
+import json
+import sys
+
+from typing import Any, Dict, List, Optional, Sequence, Union
+
+try:
+    import yaml
+except ImportError:
+    # PyYAML is only needed for pipelines written as YAML
+    yaml = None
+
+from timings import percentile
+
+BARRIER_STEPS: List[str] = ["wait", "block", "input"]
+DEFAULT_QUEUE: str = "default"
+
+Durations = Dict[str, Union[float, List[float]]]
+
+
+def step_id(step: Dict[str, Any], position: int) -> str:
+    """How a step is referred to, its key, or its label or position when it has none"""
+    return str(step.get("key") or step.get("label") or f"step-{position + 1}")
+
+
+def dependency_keys(step: Dict[str, Any]) -> List[str]:
+    """The keys a step's depends_on names, which may be a key, a list of keys or a list of {step: key}"""
+    depends_on = step.get("depends_on") or []
+    if isinstance(depends_on, str):
+        depends_on = [depends_on]
+    return [dependency["step"] if isinstance(dependency, dict) else dependency for dependency in depends_on]
+
+
+def step_queue(step: Dict[str, Any]) -> str:
+    """The queue a step's agents are targeted by, as a mapping or a list of key=value strings"""
+    agents = step.get("agents") or {}
+    if isinstance(agents, list):
+        agents = dict(tag.split("=", 1) for tag in agents if "=" in tag)
+    return str(agents.get("queue", DEFAULT_QUEUE))
+
+
+def step_duration(key: str, durations: Durations, fraction: float) -> Optional[float]:
+    """A step's expected duration in seconds, from its key or the first pattern matching it"""
+    value = durations.get(key)
+    if value is None:
+        value = next((value for pattern, value in durations.items() if fnmatch.fnmatchcase(key, pattern)), None)
+    if isinstance(value, list):
+        return percentile(sorted(value), fraction) if value else None
+    return value
+
+
+def flatten(pipeline: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
+    """Every step that runs on an agent with what it waits for, groups and wait steps turned into dependencies"""
+    steps: Dict[str, Dict[str, Any]] = {}
+    groups: Dict[str, List[str]] = {}
+
+    def add(entries: List[Any], inherited: List[str]) -> List[str]:
+        added: List[str] = []
+        barrier: List[str] = []
+        for entry in entries:
+            if isinstance(entry, str):
+                entry = {entry: None}
+            if any(name in entry for name in BARRIER_STEPS):
+                # Later steps wait for everything before a wait, block or input step
+                barrier = list(added)
+                continue
+
+            key = step_id(entry, len(steps))
+            depends_on = [*inherited, *barrier, *dependency_keys(entry)]
+            if "group" in entry:
+                members = add(entry.get("steps", []), depends_on)
+                key = str(entry.get("key") or entry["group"])
+                groups[key] = members
+                added.extend(members)
+                continue
+
+            steps[key] = {
+                "key": key,
+                "label": entry.get("label") or entry.get("name") or key,
+                "queue": step_queue(entry),
+                "parallelism": entry.get("parallelism") or 1,
+                "depends_on": depends_on,
+            }
+            added.append(key)
+        return added
+
+    add(pipeline.get("steps", []), [])
+
+    # Depending on a group waits for every step in it, keys from outside the pipeline are taken as already finished
+    for step in steps.values():
+        expanded: List[str] = []
+        for dependency in step["depends_on"]:
+            for key in groups.get(dependency, [dependency]):
+                if key in steps and key not in expanded and key != step["key"]:
+                    expanded.append(key)
+        step["depends_on"] = expanded
+    return steps
+
+
+def simulate(pipeline: Dict[str, Any], durations: Durations, fraction: float = 0.5) -> Dict[str, Any]:
+    """The critical path, end-to-end duration and agent minutes per queue of a pipeline
+
+    Durations given as a list of past runs are summarised by the percentile fraction. A ValueError lists the steps
+    with no duration, or the steps that depend on each other.
+    """
+    steps = flatten(pipeline)
+    missing = [key for key in steps if step_duration(key, durations, fraction) is None]
+    if missing:
+        raise ValueError(f'No duration for step(s) {", ".join(missing)}')
+
+    finish: Dict[str, float] = {}
+    visiting: List[str] = []
+
+    def finish_time(key: str) -> float:
+        if key in finish:
+            return finish[key]
+        if key in visiting:
+            raise ValueError(f'Steps {", ".join(visiting[visiting.index(key):])} depend on each other')
+        visiting.append(key)
+        step = steps[key]
+        step["start_s"] = max((finish_time(dependency) for dependency in step["depends_on"]), default=0.0)
+        step["duration_s"] = float(step_duration(key, durations, fraction) or 0)
+        visiting.pop()
+        finish[key] = step["finish_s"] = step["start_s"] + step["duration_s"]
+        return finish[key]
+
+    for key in steps:
+        finish_time(key)
+
+    critical_path: List[Dict[str, Any]] = []
+    current = max(steps.values(), key=lambda step: step["finish_s"], default=None)
+    while current is not None:
+        critical_path.insert(0, {field: current[field] for field in ("key", "label", "start_s", "finish_s")})
+        current = max(
+            (steps[dependency] for dependency in current["depends_on"]),
+            key=lambda step: step["finish_s"],
+            default=None,
+        )
+
+    agent_minutes: Dict[str, float] = {}
+    for step in steps.values():
+        agent_minutes[step["queue"]] = agent_minutes.get(step["queue"], 0.0) + step["duration_s"] * step["parallelism"] / 60
+
+    return {
+        "duration_s": max(finish.values(), default=0.0),
+        "critical_path": critical_path,
+        "agent_minutes": dict(sorted(agent_minutes.items())),
+    }
+
+
+def format_duration(seconds: float) -> str:
+    """Seconds as minutes and seconds"""
+    minutes, seconds = divmod(round(seconds), 60)
+    return f"{minutes}m {seconds:02d}s"
+
+
+def format_result(name: str, result: Dict[str, Any]) -> str:
+    """Render a simulation as text, the critical path in order followed by the agent minutes of each queue"""
+    lines = [f'{name}: {format_duration(result["duration_s"])} end to end', "Critical path:"]
+    lines.extend(
+        f'  {format_duration(step["start_s"]):>8} - {format_duration(step["finish_s"]):>8}  {step["key"]}'
+        for step in result["critical_path"]
+    )
+    lines.append("Agent minutes:")
+    width = max((len(queue) for queue in result["agent_minutes"]), default=0)
+    lines.extend(f"  {queue.ljust(width)}  {minutes:.1f}" for queue, minutes in result["agent_minutes"].items())
+    return "\n".join(lines)
+
+
+def load(path: str) -> Any:
+    """Read a pipeline or durations file, as JSON when it parses as JSON and otherwise as YAML"""
+    with open(path, encoding="utf8") as file:
+        text = file.read()
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        if yaml is None:
+            raise
+        return yaml.safe_load(text)
+
+
+def main(argv: Optional[Sequence[str]] = None) -> int:
+    """Print the simulation of each pipeline file, so variants of a config can be compared"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("paths", nargs="+", help="pipelines written by pipeline.py, as YAML or JSON")
+    parser.add_argument("--durations", required=True, help="JSON object of step keys or patterns to seconds")
+    parser.add_argument("--percentile", type=float, default=0.5, help="percentile of past durations to use, from 0 to 1 (default: 0.5)")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args(argv)
+    if not 0 < args.percentile <= 1:
+        parser.error("--percentile must be greater than 0 and at most 1")
+
+    durations = load(args.durations)
+    results: Dict[str, Any] = {}
+    for path in args.paths:
+        try:
+            results[path] = simulate(load(path), durations, args.percentile)
+        except ValueError as error:
+            print(f"Unable to simulate {path}: {error}", file=sys.stderr)
+            return 1
+
+    if args.json:
+        json.dump(results, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+    else:
+        print("\n\n".join(format_result(path, result) for path, result in results.items()))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,74 @@
+"""Keys, agents and phase timing shared by the generated steps"""
+import shlex
+
+from typing import List, Dict, Any
+
+from options import platform_settings, sanitise_image_tag, sanitise_step_key
+
+# Phase timing records written by steps generated with `phase-timings`, one file per job
+PHASE_TIMINGS_FILE: str = "phase-timings-$$BUILDKITE_JOB_ID.jsonl"
+
+
+def fingerprint_tag(config: Dict[str, Any]) -> str:
+    """The tag an image is published under so later builds with identical inputs can find it"""
+    return f'fingerprint-{config["fingerprint"][0:32]}'
+
+
+def step_agents(platform: str, agent: str, config: Dict[str, Any]) -> Dict[str, str]:
+    """Agent targeting rules for a platform's steps"""
+    agents = {"queue": agent}
+    resource_class = platform_settings(platform, config)["resource-class"]
+    if resource_class:
+        agents["resource_class"] = resource_class
+    return agents
+
+
+def gzip_variant(config: Dict[str, Any]) -> bool:
+    """Whether gzip copies of the images are published for runtimes that can't pull the configured compression"""
+    return config["gzip-variant"] and config["compression"] != "gzip" and config["push-to-ecr"]
+
+
+def image_meta_data_key(platform: str, config: Dict[str, Any]) -> str:
+    """The build meta-data key a pushed platform image's digest reference is recorded under"""
+    return f'{config["group-key"]}-{sanitise_step_key(config["image-name"])}-{platform}-image'
+
+
+def scan_step_key(platform: str, config: Dict[str, Any]) -> str:
+    """The key of the step scanning an image for a platform"""
+    if config["image-key"]:
+        return f'{config["group-key"]}-scan-{config["image-key"]}-{platform}'
+    return f'{config["group-key"]}-scan-{platform}'
+
+
+def phase_timing_setup(platform: str) -> List[str]:
+    """Commands defining bp_phase, which runs a command and appends a JSON timing record for it, and uploading the records however the step exits"""
+    record = (
+        '{"phase":"%s","platform":"%s","image":"%s","tag":"%s","pipeline":"%s","build_number":"%s","job_id":"%s","started_at":%d,"duration_ms":%d,"exit_status":%d,"affinity":"%s","builder":"%s"}\\n'
+    )
+    return [
+        "bp_phase() { local bp_start bp_status=0; bp_start=$$(date +%s%3N); eval \"$$4\" || bp_status=$$?; "
+        f"printf '{record}' \"$$1\" {platform} \"$$2\" \"$$3\" \"$$BUILDKITE_PIPELINE_SLUG\" \"$$BUILDKITE_BUILD_NUMBER\" \"$$BUILDKITE_JOB_ID\" \"$$bp_start\" $$(($$(date +%s%3N) - bp_start)) \"$$bp_status\" \"$${{BP_AFFINITY:-}}\" \"$${{BP_BUILDER:-}}\" >> \"{PHASE_TIMINGS_FILE}\"; "
+        'return "$$bp_status"; }',
+        f"trap 'buildkite-agent artifact upload \"{PHASE_TIMINGS_FILE}\"' EXIT",
+    ]
+
+
+def timed(phase: str, command: str, config: Dict[str, Any], shared: bool = False) -> str:
+    """Wrap a command in bp_phase when phase timings are enabled, shared phases serve every image built by the job"""
+    if not config["phase-timings"]:
+        return command
+    image_name = "" if shared else config["image-name"]
+    image_tag = "" if shared else sanitise_image_tag(config["image-tag"])
+    return f"bp_phase {phase} {shlex.quote(image_name)} {shlex.quote(image_tag)} {shlex.quote(command)}"
+
+
+def finish_platform_step(step: Dict[str, Any], platform: str, config: Dict[str, Any]) -> Dict[str, Any]:
+    """Set up phase timing before a platform step's commands and add the configured additional plugins"""
+    if config["phase-timings"]:
+        step["command"][0:0] = phase_timing_setup(platform)
+
+    if len(config["additional-plugins"]) > 0:
+        for plugin in config["additional-plugins"]:
+            step["plugins"].append(plugin)
+
+    return step
@@ -1,19 +1,48 @@
+import io
 import os
 import json
+import subprocess
+import tempfile
 import time
 import json
-from unittest import mock, main, TestCase
+from unittest import mock, main, skipUnless, TestCase
 
+import yaml
+
+try:
+    import tomllib
+except ImportError:
+    tomllib = None
+
+from fake_registry import FakeRegistry
+from builders import add_builder_affinity, affinity_shard, builder_command, buildkitd_config, resolve_builder_affinity
+from manifest_steps import create_image_size_step, create_oci_manifest_step, create_shared_manifest_step
+from options import plugin_ref, process_config, BUILDKIT_VERSION
+from scan_steps import create_scan_step
 from pipeline import (
+    ancestor_commits,
+    build_fingerprint,
+    check_build_context,
     create_build_step,
-    create_oci_manifest_step,
-    process_config,
-    BUILDKIT_VERSION,
+    build_levels,
+    generate,
+    resolve_base_images,
+    resolve_build_args,
+    resolve_cache_ancestor,
+    resolve_promotion,
+    resolve_unchanged_build,
+    write_pipeline,
 )
+from registry import RegistryClient
 
 BUILD_TIME = int(time.time())
 
 
+def process_plugin_config(plugin_config):
+    """Process a plugin configuration in the build environment of the pipeline generation tests"""
+    return process_config(TestPipelineGeneration.RUNTIME_ENVS | {"BUILDKITE_PLUGIN_CONFIGURATION": json.dumps(plugin_config)})
+
+
 class TestPipelineGeneration(TestCase):
     config = {
         "image-name": "testcase",
@@ -23,7 +52,6 @@ class TestPipelineGeneration(TestCase):
         "build-args": [
             "arg1=42",
             "arg2",
-            "GITHUB_TOKEN",
             "BUILDKITE_COMMIT",
             "BUILDKITE_JOB_ID",
             f"BUILD_DATE={BUILD_TIME}",
@@ -40,12 +68,76 @@ class TestPipelineGeneration(TestCase):
         "composer-cache": False,
         "npm-cache": False,
         "yarn-cache": False,
+        "package-caches": [],
+        "platforms": [],
+        "context-analysis": False,
+        "context-size-budget": 0,
+        "context-budget-action": "warn",
+        "build-args-filter": True,
+        "reproducible-build-date": False,
+        "secrets": ["GITHUB_TOKEN"],
+        "secrets-as-build-args": False,
+        "dockerfile-args": None,
+        "source-date-epoch": None,
         "fully-qualified-image-name": "362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/testcase",
         "push-to-ecr": True,
         "repository-namespace": "catch",
         "additional-plugins": [],
+        "output-format": "json",
+        "upload-mode": "dry-run",
+        "archive-pipeline": True,
+        "current-branch": "main",
+        "current-tag": "",
+        "pipeline-name": "testcase",
+        "build-number": "110",
+        "block-on-container-scan": False,
+        "buildkit-version": BUILDKIT_VERSION,
+        "skip-unchanged-builds": False,
+        "promote-tag-builds": False,
+        "compression": "gzip",
+        "compression-level": 0,
+        "force-compression": False,
+        "gzip-variant": False,
+        "manifest-client": "cli",
+        "plugin-ref": None,
+        "fingerprint": None,
+        "prebuilt-images": [],
+        "cache-export": "none",
+        "cache-export-mode": "max",
+        "push-mode": "load",
+        "images": [],
+        "images-per-job": 0,
+        "order-base-images": True,
+        "image-size-check": False,
+        "image-size-budget": 0,
+        "image-size-growth-budget": 0,
+        "image-layer-budget": 0,
+        "image-layer-growth-budget": 0,
+        "image-key": "",
+        "base-images": {},
+        "base-image-contexts": {},
+        "remote-builders": {},
+        "buildkitd-gc-keep-storage": 0,
+        "buildkitd-gc-keep-duration": 0,
+        "buildkitd-registry-mirrors": {},
+        "buildkitd-max-parallelism": 0,
+        "scan-cache": "none",
+        "scan-cache-location": "",
+        "scan-cache-ttl": 24,
+        "builder-affinity-shards": 0,
+        "builder-affinity-tag": "build-cache-shard",
+        "idle-agents": None,
+        "cache-from-branches": ["main", "master"],
+        "cache-from-ancestors": 0,
+        "cache-from-limit": 4,
+        "current-commit": "123456789010",
+        "pull-request-base-branch": "",
+        "cache-ancestor": None,
+        "phase-timings": False,
     }
 
+    tag_config = config | {"current-branch": "v1.0.0", "current-tag": "v1.0.0"}
+
     maxDiff = None
 
     BUILDKITE_PLUGIN_CONFIGURATION = {
@@ -66,9 +158,13 @@ class TestPipelineGeneration(TestCase):
         "WIZ_CLIENT_SECRET": "wiz-client-secret",
     }
 
+    def setUp(this):
+        # BUILD_DATE is stamped with the current time, pin it so expectations don't race a second boundary
+        patcher = mock.patch("time.time", return_value=BUILD_TIME)
+        patcher.start()
+        this.addCleanup(patcher.stop)
+
     @mock.patch.dict(os.environ, RUNTIME_ENVS)
-    @mock.patch("pipeline.CURRENT_BRANCH", "main")
-    @mock.patch("pipeline.CURRENT_TAG", "")
     def test_process_config(this):
         config = process_config()
 
@@ -78,8 +174,6 @@ class TestPipelineGeneration(TestCase):
         os.environ,
         RUNTIME_ENVS | { "BUILDKITE_PLUGIN_CONFIGURATION": json.dumps({**BUILDKITE_PLUGIN_CONFIGURATION | {'push-branches': "testing"}})}
     )
-    @mock.patch("pipeline.CURRENT_BRANCH", "main")
-    @mock.patch("pipeline.CURRENT_TAG", "")
     def test_process_config_no_push_branch(this):
         config = process_config()
 
@@ -93,8 +187,6 @@ class TestPipelineGeneration(TestCase):
         os.environ,
         RUNTIME_ENVS | { "BUILDKITE_PLUGIN_CONFIGURATION": json.dumps({**BUILDKITE_PLUGIN_CONFIGURATION | {'push-branches': "testing,main"}})}
     )
-    @mock.patch("pipeline.CURRENT_BRANCH", "main")
-    @mock.patch("pipeline.CURRENT_TAG", "")
     def test_process_config_no_push_branch(this):
         config = process_config()
 
@@ -108,8 +200,6 @@ class TestPipelineGeneration(TestCase):
         os.environ,
         RUNTIME_ENVS | { "BUILDKITE_PLUGIN_CONFIGURATION": json.dumps({**BUILDKITE_PLUGIN_CONFIGURATION | {'repository-namespace': "docker.io"}})}
     )
-    @mock.patch("pipeline.CURRENT_BRANCH", "main")
-    @mock.patch("pipeline.CURRENT_TAG", "")
     def test_process_config_different_namespace(this):
         config = process_config()
 
@@ -151,8 +241,6 @@ class TestPipelineGeneration(TestCase):
         this.assertEqual(config, plugin_config)
 
     @mock.patch.dict(os.environ, RUNTIME_ENVS)
-    @mock.patch("pipeline.CURRENT_BRANCH", "main")
-    @mock.patch("pipeline.CURRENT_TAG", "")
     def test_create_build_step_push(this):
         platform = "arm"
         agent = "docker-arm"
@@ -166,11 +254,9 @@ class TestPipelineGeneration(TestCase):
             step["command"],
             [
                 f"docker buildx use builder || docker buildx create --bootstrap --name builder --use --driver docker-container --driver-opt image=moby/buildkit:{BUILDKIT_VERSION}",
-                f"docker buildx build --load --pull --ssh default  --cache-from type=registry,ref=362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/testcase:cache_1234567890 --cache-from type=registry,ref=362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/testcase:cache_main --cache-from type=registry,ref=362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/testcase:cache_master --build-arg arg1=42 --build-arg arg2 --build-arg GITHUB_TOKEN --build-arg BUILDKITE_COMMIT --build-arg BUILDKITE_JOB_ID --build-arg BUILD_DATE={BUILD_TIME}    --tag 362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/testcase:multi-platform-1234567890-arm -f Dockerfile .",
-                "wizcli auth --id $$WIZ_CLIENT_ID --secret $$WIZ_CLIENT_SECRET",
-                'wizcli docker scan --image 362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/testcase:multi-platform-1234567890-arm -p "Container Scanning" -p "Secret Scanning" --tag pipeline=testcase --tag architecture=arm --tag pipeline_run=110 > out 2>&1 | true; SCAN_STATUS=$${PIPESTATUS[0]}',
-                'if [[ ! $$SCAN_STATUS -eq 0 ]]; then echo -e "**Container scan report [testcase:1234567890] (arm)**\n\n<details><summary></summary>\n\n\\`\\`\\`term\n$(cat out**)\\`\\`\\`\n\n</details>" | buildkite-agent annotate --style error --context testcase-1234567890-arm-security-scan; fi',
+                f"docker buildx build --load --pull --ssh default --secret id=GITHUB_TOKEN,env=GITHUB_TOKEN  --cache-from type=registry,ref=362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/testcase:cache_main --cache-from type=registry,ref=362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/testcase:cache_master --cache-from type=registry,ref=362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/testcase:cache_1234567890 --build-arg arg1=42 --build-arg arg2 --build-arg BUILDKITE_COMMIT --build-arg BUILDKITE_JOB_ID --build-arg BUILD_DATE={BUILD_TIME}  --tag 362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/testcase:multi-platform-1234567890-arm -f Dockerfile .",
                 "docker image push 362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/testcase:multi-platform-1234567890-arm",
+                "buildkite-agent meta-data set build-and-push-testcase-arm-image $$(docker image inspect --format '{{index .RepoDigests 0}}' 362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/testcase:multi-platform-1234567890-arm)",
             ],
         )
 
@@ -178,8 +264,6 @@ class TestPipelineGeneration(TestCase):
         this.assertEqual(step["key"], "build-and-push-build-push-arm")
 
     @mock.patch.dict(os.environ, RUNTIME_ENVS)
-    @mock.patch("pipeline.CURRENT_BRANCH", "main")
-    @mock.patch("pipeline.CURRENT_TAG", "")
     def test_create_build_step_push_mutate_tags(this):
         platform = "arm"
         agent = "docker-arm"
@@ -197,11 +281,9 @@ class TestPipelineGeneration(TestCase):
             step["command"],
             [
                 f"docker buildx use builder || docker buildx create --bootstrap --name builder --use --driver docker-container --driver-opt image=moby/buildkit:{BUILDKIT_VERSION}",
-                f"docker buildx build --load --pull --ssh default  --cache-from type=registry,ref=362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/testcase:cache_1234567890 --cache-from type=registry,ref=362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/testcase:cache_main --cache-from type=registry,ref=362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/testcase:cache_master --build-arg arg1=42 --build-arg arg2 --build-arg GITHUB_TOKEN --build-arg BUILDKITE_COMMIT --build-arg BUILDKITE_JOB_ID --build-arg BUILD_DATE={BUILD_TIME}    --tag 362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/testcase:multi-platform-1234567890-arm -f Dockerfile .",
-                "wizcli auth --id $$WIZ_CLIENT_ID --secret $$WIZ_CLIENT_SECRET",
-                'wizcli docker scan --image 362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/testcase:multi-platform-1234567890-arm -p "Container Scanning" -p "Secret Scanning" --tag pipeline=testcase --tag architecture=arm --tag pipeline_run=110 > out 2>&1 | true; SCAN_STATUS=$${PIPESTATUS[0]}',
-                'if [[ ! $$SCAN_STATUS -eq 0 ]]; then echo -e "**Container scan report [testcase:1234567890] (arm)**\n\n<details><summary></summary>\n\n\\`\\`\\`term\n$(cat out**)\\`\\`\\`\n\n</details>" | buildkite-agent annotate --style error --context testcase-1234567890-arm-security-scan; fi',
+                f"docker buildx build --load --pull --ssh default --secret id=GITHUB_TOKEN,env=GITHUB_TOKEN  --cache-from type=registry,ref=362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/testcase:cache_main --cache-from type=registry,ref=362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/testcase:cache_master --cache-from type=registry,ref=362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/testcase:cache_1234567890 --build-arg arg1=42 --build-arg arg2 --build-arg BUILDKITE_COMMIT --build-arg BUILDKITE_JOB_ID --build-arg BUILD_DATE={BUILD_TIME}  --tag 362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/testcase:multi-platform-1234567890-arm -f Dockerfile .",
                 "docker image push 362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/testcase:multi-platform-1234567890-arm",
+                "buildkite-agent meta-data set build-and-push-testcase-arm-image $$(docker image inspect --format '{{index .RepoDigests 0}}' 362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/testcase:multi-platform-1234567890-arm)",
             ],
         )
 
@@ -209,28 +291,55 @@ class TestPipelineGeneration(TestCase):
         this.assertEqual(step["key"], "build-and-push-build-push-arm")
 
     @mock.patch.dict(os.environ, RUNTIME_ENVS)
-    @mock.patch("pipeline.CURRENT_BRANCH", "main")
-    @mock.patch("pipeline.CURRENT_TAG", "")
-    @mock.patch("pipeline.BLOCK_ON_CONTAINER_SCAN", True)
-    def test_create_build_step_push_scan_block(this):
+    def test_create_scan_step_block(this):
         platform = "arm"
         agent = "docker-arm"
 
-        step = create_build_step(platform, agent, this.config)
+        config = this.config | {"block-on-container-scan": True}
+        step = create_scan_step(platform, agent, config)
 
-        this.assertEqual(step["label"], ":docker: Build and push arm image")
+        this.assertEqual(step["label"], ":mag: Scan arm image")
         this.assertEqual(step["agents"], {"queue": "docker-arm"})
+        this.assertEqual(step["depends_on"], ["build-and-push-build-push-arm"])
         this.maxDiff = None
         this.assertEqual(
             step["command"],
             [
-                f"docker buildx use builder || docker buildx create --bootstrap --name builder --use --driver docker-container --driver-opt image=moby/buildkit:{BUILDKIT_VERSION}",
-                f"docker buildx build --load --pull --ssh default  --cache-from type=registry,ref=362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/testcase:cache_1234567890 --cache-from type=registry,ref=362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/testcase:cache_main --cache-from type=registry,ref=362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/testcase:cache_master --build-arg arg1=42 --build-arg arg2 --build-arg GITHUB_TOKEN --build-arg BUILDKITE_COMMIT --build-arg BUILDKITE_JOB_ID --build-arg BUILD_DATE={BUILD_TIME}    --tag 362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/testcase:multi-platform-1234567890-arm -f Dockerfile .",
+                "IMAGE=$$(buildkite-agent meta-data get build-and-push-testcase-arm-image)",
+                "docker pull --quiet $$IMAGE",
                 "wizcli auth --id $$WIZ_CLIENT_ID --secret $$WIZ_CLIENT_SECRET",
-                'wizcli docker scan --image 362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/testcase:multi-platform-1234567890-arm -p "Container Scanning" -p "Secret Scanning" --tag pipeline=testcase --tag architecture=arm --tag pipeline_run=110 > out 2>&1 | true; SCAN_STATUS=$${PIPESTATUS[0]}',
+                'wizcli docker scan --image $$IMAGE -p "Container Scanning" -p "Secret Scanning" --tag pipeline=testcase --tag architecture=arm --tag pipeline_run=110 > out 2>&1 | true; SCAN_STATUS=$${PIPESTATUS[0]}',
                 'if [[ ! $$SCAN_STATUS -eq 0 ]]; then echo -e "**Container scan report [testcase:1234567890] (arm)**\n\n<details><summary></summary>\n\n\\`\\`\\`term\n$(cat out**)\\`\\`\\`\n\n</details>" | buildkite-agent annotate --style error --context testcase-1234567890-arm-security-scan; fi',
                 "if [[ ! $$SCAN_STATUS -eq 0 ]]; then exit $$SCAN_STATUS; fi",
+            ],
+        )
+        this.assertEqual(step["key"], "build-and-push-scan-arm")
+        this.assertNotIn("soft_fail", step)
+
+    def test_create_scan_step_non_blocking(this):
+        step = create_scan_step("arm", "docker-arm", this.config | {"block-on-container-scan": False})
+
+        # Failing to pull or authenticate doesn't fail the build either
+        this.assertTrue(step["soft_fail"])
+        this.assertNotIn("if [[ ! $$SCAN_STATUS -eq 0 ]]; then exit $$SCAN_STATUS; fi", step["command"])
+
+    def test_create_build_step_push_scan_block(this):
+        platform = "arm"
+        agent = "docker-arm"
+
+        config = this.config | {"block-on-container-scan": True}
+        step = create_build_step(platform, agent, config)
+
+        this.assertEqual(step["label"], ":docker: Build and push arm image")
+        this.assertEqual(step["agents"], {"queue": "docker-arm"})
+        this.maxDiff = None
+        this.assertEqual(
+            step["command"],
+            [
+                f"docker buildx use builder || docker buildx create --bootstrap --name builder --use --driver docker-container --driver-opt image=moby/buildkit:{BUILDKIT_VERSION}",
+                f"docker buildx build --load --pull --ssh default --secret id=GITHUB_TOKEN,env=GITHUB_TOKEN  --cache-from type=registry,ref=362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/testcase:cache_main --cache-from type=registry,ref=362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/testcase:cache_master --cache-from type=registry,ref=362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/testcase:cache_1234567890 --build-arg arg1=42 --build-arg arg2 --build-arg BUILDKITE_COMMIT --build-arg BUILDKITE_JOB_ID --build-arg BUILD_DATE={BUILD_TIME}  --tag 362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/testcase:multi-platform-1234567890-arm -f Dockerfile .",
                 "docker image push 362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/testcase:multi-platform-1234567890-arm",
+                "buildkite-agent meta-data set build-and-push-testcase-arm-image $$(docker image inspect --format '{{index .RepoDigests 0}}' 362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/testcase:multi-platform-1234567890-arm)",
             ],
         )
 
@@ -241,13 +350,11 @@ class TestPipelineGeneration(TestCase):
         os.environ,
         RUNTIME_ENVS | { "BUILDKITE_TAG": "v1.0.0", "BUILDKITE_BRANCH": "v1.0.0" }
     )
-    @mock.patch("pipeline.CURRENT_BRANCH", "v1.0.0")
-    @mock.patch("pipeline.CURRENT_TAG", "v1.0.0")
     def test_create_build_step_push_tags(this):
         platform = "arm"
         agent = "docker-arm"
 
-        step = create_build_step(platform, agent, this.config)
+        step = create_build_step(platform, agent, this.tag_config)
 
         this.assertEqual(step["label"], ":docker: Build and push arm image")
         this.assertEqual(step["agents"], {"queue": "docker-arm"})
@@ -256,11 +363,9 @@ class TestPipelineGeneration(TestCase):
             step["command"],
             [
                 f"docker buildx use builder || docker buildx create --bootstrap --name builder --use --driver docker-container --driver-opt image=moby/buildkit:{BUILDKIT_VERSION}",
-                f"docker buildx build --load --pull --ssh default  --cache-from type=registry,ref=362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/testcase:cache_1234567890 --cache-from type=registry,ref=362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/testcase:cache_main --cache-from type=registry,ref=362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/testcase:cache_master --cache-from type=registry,ref=362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/testcase:cache_v1.0.0 --build-arg arg1=42 --build-arg arg2 --build-arg GITHUB_TOKEN --build-arg BUILDKITE_COMMIT --build-arg BUILDKITE_JOB_ID --build-arg BUILD_DATE={BUILD_TIME}    --tag 362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/testcase:multi-platform-1234567890-arm -f Dockerfile .",
-                "wizcli auth --id $$WIZ_CLIENT_ID --secret $$WIZ_CLIENT_SECRET",
-                'wizcli docker scan --image 362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/testcase:multi-platform-1234567890-arm -p "Container Scanning" -p "Secret Scanning" --tag pipeline=testcase --tag architecture=arm --tag pipeline_run=110 > out 2>&1 | true; SCAN_STATUS=$${PIPESTATUS[0]}',
-                'if [[ ! $$SCAN_STATUS -eq 0 ]]; then echo -e "**Container scan report [testcase:1234567890] (arm)**\n\n<details><summary></summary>\n\n\\`\\`\\`term\n$(cat out**)\\`\\`\\`\n\n</details>" | buildkite-agent annotate --style error --context testcase-1234567890-arm-security-scan; fi',
+                f"docker buildx build --load --pull --ssh default --secret id=GITHUB_TOKEN,env=GITHUB_TOKEN  --cache-from type=registry,ref=362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/testcase:cache_v1.0.0 --cache-from type=registry,ref=362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/testcase:cache_main --cache-from type=registry,ref=362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/testcase:cache_master --cache-from type=registry,ref=362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/testcase:cache_1234567890 --build-arg arg1=42 --build-arg arg2 --build-arg BUILDKITE_COMMIT --build-arg BUILDKITE_JOB_ID --build-arg BUILD_DATE={BUILD_TIME}  --tag 362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/testcase:multi-platform-1234567890-arm -f Dockerfile .",
                 "docker image push 362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/testcase:multi-platform-1234567890-arm",
+                "buildkite-agent meta-data set build-and-push-testcase-arm-image $$(docker image inspect --format '{{index .RepoDigests 0}}' 362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/testcase:multi-platform-1234567890-arm)",
             ],
         )
 
@@ -268,8 +373,6 @@ class TestPipelineGeneration(TestCase):
         this.assertEqual(step["key"], "build-and-push-build-push-arm")
 
     @mock.patch.dict(os.environ, RUNTIME_ENVS)
-    @mock.patch("pipeline.CURRENT_BRANCH", "main")
-    @mock.patch("pipeline.CURRENT_TAG", "")
     def test_create_build_step_no_push(this):
         platform = "arm"
         agent = "docker-arm"
@@ -285,7 +388,7 @@ class TestPipelineGeneration(TestCase):
             step["command"],
             [
                 f"docker buildx use builder || docker buildx create --bootstrap --name builder --use --driver docker-container --driver-opt image=moby/buildkit:{BUILDKIT_VERSION}",
-                f"docker buildx build --load --pull --ssh default  --cache-from type=registry,ref=362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/testcase:cache_1234567890 --cache-from type=registry,ref=362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/testcase:cache_main --cache-from type=registry,ref=362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/testcase:cache_master --build-arg arg1=42 --build-arg arg2 --build-arg GITHUB_TOKEN --build-arg BUILDKITE_COMMIT --build-arg BUILDKITE_JOB_ID --build-arg BUILD_DATE={BUILD_TIME}    --tag 362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/testcase:multi-platform-1234567890-arm -f Dockerfile .",
+                f"docker buildx build --load --pull --ssh default --secret id=GITHUB_TOKEN,env=GITHUB_TOKEN  --cache-from type=registry,ref=362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/testcase:cache_main --cache-from type=registry,ref=362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/testcase:cache_master --cache-from type=registry,ref=362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/testcase:cache_1234567890 --build-arg arg1=42 --build-arg arg2 --build-arg BUILDKITE_COMMIT --build-arg BUILDKITE_JOB_ID --build-arg BUILD_DATE={BUILD_TIME}  --tag 362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/testcase:multi-platform-1234567890-arm -f Dockerfile .",
                 "wizcli auth --id $$WIZ_CLIENT_ID --secret $$WIZ_CLIENT_SECRET",
                 'wizcli docker scan --image 362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/testcase:multi-platform-1234567890-arm -p "Container Scanning" -p "Secret Scanning" --tag pipeline=testcase --tag architecture=arm --tag pipeline_run=110 > out 2>&1 | true; SCAN_STATUS=$${PIPESTATUS[0]}',
                 'if [[ ! $$SCAN_STATUS -eq 0 ]]; then echo -e "**Container scan report [testcase:1234567890] (arm)**\n\n<details><summary></summary>\n\n\\`\\`\\`term\n$(cat out**)\\`\\`\\`\n\n</details>" | buildkite-agent annotate --style error --context testcase-1234567890-arm-security-scan; fi',
@@ -296,8 +399,6 @@ class TestPipelineGeneration(TestCase):
         this.assertEqual(step["env"], {"DOCKER_BUILDKIT": "1"})
         this.assertEqual(step["key"], "build-and-push-build-push-arm")
 
-    @mock.patch("pipeline.CURRENT_BRANCH", "main")
-    @mock.patch("pipeline.CURRENT_TAG", "")
     def test_create_manifest_step(this):
         step = create_oci_manifest_step(this.config)
 
@@ -314,8 +415,6 @@ class TestPipelineGeneration(TestCase):
 
         this.assertNotIn("agent", step)
 
-    @mock.patch("pipeline.CURRENT_BRANCH", "main")
-    @mock.patch("pipeline.CURRENT_TAG", "")
     def test_create_manifest_step_mutate_tags(this):
         config = this.config.copy()
         config["mutate-image-tag"] = True
@@ -336,8 +435,6 @@ class TestPipelineGeneration(TestCase):
         this.assertNotIn("agent", step)
 
     @mock.patch.dict(os.environ, RUNTIME_ENVS)
-    @mock.patch("pipeline.CURRENT_BRANCH", "main")
-    @mock.patch("pipeline.CURRENT_TAG", "")
     def test_create_manifest_step_multi_arch(this):
         multi_arch_config = this.config.copy()
         multi_arch_config["build-x86"] = True
@@ -364,12 +461,9 @@ class TestPipelineGeneration(TestCase):
         os.environ,
         RUNTIME_ENVS | { "BUILDKITE_TAG": "v1.0.0", "BUILDKITE_BRANCH": "v1.0.0" }
     )
-    @mock.patch(
-        "pipeline.CURRENT_BRANCH", "v1.0.0"
-    )  # This is due to a BK "bug" where the branch is set to the tag name
-    @mock.patch("pipeline.CURRENT_TAG", "v1.0.0")
     def test_create_manifest_step_multi_arch_tag(this):
-        multi_arch_config = this.config.copy()
+        # The branch is set to the tag name due to a BK "bug"
+        multi_arch_config = this.tag_config.copy()
         multi_arch_config["build-x86"] = True
 
         step = create_oci_manifest_step(multi_arch_config)
@@ -392,8 +486,6 @@ class TestPipelineGeneration(TestCase):
 
 
     @mock.patch.dict(os.environ, RUNTIME_ENVS)
-    @mock.patch("pipeline.CURRENT_BRANCH", "main")
-    @mock.patch("pipeline.CURRENT_TAG", "")
     def test_create_build_step_additional_plugins(this):
         docker_login_plugin = {
             "docker-login#v3.0.0": {
@@ -410,5 +502,1593 @@ class TestPipelineGeneration(TestCase):
         expected_plugins = [{"CatchoftheDay/set-environment#v1.1.0": {}}, docker_login_plugin]
         this.assertEqual(step["plugins"], expected_plugins)
 
+    def test_process_config_explicit_environ(this):
+        config = process_config(this.RUNTIME_ENVS)
+
+        this.assertEqual(config, this.config)
+
+    def test_generate(this):
+        pipeline = generate(this.config)
+
+        this.assertEqual(len(pipeline["steps"]), 2)
+        this.assertEqual(pipeline["steps"][0]["key"], "build-and-push")
+        this.assertEqual(
+            [step["key"] for step in pipeline["steps"][0]["steps"]],
+            ["build-and-push-build-push-arm", "build-and-push-manifest"],
+        )
+        # Scans don't hold up anything depending on the build-and-push group
+        this.assertEqual(pipeline["steps"][1]["key"], "build-and-push-scan")
+        this.assertEqual(
+            [step["key"] for step in pipeline["steps"][1]["steps"]],
+            ["build-and-push-scan-arm"],
+        )
+        this.assertEqual(pipeline["steps"][0]["steps"][1]["depends_on"], ["build-and-push-build-push-arm"])
+
+    def test_generate_blocking_scan(this):
+        config = this.config | {"block-on-container-scan": True, "build-x86": True}
+        pipeline = generate(config)
+
+        this.assertEqual(len(pipeline["steps"]), 1)
+        this.assertEqual(
+            [step["key"] for step in pipeline["steps"][0]["steps"]],
+            [
+                "build-and-push-build-push-arm",
+                "build-and-push-build-push-x86",
+                "build-and-push-manifest",
+                "build-and-push-scan-arm",
+                "build-and-push-scan-x86",
+            ],
+        )
+        this.assertEqual(
+            pipeline["steps"][0]["steps"][2]["depends_on"],
+            [
+                "build-and-push-build-push-arm",
+                "build-and-push-build-push-x86",
+                "build-and-push-scan-arm",
+                "build-and-push-scan-x86",
+            ],
+        )
+
+    def test_generate_no_push_scans_inline(this):
+        config = this.config | {"push-to-ecr": False}
+        pipeline = generate(config)
+
+        this.assertEqual(len(pipeline["steps"]), 1)
+        this.assertIn(
+            "wizcli auth --id $$WIZ_CLIENT_ID --secret $$WIZ_CLIENT_SECRET",
+            pipeline["steps"][0]["steps"][0]["command"],
+        )
+
+    def test_generate_no_push(this):
+        config = this.config | {"push-to-ecr": False}
+        pipeline = generate(config)
+
+        this.assertEqual(
+            [step["key"] for step in pipeline["steps"][0]["steps"]],
+            ["build-and-push-build-push-arm"],
+        )
+
+    def test_write_pipeline_json(this):
+        pipeline = generate(this.config)
+        file = io.StringIO()
+
+        write_pipeline(pipeline, file, "json")
+
+        this.assertEqual(json.loads(file.getvalue()), pipeline)
+        # JSON output must remain loadable as a YAML pipeline
+        this.assertEqual(yaml.safe_load(file.getvalue()), pipeline)
+
+    def test_write_pipeline_yaml(this):
+        pipeline = generate(this.config)
+        file = io.StringIO()
+
+        write_pipeline(pipeline, file, "yaml")
+
+        this.assertEqual(yaml.safe_load(file.getvalue()), pipeline)
+
+    @mock.patch("pipeline.yaml", None)
+    def test_write_pipeline_yaml_without_pyyaml(this):
+        pipeline = generate(this.config)
+        file = io.StringIO()
+
+        with mock.patch("sys.stderr", io.StringIO()):
+            write_pipeline(pipeline, file, "yaml")
+
+        this.assertEqual(json.loads(file.getvalue()), pipeline)
+
+    def test_write_pipeline_unknown_format(this):
+        with this.assertRaises(ValueError):
+            write_pipeline({}, io.StringIO(), "toml")
+
+    def test_create_build_step_registry_cache(this):
+        config = this.config | {"cache-export": "registry"}
+        step = create_build_step("arm", "docker-arm", config)
+
+        this.assertEqual(
+            step["command"][1],
+            f"docker buildx build --load --pull --ssh default --secret id=GITHUB_TOKEN,env=GITHUB_TOKEN  --cache-from type=registry,ref=362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/testcase:cache_main-arm --cache-from type=registry,ref=362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/testcase:cache_master-arm --cache-from type=registry,ref=362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/testcase:cache_1234567890-arm --cache-to type=registry,ref=362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/testcase:cache_main-arm,mode=max,image-manifest=true,oci-mediatypes=true --build-arg arg1=42 --build-arg arg2 --build-arg BUILDKITE_COMMIT --build-arg BUILDKITE_JOB_ID --build-arg BUILD_DATE={BUILD_TIME}  --tag 362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/testcase:multi-platform-1234567890-arm -f Dockerfile .",
+        )
+
+    def test_create_build_step_registry_cache_min_mode_without_branch(this):
+        config = this.config | {"cache-export": "registry", "cache-export-mode": "min", "current-branch": ""}
+        step = create_build_step("x86", "docker", config)
+
+        this.assertIn(
+            " --cache-to type=registry,ref=362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/testcase:cache_1234567890-x86,mode=min,image-manifest=true,oci-mediatypes=true ",
+            step["command"][1],
+        )
+        this.assertNotIn("cache_-x86", step["command"][1])
+
+    def test_create_build_step_inline_cache(this):
+        config = this.config | {"cache-export": "inline"}
+        step = create_build_step("arm", "docker-arm", config)
+
+        this.assertIn(
+            "--cache-from type=registry,ref=362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/testcase:cache_1234567890 --cache-to type=inline --build-arg",
+            step["command"][1],
+        )
+
+    def test_create_manifest_step_registry_cache(this):
+        config = this.config | {"cache-export": "registry"}
+        step = create_oci_manifest_step(config)
+
+        this.assertEqual(
+            step["command"],
+            [
+                "docker buildx imagetools create -t 362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/testcase:1234567890 362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/testcase:multi-platform-1234567890-arm",
+            ],
+        )
+
+    def test_create_build_step_direct_push(this):
+        config = this.config | {"push-mode": "direct"}
+        step = create_build_step("arm", "docker-arm", config)
+
+        this.assertEqual(
+            step["command"],
+            [
+                f"docker buildx use builder || docker buildx create --bootstrap --name builder --use --driver docker-container --driver-opt image=moby/buildkit:{BUILDKIT_VERSION}",
+                f"docker buildx build --output type=image,push=true --metadata-file build-metadata-arm.json --pull --ssh default --secret id=GITHUB_TOKEN,env=GITHUB_TOKEN  --cache-from type=registry,ref=362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/testcase:cache_main --cache-from type=registry,ref=362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/testcase:cache_master --cache-from type=registry,ref=362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/testcase:cache_1234567890 --build-arg arg1=42 --build-arg arg2 --build-arg BUILDKITE_COMMIT --build-arg BUILDKITE_JOB_ID --build-arg BUILD_DATE={BUILD_TIME}  --tag 362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/testcase:multi-platform-1234567890-arm -f Dockerfile .",
+                "IMAGE_DIGEST=$$(grep -o '\"containerimage.digest\": *\"sha256:[0-9a-f]*\"' build-metadata-arm.json | grep -o 'sha256:[0-9a-f]*')",
+                "buildkite-agent meta-data set build-and-push-testcase-arm-image 362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/testcase@$$IMAGE_DIGEST",
+            ],
+        )
+
+    def test_create_build_step_push_without_scan(this):
+        # Nothing reads the digest meta-data without a scan step
+        config = this.config | {"scan-image": False}
+
+        step = create_build_step("arm", "docker-arm", config)
+        this.assertEqual(
+            step["command"][2:],
+            ["docker image push 362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/testcase:multi-platform-1234567890-arm"],
+        )
+
+        step = create_build_step("arm", "docker-arm", config | {"push-mode": "direct"})
+        this.assertTrue(step["command"][1].startswith("docker buildx build --output type=image,push=true --metadata-file build-metadata-arm.json "))
+        this.assertEqual(len(step["command"]), 2)
+
+    def test_create_build_step_direct_push_not_pushing(this):
+        config = this.config | {"push-mode": "direct", "push-to-ecr": False}
+
+        step = create_build_step("arm", "docker-arm", config)
+        this.assertTrue(step["command"][1].startswith("docker buildx build --load --pull "))
+
+        step = create_build_step("arm", "docker-arm", config | {"scan-image": False})
+        this.assertTrue(step["command"][1].startswith("docker buildx build --output type=cacheonly --pull "))
+        this.assertEqual(
+            step["command"][2:],
+            ['echo "Not pushing to ECR as branch not listed in push-branches"'],
+        )
+
+    def test_create_build_step_remote_builder(this):
+        config = this.config | {"remote-builders": {"arm": "tcp://buildkitd-arm:1234"}}
+        step = create_build_step("arm", "docker-arm", config)
+
+        builder = step["command"][0]
+        name = builder.split(" ")[3]
+        this.assertTrue(name.startswith("remote-arm-"))
+        this.assertEqual(
+            builder,
+            f"(docker buildx inspect {name} >/dev/null 2>&1 || docker buildx create --name {name} --driver remote tcp://buildkitd-arm:1234)"
+            f" && timeout 30 docker buildx inspect --bootstrap {name} >/dev/null 2>&1"
+            f" && docker buildx use {name}"
+            f' || (echo "Remote builder tcp://buildkitd-arm:1234 is unavailable, falling back to a local builder" && (docker buildx use builder || docker buildx create --bootstrap --name builder --use --driver docker-container --driver-opt image=moby/buildkit:{BUILDKIT_VERSION}))',
+        )
+
+        # Other platforms keep using a local builder
+        step = create_build_step("x86", "docker", config)
+        this.assertTrue(step["command"][0].startswith("docker buildx use builder || "))
+
+    def test_create_build_step_remote_builder_tls(this):
+        remote = {"endpoint": "tcp://buildkitd-arm:1234", "cacert": "/certs/ca.pem", "cert": "/certs/cert.pem", "key": "/certs/key.pem"}
+        step = create_build_step("arm", "docker-arm", this.config | {"remote-builders": {"arm": remote}})
+
+        this.assertIn(
+            " --driver remote --driver-opt cacert=/certs/ca.pem,cert=/certs/cert.pem,key=/certs/key.pem tcp://buildkitd-arm:1234)",
+            step["command"][0],
+        )
+
+        # A changed endpoint gets a builder of its own
+        other = create_build_step("arm", "docker-arm", this.config | {"remote-builders": {"arm": remote | {"endpoint": "tcp://other:1234"}}})
+        this.assertNotEqual(step["command"][0].split(" ")[3], other["command"][0].split(" ")[3])
+
+    @mock.patch.dict(
+        os.environ,
+        RUNTIME_ENVS | { "BUILDKITE_PLUGIN_CONFIGURATION": json.dumps({**BUILDKITE_PLUGIN_CONFIGURATION | {'cache-export': "local"}})}
+    )
+    def test_process_config_unknown_cache_export(this):
+        with this.assertRaises(ValueError):
+            process_config()
+
+
+class TestMultipleImages(TestCase):
+    RUNTIME_ENVS = TestPipelineGeneration.RUNTIME_ENVS | {
+        "BUILDKITE_PLUGIN_CONFIGURATION": json.dumps(
+            {
+                "build-args": "shared=1",
+                "build-arm": "true",
+                "build-x86": "true",
+                "images": [
+                    {"image-name": "api", "dockerfile-path": "api/Dockerfile", "context-path": "api"},
+                    {"image-name": "worker", "dockerfile-path": "worker/Dockerfile", "build-args": "queue=jobs", "npm-cache": "true"},
+                    {"image-name": "web", "context-path": "web", "additional-tag": "latest"},
+                ],
+            }
+        ),
+    }
+
+    def setUp(this):
+        # BUILD_DATE is stamped with the current time, pin it so expectations don't race a second boundary
+        patcher = mock.patch("time.time", return_value=BUILD_TIME)
+        patcher.start()
+        this.addCleanup(patcher.stop)
+
+    def test_process_config(this):
+        config = process_config(this.RUNTIME_ENVS)
+
+        this.assertEqual([image["image-name"] for image in config["images"]], ["api", "worker", "web"])
+        api, worker, web = config["images"]
+        this.assertEqual(api["dockerfile-path"], "api/Dockerfile")
+        this.assertEqual(api["context-path"], "api")
+        this.assertEqual(api["image-key"], "api")
+        this.assertEqual(api["build-args"][0], "shared=1")
+        this.assertEqual(worker["build-args"][0:2], ["queue=jobs", "BUILDKITE_COMMIT"])
+        this.assertTrue(worker["npm-cache"])
+        this.assertEqual(web["dockerfile-path"], "Dockerfile")
+        this.assertEqual(web["additional-tag"], "latest")
+        this.assertEqual(
+            web["fully-qualified-image-name"],
+            "362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/web",
+        )
+
+    def test_process_config_unknown_image_option(this):
+        environ = this.RUNTIME_ENVS | {
+            "BUILDKITE_PLUGIN_CONFIGURATION": json.dumps({"images": [{"image-name": "api", "push-branches": "main"}]})
+        }
+
+        with this.assertRaises(ValueError):
+            process_config(environ)
+
+    def test_process_config_duplicate_image_names(this):
+        environ = this.RUNTIME_ENVS | {
+            "BUILDKITE_PLUGIN_CONFIGURATION": json.dumps({"images": [{"image-name": "api"}, {"image-name": "api", "context-path": "other"}]})
+        }
+
+        with this.assertRaises(ValueError):
+            process_config(environ)
+
+    def test_generate_packs_images_per_platform(this):
+        config = process_config(this.RUNTIME_ENVS)
+        pipeline = generate(config)
+
+        steps = pipeline["steps"][0]["steps"]
+        this.assertEqual(
+            [step["key"] for step in steps],
+            ["build-and-push-build-push-arm", "build-and-push-build-push-x86", "build-and-push-manifest"],
+        )
+
+        arm = steps[0]
+        this.assertEqual(arm["label"], ":docker: Build and push arm images (api, worker, web)")
+        this.assertEqual(arm["agents"], {"queue": "docker-arm"})
+        this.assertEqual(
+            arm["command"][0:3],
+            [
+                'echo ".npm-cache" >> .dockerignore',
+                "mkdir -p .npm-cache",
+                f"docker buildx use builder || docker buildx create --bootstrap --name builder --use --driver docker-container --driver-opt image=moby/buildkit:{BUILDKIT_VERSION}",
+            ],
+        )
+        builds = [command for command in arm["command"] if command.startswith("docker buildx build")]
+        this.assertEqual(len(builds), 3)
+        this.assertTrue(builds[0].endswith("--tag 362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/api:multi-platform-1234567890-arm -f api/Dockerfile api"))
+        this.assertIn("--build-arg queue=jobs", builds[1])
+        this.assertIn("--build-context npm-cache=.npm-cache", builds[1])
+        this.assertTrue(builds[2].endswith("-f Dockerfile web"))
+        this.assertEqual(len([plugin for plugin in arm["plugins"] if "cache#v1.3.0" in plugin]), 1)
+
+        manifest = steps[2]
+        this.assertEqual(manifest["label"], ":docker: Create container manifests")
+        this.assertEqual(manifest["depends_on"], ["build-and-push-build-push-arm", "build-and-push-build-push-x86"])
+        this.assertEqual(
+            [command for command in manifest["command"] if " -t " in command and "cache_" not in command],
+            [
+                "docker buildx imagetools create -t 362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/api:1234567890 362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/api:multi-platform-1234567890-arm 362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/api:multi-platform-1234567890-x86",
+                "docker buildx imagetools create -t 362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/worker:1234567890 362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/worker:multi-platform-1234567890-arm 362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/worker:multi-platform-1234567890-x86",
+                "docker buildx imagetools create -t 362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/web:1234567890 362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/web:multi-platform-1234567890-arm 362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/web:multi-platform-1234567890-x86",
+                "docker buildx imagetools create -t 362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/web:latest 362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/web:multi-platform-1234567890-arm 362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/web:multi-platform-1234567890-x86",
+            ],
+        )
+
+        scans = pipeline["steps"][1]["steps"]
+        this.assertEqual(
+            [(step["key"], step["depends_on"]) for step in scans],
+            [
+                ("build-and-push-scan-api-arm", ["build-and-push-build-push-arm"]),
+                ("build-and-push-scan-worker-arm", ["build-and-push-build-push-arm"]),
+                ("build-and-push-scan-web-arm", ["build-and-push-build-push-arm"]),
+                ("build-and-push-scan-api-x86", ["build-and-push-build-push-x86"]),
+                ("build-and-push-scan-worker-x86", ["build-and-push-build-push-x86"]),
+                ("build-and-push-scan-web-x86", ["build-and-push-build-push-x86"]),
+            ],
+        )
+        this.assertEqual(scans[0]["command"][0], "IMAGE=$$(buildkite-agent meta-data get build-and-push-api-arm-image)")
+
+    def test_generate_images_per_job(this):
+        config = process_config(this.RUNTIME_ENVS) | {"images-per-job": 2, "build-x86": False}
+        config["images"] = [image | {"build-x86": False} for image in config["images"]]
+        pipeline = generate(config)
+
+        steps = pipeline["steps"][0]["steps"]
+        this.assertEqual(
+            [step["key"] for step in steps],
+            ["build-and-push-build-push-arm-1", "build-and-push-build-push-arm-2", "build-and-push-manifest"],
+        )
+        this.assertEqual(steps[1]["label"], ":docker: Build and push arm image")
+        this.assertEqual(steps[2]["depends_on"], ["build-and-push-build-push-arm-1", "build-and-push-build-push-arm-2"])
+        this.assertEqual(
+            [step["depends_on"] for step in pipeline["steps"][1]["steps"]],
+            [["build-and-push-build-push-arm-1"], ["build-and-push-build-push-arm-1"], ["build-and-push-build-push-arm-2"]],
+        )
+
+    def base_images_config(this):
+        directory = tempfile.TemporaryDirectory()
+        this.addCleanup(directory.cleanup)
+        dockerfiles = {
+            "api": "ARG BASE=362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/worker\nFROM ${BASE}:${BASE_TAG:-latest}\n",
+            "worker": "FROM 362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/web@sha256:abcd AS base\nFROM base\n",
+            "web": "FROM python:3.12\n",
+        }
+        config = process_config(this.RUNTIME_ENVS)
+        for image in config["images"]:
+            image["dockerfile-path"] = os.path.join(directory.name, image["image-name"])
+            with open(image["dockerfile-path"], "w", encoding="utf8") as file:
+                file.write(dockerfiles[image["image-name"]])
+        return config
+
+    def test_resolve_base_images(this):
+        config = this.base_images_config()
+        resolve_base_images(config, {})
+
+        api, worker, web = config["images"]
+        this.assertEqual(api["base-images"], {"362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/worker:latest": "worker"})
+        this.assertEqual(worker["base-images"], {"362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/web@sha256:abcd": "web"})
+        this.assertEqual(web["base-images"], {})
+        this.assertEqual(
+            [[image["image-key"] for image in level] for level in build_levels(config["images"])],
+            [["web"], ["worker"], ["api"]],
+        )
+
+    def test_resolve_base_images_cycle(this):
+        config = this.base_images_config()
+        with open(config["images"][2]["dockerfile-path"], "w", encoding="utf8") as file:
+            file.write("FROM 362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/api\n")
+
+        with mock.patch("sys.stderr", io.StringIO()) as stderr:
+            resolve_base_images(config, {})
+
+        this.assertIn("Images api, web, worker are built FROM each other", stderr.getvalue())
+        this.assertEqual([image["base-images"] for image in config["images"]], [{}, {}, {}])
+
+    def test_generate_orders_base_images(this):
+        config = this.base_images_config() | {"images-per-job": 0, "build-x86": False}
+        config["images"] = [image | {"build-x86": False} for image in config["images"]]
+        resolve_base_images(config, {"BASE_TAG": "unused"})
+        pipeline = generate(config)
+
+        steps = pipeline["steps"][0]["steps"]
+        this.assertEqual(
+            [(step["key"], step.get("depends_on")) for step in steps],
+            [
+                ("build-and-push-build-push-arm-1", None),
+                ("build-and-push-build-push-arm-2", ["build-and-push-build-push-arm-1"]),
+                ("build-and-push-build-push-arm-3", ["build-and-push-build-push-arm-2"]),
+                (
+                    "build-and-push-manifest",
+                    ["build-and-push-build-push-arm-1", "build-and-push-build-push-arm-2", "build-and-push-build-push-arm-3"],
+                ),
+            ],
+        )
+        this.assertEqual(steps[0]["label"], ":docker: Build and push arm image")
+        this.assertNotIn("docker-image://", steps[0]["command"][-2])
+        build = [command for command in steps[1]["command"] if command.startswith("docker buildx build")][0]
+        this.assertIn(
+            "--build-context 362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/web@sha256:abcd"
+            "=docker-image://362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/web:multi-platform-1234567890-arm",
+            build,
+        )
+
+    def test_generate_prebuilt_base_image(this):
+        config = this.base_images_config() | {"build-x86": False}
+        config["images"] = [image | {"build-x86": False} for image in config["images"]]
+        resolve_base_images(config, {})
+        config["images"][2]["prebuilt-images"] = ["362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/web:fingerprint-abcd"]
+        pipeline = generate(config)
+
+        # The reused base is pulled as it is, so worker doesn't wait on a build
+        steps = pipeline["steps"][0]["steps"]
+        this.assertEqual([step.get("depends_on") for step in steps[0:2]], [None, ["build-and-push-build-push-arm-1"]])
+        build = [command for command in steps[0]["command"] if command.startswith("docker buildx build")][0]
+        this.assertIn("=docker-image://362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/web:fingerprint-abcd ", build)
+
+    def test_generate_many_images(this):
+        plugin_config = {
+            "build-args": ",".join(f"ARG_{i}={i}" for i in range(50)),
+            "additional-plugins": [{f"example/plugin-{i}#v1.0.0": {"option": i}} for i in range(10)],
+            "images-per-job": 8,
+            "images": [{"image-name": f"service-{i}", "context-path": f"services/{i}"} for i in range(100)],
+        }
+        config = process_config(this.RUNTIME_ENVS | {"BUILDKITE_PLUGIN_CONFIGURATION": json.dumps(plugin_config)})
+        pipeline = generate(config)
+
+        steps = [step for group in pipeline["steps"] for step in group["steps"]]
+        keys = [step["key"] for step in steps]
+        this.assertEqual(len(keys), len(set(keys)))
+
+        builds = [step for step in steps if "-build-push-" in step["key"]]
+        # 100 images, 8 to a job, for each of the two platforms
+        this.assertEqual(len(builds), 2 * 13)
+        for platform in ["arm", "x86"]:
+            commands = "\n".join(command for step in builds if step["key"].endswith(tuple(f"-{platform}-{i}" for i in range(1, 14))) for command in step["command"])
+            for i in range(100):
+                this.assertEqual(commands.count(f"/catch/service-{i}:multi-platform-1234567890-{platform} "), 1)
+
+        manifest = next(step for step in steps if step["key"] == "build-and-push-manifest")
+        this.assertEqual(len([command for command in manifest["command"] if command.startswith("docker buildx imagetools create -t 362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/service-") and ":1234567890 " in command]), 100)
+        this.assertEqual(len(manifest["plugins"]), 10)
+
+
+class TestPackageCaches(TestCase):
+    def test_process_config_builtin_names(this):
+        config = process_plugin_config({"package-caches": "pip,go"})
+        this.assertEqual(
+            config["package-caches"],
+            [
+                {"name": "pip", "manifest": ["requirements.txt"], "path": ".pip-cache"},
+                {"name": "go", "manifest": ["go.sum"], "path": ".go-cache"},
+            ],
+        )
+
+    def test_process_config_definitions(this):
+        config = process_plugin_config(
+            {
+                "package-caches": [
+                    {"name": "poetry", "manifest": ["poetry.lock", "pyproject.toml"], "path": ".poetry-cache"},
+                    {"name": "gradle", "manifest": "gradle/libs.versions.toml"},
+                ]
+            }
+        )
+        this.assertEqual(
+            config["package-caches"],
+            [
+                {"name": "poetry", "manifest": ["poetry.lock", "pyproject.toml"], "path": ".poetry-cache"},
+                {"name": "gradle", "manifest": ["gradle/libs.versions.toml"], "path": ".gradle-cache"},
+            ],
+        )
+
+    def test_process_config_unknown_cache(this):
+        with this.assertRaisesRegex(ValueError, "Unknown package cache bundler"):
+            process_plugin_config({"package-caches": "pip,bundler"})
+        with this.assertRaisesRegex(ValueError, "missing manifest, path"):
+            process_plugin_config({"package-caches": [{"name": "bundler"}]})
+
+    def test_create_build_step(this):
+        config = TestPipelineGeneration.config | {
+            "npm-cache": True,
+            "package-caches": [
+                {"name": "cargo", "manifest": ["Cargo.lock"], "path": ".cargo-cache"},
+                {"name": "poetry", "manifest": ["poetry.lock", "pyproject.toml"], "path": ".poetry-cache"},
+            ],
+        }
+        step = create_build_step("arm", "docker-arm", config)
+
+        this.assertEqual(
+            step["command"][0:6],
+            [
+                'echo ".poetry-cache" >> .dockerignore',
+                "mkdir -p .poetry-cache",
+                'echo ".cargo-cache" >> .dockerignore',
+                "mkdir -p .cargo-cache",
+                'echo ".npm-cache" >> .dockerignore',
+                "mkdir -p .npm-cache",
+            ],
+        )
+        this.assertIn(
+            " --build-context npm-cache=.npm-cache --build-context cargo-cache=.cargo-cache --build-context poetry-cache=.poetry-cache --tag ",
+            step["command"][7],
+        )
+        this.assertEqual(
+            step["plugins"][1:],
+            [
+                {"cache#v1.3.0": {"backend": "s3", "manifest": "package-lock.json", "path": ".npm-cache", "restore": "file", "save": "pipeline"}},
+                {"cache#v1.3.0": {"backend": "s3", "manifest": "Cargo.lock", "path": ".cargo-cache", "restore": "file", "save": "pipeline"}},
+                {"cache#v1.3.0": {"backend": "s3", "manifest": ["poetry.lock", "pyproject.toml"], "path": ".poetry-cache", "restore": "file", "save": "pipeline"}},
+            ],
+        )
+
+    def test_gradle_cache_plugin_config(this):
+        config = TestPipelineGeneration.config | {"package-caches": process_plugin_config({"package-caches": "gradle"})["package-caches"]}
+        step = create_build_step("arm", "docker-arm", config)
+
+        this.assertEqual(
+            step["plugins"][1:],
+            [
+                {
+                    "cache#v1.3.0": {
+                        "backend": "s3",
+                        "manifest": ["build.gradle", "settings.gradle"],
+                        "path": ".gradle-cache",
+                        "restore": "file",
+                        "save": "pipeline",
+                    }
+                },
+            ],
+        )
+
+    def test_definition_overrides_boolean_option(this):
+        config = TestPipelineGeneration.config | {
+            "npm-cache": True,
+            "package-caches": [{"name": "npm", "manifest": ["package-lock.json", ".nvmrc"], "path": ".npm-cache"}],
+        }
+        step = create_build_step("arm", "docker-arm", config)
+
+        this.assertEqual(step["command"].count("mkdir -p .npm-cache"), 1)
+        this.assertEqual([plugin["cache#v1.3.0"]["manifest"] for plugin in step["plugins"][1:]], [["package-lock.json", ".nvmrc"]])
+
+
+class TestPlatforms(TestCase):
+    PLATFORMS = {
+        "linux/arm64/v8": "docker-arm",
+        "linux/amd64/v3": {"queue": "docker", "resource-class": "large", "build-args": "GOAMD64=v3"},
+        "linux/riscv64": {"queue": "docker-riscv", "name": "riscv"},
+    }
+
+    def test_process_config(this):
+        config = process_plugin_config({"platforms": this.PLATFORMS})
+        this.assertEqual(
+            config["platforms"],
+            [
+                {"name": "arm64-v8", "platform": "linux/arm64/v8", "queue": "docker-arm", "resource-class": None, "build-args": []},
+                {"name": "amd64-v3", "platform": "linux/amd64/v3", "queue": "docker", "resource-class": "large", "build-args": ["GOAMD64=v3"]},
+                {"name": "riscv", "platform": "linux/riscv64", "queue": "docker-riscv", "resource-class": None, "build-args": []},
+            ],
+        )
+
+    def test_process_config_invalid(this):
+        with this.assertRaisesRegex(ValueError, "Invalid platform arm64"):
+            process_plugin_config({"platforms": {"arm64": "docker-arm"}})
+        with this.assertRaisesRegex(ValueError, "missing a queue"):
+            process_plugin_config({"platforms": {"linux/arm64": {"resource-class": "large"}}})
+        with this.assertRaisesRegex(ValueError, "distinct name"):
+            process_plugin_config({"platforms": {"linux/arm64": "docker-arm", "linux/arm64/v8": {"queue": "docker-arm", "name": "arm64"}}})
+
+    def test_generate(this):
+        config = process_plugin_config({"platforms": this.PLATFORMS, "push-branches": "main", "scan-image": "false"})
+        steps = generate(config)["steps"][0]["steps"]
+
+        this.assertEqual(
+            [(step["key"], step.get("agents")) for step in steps],
+            [
+                ("build-and-push-build-push-arm64-v8", {"queue": "docker-arm"}),
+                ("build-and-push-build-push-amd64-v3", {"queue": "docker", "resource_class": "large"}),
+                ("build-and-push-build-push-riscv", {"queue": "docker-riscv"}),
+                ("build-and-push-manifest", None),
+            ],
+        )
+
+        build = steps[1]["command"][1]
+        this.assertIn("--pull --platform linux/amd64/v3 --ssh default", build)
+        this.assertIn("--build-arg BUILD_DATE", build)
+        this.assertIn(" --build-arg GOAMD64=v3 ", build)
+        this.assertNotIn("GOAMD64", steps[0]["command"][1])
+
+        this.assertEqual(steps[3]["depends_on"], [step["key"] for step in steps[0:3]])
+        this.assertEqual(
+            steps[3]["command"][0],
+            "docker buildx imagetools create -t 362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/testcase:1234567890"
+            " 362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/testcase:multi-platform-1234567890-arm64-v8"
+            " 362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/testcase:multi-platform-1234567890-amd64-v3"
+            " 362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/testcase:multi-platform-1234567890-riscv",
+        )
+
+    def test_platforms_replace_build_options(this):
+        config = process_plugin_config({"platforms": {"linux/amd64": "docker"}, "build-arm": "true"})
+        this.assertEqual(
+            [step["key"] for step in generate(config)["steps"][0]["steps"]],
+            ["build-and-push-build-push-amd64", "build-and-push-manifest"],
+        )
+
+
+class TestBuildContextAnalysis(TestCase):
+    def setUp(this):
+        directory = tempfile.TemporaryDirectory()
+        this.addCleanup(directory.cleanup)
+        files = {
+            "Dockerfile": "FROM python:3.12\nCOPY requirements.txt /app/\nCOPY src /app/src\n",
+            ".dockerignore": "*.log\n",
+            "requirements.txt": "x" * 100,
+            "src/main.py": "x" * 2000,
+            "fixtures/dump.sql": "x" * 3 * 1024 * 1024,
+            "debug.log": "x" * 5000,
+        }
+        for path, content in files.items():
+            os.makedirs(os.path.dirname(os.path.join(directory.name, path)), exist_ok=True)
+            with open(os.path.join(directory.name, path), "w", encoding="utf8") as file:
+                file.write(content)
+        this.config = TestPipelineGeneration.config | {
+            "dockerfile-path": os.path.join(directory.name, "Dockerfile"),
+            "context-path": directory.name,
+            "context-analysis": True,
+        }
+
+    def check(this, config):
+        with mock.patch("subprocess.run") as run:
+            result = check_build_context(config)
+        args, kwargs = run.call_args
+        return result, args[0], kwargs["input"]
+
+    def test_annotation(this):
+        result, command, annotation = this.check(this.config)
+
+        this.assertTrue(result)
+        this.assertEqual(command, ["buildkite-agent", "annotate", "--style", "info", "--context", "build-and-push-context-testcase"])
+        this.assertTrue(annotation.startswith("**Build context for testcase**: 3.0 MB in 5 files\n"))
+        this.assertIn("| `fixtures/dump.sql` | 3.0 MB |", annotation)
+        this.assertNotIn("debug.log", annotation)
+        this.assertIn("consider adding to `.dockerignore`:\n\n```\n/fixtures\n/Dockerfile\n```", annotation)
+
+    def test_over_budget_warns(this):
+        result, command, annotation = this.check(this.config | {"context-size-budget": 1})
+
+        this.assertTrue(result)
+        this.assertEqual(command[3], "warning")
+        this.assertIn("(budget 1.0 MB)", annotation)
+
+    def test_over_budget_fails(this):
+        result, command, _ = this.check(this.config | {"context-size-budget": 1, "context-budget-action": "fail"})
+
+        this.assertFalse(result)
+        this.assertEqual(command[3], "error")
+
+        result, command, _ = this.check(this.config | {"context-size-budget": 10, "context-budget-action": "fail"})
+        this.assertTrue(result)
+        this.assertEqual(command[3], "info")
+
+
+class TestBuildArgs(TestCase):
+    def setUp(this):
+        directory = tempfile.TemporaryDirectory()
+        this.addCleanup(directory.cleanup)
+        this.directory = directory.name
+        this.write("Dockerfile", "FROM alpine AS build\nARG arg1\nARG BUILD_DATE\nRUN make\nFROM alpine\nCOPY --from=build /out /\n")
+        this.config = TestPipelineGeneration.config | {
+            "dockerfile-path": os.path.join(this.directory, "Dockerfile"),
+            "context-path": this.directory,
+        }
+
+    def write(this, path, content):
+        with open(os.path.join(this.directory, path), "w", encoding="utf8") as file:
+            file.write(content)
+
+    def git(this, *args, date=None):
+        env = os.environ | ({"GIT_COMMITTER_DATE": date, "GIT_AUTHOR_DATE": date} if date else {})
+        subprocess.run(
+            ["git", "-c", "user.name=test", "-c", "user.email=test@example.com", *args],
+            cwd=this.directory, check=True, capture_output=True, env=env,
+        )
+
+    def test_undeclared_args_are_dropped(this):
+        config = this.config.copy()
+        with mock.patch("subprocess.run") as run:
+            resolve_build_args(config)
+
+        this.assertEqual(config["dockerfile-args"], ["BUILD_DATE", "arg1"])
+        this.assertEqual(
+            create_build_step("arm", "docker-arm", config)["command"][1].split(" --tag ")[0].split("env=GITHUB_TOKEN ")[1],
+            f" --cache-from type=registry,ref=362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/testcase:cache_main --cache-from type=registry,ref=362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/testcase:cache_master --cache-from type=registry,ref=362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/testcase:cache_1234567890 --build-arg arg1=42 --build-arg BUILD_DATE={BUILD_TIME} ",
+        )
+
+        # BUILD_DATE is declared in a stage, so it is reported
+        args, kwargs = run.call_args
+        this.assertEqual(args[0][0:4], ["buildkite-agent", "annotate", "--style", "warning"])
+        this.assertIn(f"- `ARG BUILD_DATE` in stage `build` (`{config['dockerfile-path']}:3`) invalidates the 1 instruction(s) after it", kwargs["input"])
+
+    def test_filter_disabled(this):
+        config = this.config | {"build-args-filter": False}
+        with mock.patch("subprocess.run"):
+            resolve_build_args(config)
+
+        this.assertIsNone(config["dockerfile-args"])
+        this.assertIn("--build-arg BUILDKITE_JOB_ID", create_build_step("arm", "docker-arm", config)["command"][1])
+
+    def test_reproducible_build_date(this):
+        this.git("init", "--quiet")
+        this.git("add", "Dockerfile")
+        this.git("commit", "--quiet", "-m", "add Dockerfile", date="1700000000 +0000")
+        os.mkdir(os.path.join(this.directory, "docs"))
+        this.write("docs/notes.md", "unrelated")
+        this.git("add", "docs")
+        this.git("commit", "--quiet", "-m", "unrelated change", date="1800000000 +0000")
+
+        config = this.config | {"reproducible-build-date": True, "context-path": os.path.join(this.directory, "Dockerfile")}
+        with mock.patch("sys.stderr", io.StringIO()):
+            resolve_build_args(config)
+
+        this.assertEqual(config["source-date-epoch"], "1700000000")
+        command = create_build_step("arm", "docker-arm", config)["command"][1]
+        this.assertIn(" --build-arg BUILD_DATE=1700000000 --build-arg SOURCE_DATE_EPOCH=1700000000 ", command)
+
+
+class TestSecrets(TestCase):
+    RUNTIME_ENVS = {
+        "BUILDKITE_PIPELINE_NAME": "testcase",
+        "BUILDKITE_COMMIT": "1234567890abcdef",
+        "BUILDKITE_BRANCH": "main",
+    }
+
+    def command(this, config):
+        return create_build_step("arm", "docker-arm", config)["command"][1]
+
+    def test_secret_mounts(this):
+        config = process_config(
+            this.RUNTIME_ENVS | {"BUILDKITE_PLUGIN_CONFIGURATION": json.dumps({"secrets": "GITHUB_TOKEN,npm=NPM_TOKEN"})}
+        )
+
+        this.assertNotIn("GITHUB_TOKEN", config["build-args"])
+        this.assertIn(
+            " --ssh default --secret id=GITHUB_TOKEN,env=GITHUB_TOKEN --secret id=npm,env=NPM_TOKEN ",
+            this.command(config),
+        )
+
+    def test_no_secrets(this):
+        config = process_config(this.RUNTIME_ENVS | {"BUILDKITE_PLUGIN_CONFIGURATION": json.dumps({"secrets": ""})})
+
+        this.assertNotIn("--secret", this.command(config))
+
+    def test_secrets_as_build_args(this):
+        config = process_config(
+            this.RUNTIME_ENVS
+            | {"BUILDKITE_PLUGIN_CONFIGURATION": json.dumps({"secrets": "GITHUB_TOKEN,npm=NPM_TOKEN", "secrets-as-build-args": True})}
+        )
+
+        command = this.command(config)
+        this.assertIn(" --secret id=GITHUB_TOKEN,env=GITHUB_TOKEN --secret id=npm,env=NPM_TOKEN ", command)
+        this.assertIn(" --build-arg GITHUB_TOKEN --build-arg npm=$$NPM_TOKEN ", command)
+
+    def test_secrets_per_image(this):
+        config = process_config(
+            this.RUNTIME_ENVS
+            | {
+                "BUILDKITE_PLUGIN_CONFIGURATION": json.dumps(
+                    {"images": [{"image-name": "api"}, {"image-name": "legacy", "secrets-as-build-args": True}]}
+                )
+            }
+        )
+
+        api, legacy = config["images"]
+        this.assertNotIn("GITHUB_TOKEN", api["build-args"])
+        this.assertIn("GITHUB_TOKEN", legacy["build-args"])
+
+    def test_secrets_left_out_of_fingerprint(this):
+        with tempfile.TemporaryDirectory() as directory:
+            with open(os.path.join(directory, "Dockerfile"), "w", encoding="utf8") as file:
+                file.write("FROM alpine\n")
+            config = TestPipelineGeneration.config | {
+                "dockerfile-path": os.path.join(directory, "Dockerfile"),
+                "context-path": directory,
+                "secrets": ["npm=NPM_TOKEN"],
+                "build-args": ["npm=$$NPM_TOKEN"],
+            }
+
+            this.assertEqual(
+                build_fingerprint(config, {"NPM_TOKEN": "old"}),
+                build_fingerprint(config | {"build-args": []}, {"NPM_TOKEN": "new"}),
+            )
+
+    def test_declared_secret_args_are_annotated(this):
+        with tempfile.TemporaryDirectory() as directory:
+            with open(os.path.join(directory, "Dockerfile"), "w", encoding="utf8") as file:
+                file.write("FROM alpine\nARG GITHUB_TOKEN\nRUN composer install\n")
+            config = TestPipelineGeneration.config | {"dockerfile-path": os.path.join(directory, "Dockerfile")}
+
+            with mock.patch("subprocess.run") as run:
+                resolve_build_args(config)
+            this.assertIn("- `ARG GITHUB_TOKEN`", run.call_args.kwargs["input"])
+            this.assertNotIn("invalidate", run.call_args.kwargs["input"])
+
+            with mock.patch("subprocess.run") as run:
+                resolve_build_args(config | {"secrets-as-build-args": True})
+            this.assertIn("`ARG GITHUB_TOKEN` in stage `0`", run.call_args.kwargs["input"])
+
+
+class TestUnchangedBuilds(TestCase):
+    config = TestPipelineGeneration.config | {"skip-unchanged-builds": True}
+
+    def setUp(this):
+        directory = tempfile.TemporaryDirectory()
+        this.addCleanup(directory.cleanup)
+        with open(os.path.join(directory.name, "Dockerfile"), "w", encoding="utf8") as file:
+            file.write("FROM scratch\nCOPY . /app\n")
+        with open(os.path.join(directory.name, "app.py"), "w", encoding="utf8") as file:
+            file.write("print('hello')\n")
+        this.config = this.config | {
+            "dockerfile-path": os.path.join(directory.name, "Dockerfile"),
+            "context-path": directory.name,
+        }
+        this.directory = directory.name
+
+    def test_fingerprint_ignores_volatile_build_args(this):
+        first = build_fingerprint(this.config, {})
+        second = build_fingerprint(
+            this.config | {"build-args": ["arg1=42", "arg2", "BUILDKITE_JOB_ID", "BUILD_DATE=1"]},
+            {},
+        )
+
+        this.assertEqual(first, second)
+
+    def test_fingerprint_changes_with_inputs(this):
+        first = build_fingerprint(this.config, {})
+
+        this.assertNotEqual(first, build_fingerprint(this.config, {"arg2": "changed"}))
+        this.assertNotEqual(first, build_fingerprint(this.config | {"build-x86": True}, {}))
+
+        with open(os.path.join(this.directory, "app.py"), "a", encoding="utf8") as file:
+            file.write("print('world')\n")
+        this.assertNotEqual(first, build_fingerprint(this.config, {}))
+
+    def test_resolve_unchanged_build_hit(this):
+        config = this.config.copy()
+        fingerprint = build_fingerprint(config, os.environ)
+
+        with FakeRegistry() as registry, mock.patch("sys.stderr", io.StringIO()):
+            registry.put_manifest("catch/testcase", f"fingerprint-{fingerprint[0:32]}", {"schemaVersion": 2})
+            resolve_unchanged_build(config, RegistryClient(registry.host, secure=False))
+
+        this.assertEqual(config["fingerprint"], fingerprint)
+        this.assertEqual(
+            config["prebuilt-images"],
+            [f"362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/testcase:fingerprint-{fingerprint[0:32]}"],
+        )
+
+        pipeline = generate(config)
+        steps = pipeline["steps"][0]["steps"]
+        this.assertEqual([step["key"] for step in steps], ["build-and-push-manifest"])
+        this.assertEqual(steps[0]["depends_on"], [])
+        this.assertEqual(
+            steps[0]["command"],
+            [
+                f"docker buildx imagetools create -t 362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/testcase:1234567890 362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/testcase:fingerprint-{fingerprint[0:32]}",
+                "aws ecr batch-delete-image --registry-id 362995399210 --repository-name catch/testcase --image-ids imageTag=cache_main || true",
+                f"docker buildx imagetools create -t 362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/testcase:cache_main 362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/testcase:fingerprint-{fingerprint[0:32]}",
+            ],
+        )
+
+    def test_resolve_unchanged_build_miss(this):
+        config = this.config.copy()
+
+        with FakeRegistry() as registry:
+            resolve_unchanged_build(config, RegistryClient(registry.host, secure=False))
+
+        this.assertEqual(config["prebuilt-images"], [])
+
+        pipeline = generate(config)
+        steps = pipeline["steps"][0]["steps"]
+        this.assertEqual(
+            [step["key"] for step in steps],
+            ["build-and-push-build-push-arm", "build-and-push-manifest"],
+        )
+        this.assertEqual(
+            steps[1]["command"][-1],
+            f"docker buildx imagetools create -t 362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/testcase:fingerprint-{config['fingerprint'][0:32]} 362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/testcase:multi-platform-1234567890-arm || true",
+        )
+
+    def test_resolve_unchanged_build_registry_unavailable(this):
+        config = this.config.copy()
+
+        with FakeRegistry() as registry:
+            host = registry.host
+
+        with mock.patch("sys.stderr", io.StringIO()):
+            resolve_unchanged_build(config, RegistryClient(host, secure=False))
+
+        this.assertIsNotNone(config["fingerprint"])
+        this.assertEqual(config["prebuilt-images"], [])
+
+
+class TestCacheSources(TestCase):
+    config = TestPipelineGeneration.config | {"current-branch": "feature/thing"}
+    registry = "362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/testcase"
+
+    def cache_from(this, config, platform="arm"):
+        command = create_build_step(platform, "docker-arm", config)["command"][1]
+        return [part.split("ref=")[1] for part in command.split(" ") if part.startswith("type=registry,ref=")]
+
+    def test_cache_from_order(this):
+        config = this.config | {"pull-request-base-branch": "develop", "cache-from-branches": ["main"]}
+        this.assertEqual(
+            this.cache_from(config),
+            [f"{this.registry}:cache_feature-thing", f"{this.registry}:cache_develop", f"{this.registry}:cache_main", f"{this.registry}:cache_1234567890"],
+        )
+
+    def test_cache_from_limit(this):
+        config = this.config | {"pull-request-base-branch": "main", "cache-ancestor": "abcdef", "cache-from-limit": 3}
+        this.assertEqual(
+            this.cache_from(config),
+            [f"{this.registry}:cache_feature-thing", f"{this.registry}:cache_main", f"{this.registry}:cache_abcdef"],
+        )
+
+    def test_cache_from_limit_keeps_default_branch(this):
+        # The image tag's cache is only exported by builds without a branch, it gives way to the default branch
+        config = this.config | {"pull-request-base-branch": "develop", "cache-ancestor": "abcdef", "cache-from-branches": ["main"]}
+        this.assertEqual(
+            this.cache_from(config),
+            [f"{this.registry}:cache_feature-thing", f"{this.registry}:cache_develop", f"{this.registry}:cache_abcdef", f"{this.registry}:cache_main"],
+        )
+
+    @mock.patch.dict(
+        os.environ,
+        TestPipelineGeneration.RUNTIME_ENVS | {"BUILDKITE_PIPELINE_DEFAULT_BRANCH": "trunk", "BUILDKITE_PULL_REQUEST_BASE_BRANCH": "false"},
+    )
+    def test_process_config_default_branch(this):
+        config = process_config()
+        this.assertEqual(config["cache-from-branches"], ["trunk"])
+        this.assertEqual(config["pull-request-base-branch"], "")
+
+    def test_registry_cache_exports_commit(this):
+        config = this.config | {"cache-export": "registry", "cache-from-ancestors": 10, "cache-ancestor": "abcdef"}
+        command = create_build_step("arm", "docker-arm", config)["command"][1]
+
+        this.assertIn(f" --cache-from type=registry,ref={this.registry}:cache_abcdef-arm ", command)
+        this.assertIn(
+            f" --cache-to type=registry,ref={this.registry}:cache_feature-thing-arm,mode=max,image-manifest=true,oci-mediatypes=true"
+            f" --cache-to type=registry,ref={this.registry}:cache_123456789010-arm,mode=max,image-manifest=true,oci-mediatypes=true ",
+            command,
+        )
+
+    def test_manifest_step_tags_commit_cache(this):
+        step = create_oci_manifest_step(this.config | {"cache-from-ancestors": 10})
+        this.assertEqual(
+            step["command"][-1],
+            f"docker buildx imagetools create -t {this.registry}:cache_123456789010 {this.registry}:multi-platform-1234567890-arm || true",
+        )
+
+    def test_resolve_cache_ancestor(this):
+        config = this.config | {"cache-export": "registry", "cache-from-ancestors": 10, "build-x86": True}
+
+        with FakeRegistry() as registry:
+            registry.put_manifest("catch/testcase", "cache_bbbb-arm", {})
+            registry.put_manifest("catch/testcase", "cache_cccc-arm", {})
+            registry.put_manifest("catch/testcase", "cache_cccc-x86", {})
+            resolve_cache_ancestor(config, RegistryClient(registry.host, secure=False), ["aaaa", "bbbb", "cccc", "dddd"])
+
+        # bbbb only has cache for one of the platforms being built
+        this.assertEqual(config["cache-ancestor"], "cccc")
+
+    def test_resolve_cache_ancestor_registry_unavailable(this):
+        config = this.config | {"cache-from-ancestors": 10}
+
+        with FakeRegistry() as registry:
+            host = registry.host
+
+        with mock.patch("sys.stderr", io.StringIO()):
+            resolve_cache_ancestor(config, RegistryClient(host, secure=False), ["aaaa"])
+
+        this.assertIsNone(config["cache-ancestor"])
+
+    def test_ancestor_commits(this):
+        with tempfile.TemporaryDirectory() as directory:
+            def git(*args):
+                return subprocess.run(
+                    ["git", "-c", "user.name=test", "-c", "user.email=test@example.com", *args],
+                    cwd=directory, check=True, capture_output=True, text=True,
+                ).stdout.strip()
+
+            git("init", "--quiet")
+            for message in ["one", "two", "three"]:
+                git("commit", "--quiet", "--allow-empty", "-m", message)
+
+            this.assertEqual(ancestor_commits(5, directory), [git("rev-parse", "HEAD~1"), git("rev-parse", "HEAD~2")])
+            this.assertEqual(ancestor_commits(1, directory), [git("rev-parse", "HEAD~1")])
+
+
+class TestPromotion(TestCase):
+    config = TestPipelineGeneration.config | {
+        "promote-tag-builds": True,
+        "build-x86": True,
+        "current-branch": "v1.0.0",
+        "current-tag": "v1.0.0",
+        "additional-tag": "v1.0.0",
+    }
+    registry = "362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/testcase"
+
+    def test_promote_existing_images(this):
+        config = this.config.copy()
+
+        with FakeRegistry() as registry, mock.patch("sys.stderr", io.StringIO()):
+            registry.put_manifest("catch/testcase", "multi-platform-1234567890-arm", {"schemaVersion": 2})
+            registry.put_manifest("catch/testcase", "multi-platform-1234567890-x86", {"schemaVersion": 2})
+            resolve_promotion(config, RegistryClient(registry.host, secure=False))
+
+        images = f"{this.registry}:multi-platform-1234567890-arm {this.registry}:multi-platform-1234567890-x86"
+        steps = generate(config)["steps"]
+        # No build or scan steps, only the tags are created
+        this.assertEqual(len(steps), 1)
+        this.assertEqual([step["key"] for step in steps[0]["steps"]], ["build-and-push-manifest"])
+        this.assertEqual(steps[0]["steps"][0]["depends_on"], [])
+        this.assertEqual(
+            steps[0]["steps"][0]["command"][0:2],
+            [
+                f"docker buildx imagetools create -t {this.registry}:1234567890 {images}",
+                f"docker buildx imagetools create -t {this.registry}:v1.0.0 {images}",
+            ],
+        )
+
+    def test_build_when_a_platform_is_missing(this):
+        config = this.config.copy()
+
+        with FakeRegistry() as registry, mock.patch("sys.stderr", io.StringIO()) as stderr:
+            registry.put_manifest("catch/testcase", "multi-platform-1234567890-arm", {"schemaVersion": 2})
+            resolve_promotion(config, RegistryClient(registry.host, secure=False))
+
+        this.assertEqual(config["prebuilt-images"], [])
+        this.assertIn(f"No existing image for {this.registry}:multi-platform-1234567890-x86", stderr.getvalue())
+        this.assertEqual(
+            [step["key"] for step in generate(config)["steps"][0]["steps"]],
+            ["build-and-push-build-push-arm", "build-and-push-build-push-x86", "build-and-push-manifest"],
+        )
+
+    def test_registry_unavailable(this):
+        config = this.config.copy()
+
+        with FakeRegistry() as registry:
+            host = registry.host
+
+        with mock.patch("sys.stderr", io.StringIO()):
+            resolve_promotion(config, RegistryClient(host, secure=False))
+
+        this.assertEqual(config["prebuilt-images"], [])
+
+
+class TestCompression(TestCase):
+    config = TestPipelineGeneration.config | {"push-mode": "direct", "compression": "zstd", "compression-level": 3}
+    image = "362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/testcase"
+
+    def test_build_output(this):
+        command = create_build_step("arm", "docker-arm", this.config)["command"][1]
+
+        this.assertIn(
+            " --output type=image,push=true,compression=zstd,oci-mediatypes=true,compression-level=3 --metadata-file build-metadata-arm.json ",
+            command,
+        )
+
+    def test_force_compression(this):
+        command = create_build_step("arm", "docker-arm", this.config | {"compression": "estargz", "compression-level": 0, "force-compression": True})["command"][1]
+
+        this.assertIn(" --output type=image,push=true,compression=estargz,oci-mediatypes=true,force-compression=true ", command)
+
+    def test_default_compression(this):
+        command = create_build_step("arm", "docker-arm", this.config | {"compression": "gzip", "compression-level": 0})["command"][1]
+
+        this.assertIn(" --output type=image,push=true --metadata-file ", command)
+
+    def test_needs_direct_push(this):
+        environ = TestPipelineGeneration.RUNTIME_ENVS | {
+            "BUILDKITE_PLUGIN_CONFIGURATION": json.dumps({"compression": "zstd"}),
+        }
+        with this.assertRaisesRegex(ValueError, "compression zstd needs push-mode direct"):
+            process_config(environ)
+        with this.assertRaisesRegex(ValueError, "Unknown compression lz4"):
+            process_config(environ | {"BUILDKITE_PLUGIN_CONFIGURATION": json.dumps({"compression": "lz4", "push-mode": "direct"})})
+        with this.assertRaisesRegex(ValueError, "compression-level needs push-mode direct"):
+            process_config(environ | {"BUILDKITE_PLUGIN_CONFIGURATION": json.dumps({"compression-level": 9})})
+        with this.assertRaisesRegex(ValueError, "force-compression needs push-mode direct"):
+            process_config(environ | {"BUILDKITE_PLUGIN_CONFIGURATION": json.dumps({"force-compression": True, "push-mode": "load"})})
+
+    def test_gzip_variant_of_gzip(this):
+        environ = TestPipelineGeneration.RUNTIME_ENVS | {
+            "BUILDKITE_PLUGIN_CONFIGURATION": json.dumps({"gzip-variant": True}),
+        }
+        with mock.patch("sys.stderr", io.StringIO()) as stderr:
+            process_config(environ)
+
+        this.assertIn("gzip-variant has no effect when compression is gzip", stderr.getvalue())
+
+    def test_gzip_variant(this):
+        config = this.config | {"gzip-variant": True, "additional-tag": "latest"}
+
+        command = create_build_step("arm", "docker-arm", config)["command"]
+        # The gzip copy is built from the same inputs once the image is pushed and recorded, without exporting cache again
+        build, variant = command[1], command[-1]
+        this.assertEqual(variant.split(" --pull ")[1], build.split(" --pull ")[1].replace("multi-platform-1234567890-arm", "multi-platform-1234567890-arm-gzip"))
+        this.assertTrue(variant.startswith("docker buildx build --output type=image,push=true,compression=gzip,force-compression=true --pull "))
+
+        manifest = create_oci_manifest_step(config)["command"]
+        this.assertEqual(
+            manifest[-2:],
+            [
+                f"docker buildx imagetools create -t {this.image}:1234567890-gzip {this.image}:multi-platform-1234567890-arm-gzip",
+                f"docker buildx imagetools create -t {this.image}:latest-gzip {this.image}:multi-platform-1234567890-arm-gzip",
+            ],
+        )
+
+        step = create_oci_manifest_step(config | {"manifest-client": "registry", "plugin-ref": TestManifestClient.ref})
+        specs = step["plugins"][0][TestManifestClient.ref]["manifest"]
+        this.assertEqual([spec["sources"] for spec in specs], [["multi-platform-1234567890-arm"], ["multi-platform-1234567890-arm-gzip"]])
+
+    def test_fingerprint_includes_compression(this):
+        with tempfile.TemporaryDirectory() as directory:
+            with open(os.path.join(directory, "Dockerfile"), "w", encoding="utf8") as file:
+                file.write("FROM alpine\n")
+            config = TestPipelineGeneration.config | {"dockerfile-path": f"{directory}/Dockerfile", "context-path": directory}
+
+            this.assertNotEqual(build_fingerprint(config, {}), build_fingerprint(config | {"compression": "zstd"}, {}))
+
+
+class TestScanCache(TestCase):
+    config = TestPipelineGeneration.config | {"scan-cache": "local"}
+
+    def setUp(this):
+        directory = tempfile.TemporaryDirectory()
+        this.addCleanup(directory.cleanup)
+        this.directory = directory.name
+        this.cache = os.path.join(this.directory, "cache")
+        bin_directory = os.path.join(this.directory, "bin")
+        os.mkdir(bin_directory)
+        stubs = {
+            "docker": 'echo "docker $*" >> calls.log',
+            "wizcli": 'echo "wizcli $*" >> calls.log; [[ "$1" == "auth" ]] && exit 0; echo "2 findings"; exit "${WIZ_STATUS:-0}"',
+            "buildkite-agent": 'echo "buildkite-agent $*" >> calls.log; [[ "$1" == "meta-data" ]] && echo "registry/catch/testcase@sha256:abcd"; cat > /dev/null',
+        }
+        for name, body in stubs.items():
+            path = os.path.join(bin_directory, name)
+            with open(path, "w", encoding="utf8") as file:
+                file.write(f"#!/bin/bash\n{body}\n")
+            os.chmod(path, 0o755)
+        this.environ = {"PATH": f'{bin_directory}:{os.environ["PATH"]}', "HOME": this.directory}
+
+    def run_step(this, config, **environ):
+        """Run the scan step's commands the way the agent does, returning the exit status and the commands it ran"""
+        workdir = tempfile.mkdtemp(dir=this.directory)
+        # Buildkite interpolation turns $$ into $ before the agent runs the script
+        script = "\n".join(create_scan_step("arm", "docker-arm", config)["command"]).replace("$$", "$")
+        result = subprocess.run(["bash", "-e", "-c", script], cwd=workdir, env=this.environ | environ, capture_output=True, text=True, check=False)
+        with open(os.path.join(workdir, "calls.log"), encoding="utf8") as file:
+            return result.returncode, [call.split(" ")[0:2] for call in file.read().splitlines()], result.stdout
+
+    def test_reuses_scan_of_digest(this):
+        config = this.config | {"scan-cache-location": this.cache}
+
+        status, calls, _ = this.run_step(config)
+        this.assertEqual(status, 0)
+        this.assertIn(["docker", "pull"], calls)
+        this.assertIn(["wizcli", "docker"], calls)
+        with open(os.path.join(this.cache, "sha256:abcd", "status"), encoding="utf8") as file:
+            this.assertEqual(file.read().strip(), "0")
+
+        status, calls, stdout = this.run_step(config)
+        this.assertEqual(status, 0)
+        this.assertEqual(calls, [["buildkite-agent", "meta-data"]])
+        this.assertIn("Reusing the scan of sha256:abcd", stdout)
+
+    def test_reuses_findings(this):
+        config = this.config | {"scan-cache-location": this.cache, "block-on-container-scan": True}
+
+        this.assertEqual(this.run_step(config, WIZ_STATUS="4")[0], 4)
+        status, calls, _ = this.run_step(config)
+
+        # The findings are annotated and block the build again without scanning
+        this.assertEqual(status, 4)
+        this.assertEqual(calls, [["buildkite-agent", "meta-data"], ["buildkite-agent", "annotate"]])
+
+    def test_errors_are_not_cached(this):
+        config = this.config | {"scan-cache-location": this.cache}
+
+        this.run_step(config, WIZ_STATUS="3")
+        _, calls, _ = this.run_step(config)
+
+        this.assertIn(["wizcli", "docker"], calls)
+
+    def test_expired_results_are_rescanned(this):
+        config = this.config | {"scan-cache-location": this.cache, "scan-cache-ttl": 0}
+
+        this.run_step(config)
+        _, calls, _ = this.run_step(config)
+
+        this.assertIn(["wizcli", "docker"], calls)
+
+    def test_default_location(this):
+        this.run_step(this.config)
+
+        this.assertTrue(os.path.exists(os.path.join(this.directory, ".cache", "build-and-push", "scans", "sha256:abcd", "scanned_at")))
+
+    def test_unpushed_images_are_keyed_by_id(this):
+        step = create_build_step("arm", "docker-arm", this.config | {"push-to-ecr": False})
+
+        this.assertIn("SCAN_KEY=$$(docker image inspect --format '{{.Id}}' 362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/testcase:multi-platform-1234567890-arm)", step["command"])
+
+    def test_s3_location(this):
+        environ = TestPipelineGeneration.RUNTIME_ENVS | {"BUILDKITE_PLUGIN_CONFIGURATION": json.dumps({"scan-cache": "s3"})}
+        with this.assertRaisesRegex(ValueError, "scan-cache s3 needs an s3:// scan-cache-location"):
+            process_config(environ)
+
+        step = create_scan_step("arm", "docker-arm", this.config | {"scan-cache": "s3", "scan-cache-location": "s3://scans/catch"})
+        this.assertTrue(any('aws s3 cp --recursive --quiet "s3://scans/catch/$$SCAN_KEY" scan-cache' in command for command in step["command"]))
+
+
+class TestBuildkitdConfig(TestCase):
+    config = TestPipelineGeneration.config | {
+        "buildkitd-gc-keep-storage": 20000,
+        "buildkitd-gc-keep-duration": 72,
+        "buildkitd-registry-mirrors": {"docker.io": ["mirror.gcr.io"]},
+        "buildkitd-max-parallelism": 4,
+    }
+
+    def test_buildkitd_config(this):
+        this.assertEqual(buildkitd_config(TestPipelineGeneration.config), "")
+        this.assertEqual(
+            buildkitd_config(this.config),
+            "\n".join(
+                [
+                    "[worker.oci]",
+                    "  max-parallelism = 4",
+                    "  gc = true",
+                    "  [[worker.oci.gcpolicy]]",
+                    "    all = true",
+                    "    keepDuration = 259200",
+                    "  [[worker.oci.gcpolicy]]",
+                    "    all = true",
+                    "    keepBytes = 20971520000",
+                    '[registry."docker.io"]',
+                    '  mirrors = ["mirror.gcr.io"]',
+                ]
+            ),
+        )
+
+    def test_mirrors_option(this):
+        environ = TestPipelineGeneration.RUNTIME_ENVS | {
+            "BUILDKITE_PLUGIN_CONFIGURATION": json.dumps({"buildkitd-registry-mirrors": {"docker.io": "mirror.gcr.io"}}),
+        }
+        this.assertEqual(process_config(environ)["buildkitd-registry-mirrors"], {"docker.io": ["mirror.gcr.io"]})
+
+        with this.assertRaisesRegex(ValueError, "buildkitd-registry-mirrors"):
+            process_config(environ | {"BUILDKITE_PLUGIN_CONFIGURATION": json.dumps({"buildkitd-registry-mirrors": ["mirror.gcr.io"]})})
+
+    def test_builder_is_recreated_when_config_changes(this):
+        builder = builder_command("arm", this.config)
+        name = builder.split(" ")[3]
+
+        this.assertTrue(name.startswith("builder-"))
+        this.assertTrue(builder.startswith(f"docker buildx use {name} || (printf "))
+        this.assertTrue(builder.endswith(f' --config $${{TMPDIR:-/tmp}}/{name}.toml)'))
+        other = builder_command("arm", this.config | {"buildkitd-max-parallelism": 8})
+        this.assertNotEqual(other.split(" ")[3], name)
+        # The default settings keep the builder existing agents already have
+        this.assertTrue(builder_command("arm", TestPipelineGeneration.config).startswith("docker buildx use builder || "))
+
+    @skipUnless(tomllib, "tomllib needs Python 3.11")
+    def test_config_file(this):
+        with tempfile.TemporaryDirectory() as directory:
+            bin_directory = os.path.join(directory, "bin")
+            os.mkdir(bin_directory)
+            with open(os.path.join(bin_directory, "docker"), "w", encoding="utf8") as file:
+                file.write(f'#!/bin/bash\n[[ "$2" == "use" ]] && exit 1\necho "$*" > {directory}/docker.log\n')
+            os.chmod(os.path.join(bin_directory, "docker"), 0o755)
+
+            # Buildkite interpolation turns $$ into $ before the agent runs the command
+            command = builder_command("arm", this.config).replace("$$", "$")
+            subprocess.run(["bash", "-e", "-c", command], env={"PATH": f'{bin_directory}:{os.environ["PATH"]}', "TMPDIR": directory}, check=True)
+
+            name = command.split(" ")[3]
+            with open(os.path.join(directory, f"{name}.toml"), "rb") as file:
+                written = tomllib.load(file)
+            with open(os.path.join(directory, "docker.log"), encoding="utf8") as file:
+                this.assertTrue(file.read().strip().endswith(f"--config {directory}/{name}.toml"))
+
+        this.assertEqual(written["worker"]["oci"]["max-parallelism"], 4)
+        this.assertEqual([policy.get("keepBytes") for policy in written["worker"]["oci"]["gcpolicy"]], [None, 20971520000])
+        this.assertEqual(written["registry"]["docker.io"]["mirrors"], ["mirror.gcr.io"])
+
+
+    def test_stale_builders_removed(this):
+        name = builder_command("arm", this.config).split(" ")[3]
+        with tempfile.TemporaryDirectory() as directory:
+            bin_directory = os.path.join(directory, "bin")
+            os.mkdir(bin_directory)
+            with open(os.path.join(bin_directory, "docker"), "w", encoding="utf8") as file:
+                file.write(
+                    f'#!/bin/bash\n[[ "$2" == "use" ]] && exit 1\n'
+                    f'[[ "$2" == "ls" ]] && printf "default\\nbuilder\\nbuilder-0badf00d\\n{name}\\nremote-arm-12345678\\n" && exit 0\n'
+                    f'echo "$*" >> {directory}/docker.log\n'
+                )
+            os.chmod(os.path.join(bin_directory, "docker"), 0o755)
+
+            command = builder_command("arm", this.config).replace("$$", "$")
+            subprocess.run(["bash", "-e", "-c", command], env={"PATH": f'{bin_directory}:{os.environ["PATH"]}', "TMPDIR": directory}, check=True)
+
+            with open(os.path.join(directory, "docker.log"), encoding="utf8") as file:
+                calls = file.read().splitlines()
+
+        # Only builders of other buildkitd settings go, the default builder is kept for pipelines without any
+        this.assertEqual(calls[0], "buildx rm --keep-state=false builder-0badf00d")
+        this.assertTrue(calls[1].startswith(f"buildx create --bootstrap --name {name} "))
+        this.assertEqual(len(calls), 2)
+
+
+class TestBuilderAffinity(TestCase):
+    config = TestPipelineGeneration.config | {"builder-affinity-shards": 4, "build-x86": True}
+
+    def build_steps(this, config):
+        return {step["key"]: step for step in generate(config)["steps"][0]["steps"] if "-build-push-" in step["key"]}
+
+    def test_shards(this):
+        shards = {affinity_shard(f"build-and-push-build-push-{index}", this.config) for index in range(100)}
+        this.assertEqual(shards, {"0", "1", "2", "3"})
+        # Builds of the same step in the same pipeline always prefer the same shard
+        this.assertEqual(affinity_shard("build-and-push-build-push-arm", this.config), affinity_shard("build-and-push-build-push-arm", dict(this.config)))
+        this.assertNotEqual(
+            [affinity_shard(f"build-and-push-build-push-{index}", this.config) for index in range(10)],
+            [affinity_shard(f"build-and-push-build-push-{index}", this.config | {"pipeline-name": "other"}) for index in range(10)],
+        )
+
+    def test_routed_to_idle_shard(this):
+        arm_shard = affinity_shard("build-and-push-build-push-arm", this.config)
+        idle = [{"queue": "docker-arm", "build-cache-shard": arm_shard}, {"queue": "docker-arm", "build-cache-shard": "other"}]
+
+        steps = this.build_steps(this.config | {"idle-agents": idle})
+
+        this.assertEqual(steps["build-and-push-build-push-arm"]["agents"], {"queue": "docker-arm", "build-cache-shard": arm_shard})
+        # No agent of the x86 step's shard is idle, so it can run anywhere in its queue
+        this.assertEqual(steps["build-and-push-build-push-x86"]["agents"], {"queue": "docker"})
+        this.assertEqual(
+            steps["build-and-push-build-push-arm"]["command"][0:3],
+            [
+                'buildkite-agent meta-data set "build-and-push-build-push-arm-started" true',
+                f'BP_AFFINITY=$$([[ "$${{BUILDKITE_AGENT_META_DATA_BUILD_CACHE_SHARD:-}}" == "{arm_shard}" ]] && echo hit || echo miss)',
+                "BP_BUILDER=$$(docker buildx inspect builder >/dev/null 2>&1 && echo warm || echo cold)",
+            ],
+        )
+
+    def test_fallback(this):
+        arm_shard = affinity_shard("build-and-push-build-push-arm", this.config)
+        pipeline = generate(this.config | {"idle-agents": [{"queue": "docker-arm", "build-cache-shard": arm_shard}]})
+        steps = {step["key"]: step for step in pipeline["steps"][0]["steps"]}
+
+        watchdog = steps["build-and-push-build-push-arm-watchdog"]
+        this.assertEqual(watchdog["agents"], {"queue": "docker-arm"})
+        this.assertNotIn("depends_on", watchdog)
+        this.assertEqual(watchdog["command"][-1], 'buildkite-agent step cancel --step "build-and-push-build-push-arm" || echo "Unable to cancel build-and-push-build-push-arm, waiting for it to build on shard ' + arm_shard + '"')
+
+        # The fallback builds on any agent once the pinned step is cancelled, or passes on its outcome
+        fallback = steps["build-and-push-build-push-arm-fallback"]
+        this.assertEqual(fallback["agents"], {"queue": "docker-arm"})
+        this.assertEqual(fallback["depends_on"], [{"step": "build-and-push-build-push-arm", "allow_failure": True}])
+        this.assertEqual(fallback["command"][2:], steps["build-and-push-build-push-arm"]["command"][1:])
+
+        manifest = steps["build-and-push-manifest"]
+        this.assertIn("build-and-push-build-push-arm-fallback", manifest["depends_on"])
+        this.assertNotIn("build-and-push-build-push-arm", manifest["depends_on"])
+        this.assertIn("build-and-push-build-push-x86", manifest["depends_on"])
+
+    def test_pins_one_step_per_idle_agent(this):
+        config = this.config | {"images-per-job": 1}
+        config["images"] = [
+            image | {"image-key": name, "image-name": name}
+            for image, name in [(config, "api"), (config, "web"), (config, "worker")]
+        ]
+        keys = [f"build-and-push-build-push-arm-{index}" for index in range(1, 4)]
+        shard = affinity_shard(keys[0], config)
+        idle = [{"queue": "docker-arm", "build-cache-shard": str(number)} for number in range(4)]
+
+        steps = this.build_steps(config | {"idle-agents": idle})
+
+        pinned = [key for key in keys if "build-cache-shard" in steps[key]["agents"]]
+        this.assertEqual(len(pinned), len({affinity_shard(key, config) for key in keys}))
+        this.assertIn(keys[0], pinned)
+        this.assertNotIn({"queue": "docker-arm", "build-cache-shard": shard}, idle)
+
+    def test_dependent_steps_not_pinned(this):
+        step = {"key": "build-and-push-build-push-arm-2", "label": "Build", "agents": {"queue": "docker-arm"}, "command": ["build"], "depends_on": ["build-and-push-build-push-arm-1"]}
+        idle = [{"queue": "docker-arm", "build-cache-shard": affinity_shard(step["key"], this.config)}]
+
+        this.assertEqual(add_builder_affinity(step, "arm", this.config | {"idle-agents": idle}), [])
+        this.assertEqual(step["agents"], {"queue": "docker-arm"})
+        this.assertEqual(len(idle), 1)
+
+    def test_unknown_agents(this):
+        steps = this.build_steps(this.config)
+
+        this.assertEqual(steps["build-and-push-build-push-arm"]["agents"], {"queue": "docker-arm"})
+        this.assertTrue(steps["build-and-push-build-push-arm"]["command"][0].startswith("BP_AFFINITY="))
+
+    def test_remote_builders(this):
+        steps = this.build_steps(this.config | {"remote-builders": {"arm": "tcp://buildkitd:1234"}})
+
+        this.assertFalse(steps["build-and-push-build-push-arm"]["command"][0].startswith("BP_AFFINITY="))
+        this.assertTrue(steps["build-and-push-build-push-x86"]["command"][0].startswith("BP_AFFINITY="))
+
+    def test_resolve_builder_affinity(this):
+        config = dict(this.config)
+        with mock.patch("sys.stderr", io.StringIO()) as stderr:
+            resolve_builder_affinity(config, {})
+        this.assertIsNone(config["idle-agents"])
+        this.assertIn("BUILD_AND_PUSH_BUILDKITE_API_TOKEN isn't set", stderr.getvalue())
+
+        with mock.patch("sys.stderr", io.StringIO()) as stderr, mock.patch("builders.connected_agents", side_effect=OSError("timed out")):
+            resolve_builder_affinity(config, {"BUILD_AND_PUSH_BUILDKITE_API_TOKEN": "token", "BUILDKITE_ORGANIZATION_SLUG": "catch"})
+        this.assertIsNone(config["idle-agents"])
+        this.assertIn("Unable to list agents", stderr.getvalue())
+
+        resolve_builder_affinity(config, agents=[{"meta_data": ["queue=docker"], "job": None}, {"meta_data": ["queue=docker-arm"], "job": {"id": "job-1"}}])
+        this.assertEqual(config["idle-agents"], [{"queue": "docker"}])
+
+
+class TestManifestClient(TestCase):
+    ref = "github.com/CatchoftheDay/build-and-push-buildkite-plugin#v1.7.0"
+    config = TestPipelineGeneration.config | {"manifest-client": "registry", "plugin-ref": ref, "mutate-image-tag": True, "cache-from-ancestors": 5}
+
+    def test_plugin_ref(this):
+        this.assertEqual(plugin_ref({"BUILDKITE_PLUGINS": json.dumps([{"docker-login#v3.0.0": {}}, {this.ref: {}}])}), this.ref)
+        this.assertEqual(plugin_ref({"BUILDKITE_PLUGINS": json.dumps([{"CatchoftheDay/build-and-push#v1.7.0": {}}])}), "CatchoftheDay/build-and-push#v1.7.0")
+        this.assertIsNone(plugin_ref({"BUILDKITE_PLUGINS": json.dumps([{"docker-login#v3.0.0": {}}])}))
+        this.assertIsNone(plugin_ref({}))
+
+    def test_manifest_step(this):
+        step = create_oci_manifest_step(this.config)
+
+        this.assertNotIn("command", step)
+        this.assertEqual(
+            step["plugins"],
+            [
+                {
+                    this.ref: {
+                        "manifest": [
+                            {
+                                "repository": "catch/testcase",
+                                "sources": ["multi-platform-1234567890-arm"],
+                                "tags": [
+                                    {"tag": "1234567890", "replace": True, "optional": False},
+                                    {"tag": "cache_main", "replace": True, "optional": False},
+                                    {"tag": "cache_123456789010", "replace": False, "optional": True},
+                                ],
+                            }
+                        ]
+                    }
+                }
+            ],
+        )
+
+    def test_falls_back_to_cli(this):
+        step = create_oci_manifest_step(this.config | {"plugin-ref": None})
+
+        this.assertEqual(step["plugins"], [])
+        this.assertEqual(
+            step["command"][0:2],
+            [
+                "aws ecr batch-delete-image --registry-id 362995399210 --repository-name catch/testcase --image-ids imageTag=1234567890 || true",
+                "docker buildx imagetools create -t 362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/testcase:1234567890 362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/testcase:multi-platform-1234567890-arm",
+            ],
+        )
+
+    def test_shared_manifest_step(this):
+        plugin = {"docker-login#v3.0.0": {}}
+        configs = [
+            this.config | {"image-name": name, "additional-plugins": [plugin]}
+            for name in ["api", "worker"]
+        ]
+
+        step = create_shared_manifest_step(configs, ["build"])
+
+        this.assertEqual(step["depends_on"], ["build"])
+        this.assertEqual(step["plugins"][1:], [plugin])
+        this.assertEqual([spec["repository"] for spec in step["plugins"][0][this.ref]["manifest"]], ["catch/api", "catch/worker"])
+
+
+class TestImageSizeCheck(TestCase):
+    ref = "github.com/CatchoftheDay/build-and-push-buildkite-plugin#v1.7.0"
+    config = TestPipelineGeneration.config | {"plugin-ref": ref, "build-x86": True, "image-size-check": True}
+
+    def test_image_size_step(this):
+        step = create_image_size_step([this.config | {"image-size-growth-budget": 10}], ["build-arm", "build-x86"])
+
+        this.assertEqual(step["key"], "build-and-push-image-size")
+        this.assertEqual(step["depends_on"], ["build-arm", "build-x86"])
+        this.assertEqual(
+            step["plugins"],
+            [
+                {
+                    this.ref: {
+                        "image-sizes": [
+                            {
+                                "image-name": "testcase",
+                                "repository": "catch/testcase",
+                                "context": "build-and-push-image-size",
+                                "platforms": [
+                                    {"name": "arm", "tag": "multi-platform-1234567890-arm"},
+                                    {"name": "x86", "tag": "multi-platform-1234567890-x86"},
+                                ],
+                                "baselines": ["cache_main", "cache_master"],
+                                "budgets": {"size": 0, "size-growth": 10, "layers": 0, "layer-growth": 0},
+                            }
+                        ]
+                    }
+                }
+            ],
+        )
+
+    def test_generate_reports_sizes(this):
+        steps = generate(this.config)["steps"][0]["steps"]
+
+        this.assertEqual(
+            [step["key"] for step in steps],
+            ["build-and-push-build-push-arm", "build-and-push-build-push-x86", "build-and-push-image-size", "build-and-push-manifest"],
+        )
+        # Without a budget the sizes are only reported, tagging only waits for them to read cache_main before replacing it
+        this.assertIn({"step": "build-and-push-image-size", "allow_failure": True}, steps[3]["depends_on"])
+
+        steps = generate(this.config | {"current-branch": "feature"})["steps"][0]["steps"]
+        this.assertEqual(steps[3]["depends_on"], ["build-and-push-build-push-arm", "build-and-push-build-push-x86"])
+
+    def test_generate_enforces_budgets(this):
+        steps = generate(this.config | {"image-size-check": False, "image-layer-budget": 20})["steps"][0]["steps"]
+
+        this.assertEqual(steps[2]["key"], "build-and-push-image-size")
+        this.assertIn("build-and-push-image-size", steps[3]["depends_on"])
+
+    def test_generate_registry_cache_keeps_baseline(this):
+        # Registry cache doesn't need the cache_main index, but it is still the baseline of the size check
+        config = this.config | {"image-size-check": False, "image-size-growth-budget": 10, "cache-export": "registry"}
+        steps = generate(config)["steps"][0]["steps"]
+
+        this.assertIn("build-and-push-image-size", steps[3]["depends_on"])
+        this.assertIn(
+            "docker buildx imagetools create -t 362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/testcase:cache_main "
+            "362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/testcase:multi-platform-1234567890-arm "
+            "362995399210.dkr.ecr.ap-southeast-2.amazonaws.com/catch/testcase:multi-platform-1234567890-x86",
+            steps[3]["command"],
+        )
+
+        steps = generate(config | {"image-size-growth-budget": 0})["steps"][0]["steps"]
+        this.assertFalse(any("cache_main" in command for command in steps[2]["command"]))
+
+    def test_generate_without_plugin_ref(this):
+        steps = generate(this.config | {"plugin-ref": None})["steps"][0]["steps"]
+
+        this.assertNotIn("build-and-push-image-size", [step["key"] for step in steps])
+
+    def test_budgets_per_image(this):
+        environ = TestPipelineGeneration.RUNTIME_ENVS | {
+            "BUILDKITE_PLUGIN_CONFIGURATION": json.dumps(
+                {"images": [{"image-name": "api", "image-size-budget": 200}, {"image-name": "worker"}]}
+            ),
+            "BUILDKITE_PLUGINS": json.dumps([{this.ref: {}}]),
+        }
+        config = process_config(environ)
+
+        step = next(step for step in generate(config)["steps"][0]["steps"] if step["key"] == "build-and-push-image-size")
+        specs = step["plugins"][0][this.ref]["image-sizes"]
+        this.assertEqual([spec["image-name"] for spec in specs], ["api"])
+        this.assertEqual(specs[0]["context"], "build-and-push-image-size-api")
+        this.assertEqual(specs[0]["budgets"]["size"], 200)
+
+
 if __name__ == "__main__":
     main()
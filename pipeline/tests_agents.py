@@ -0,0 +1,43 @@
+import io
+import json
+from unittest import mock, main, TestCase
+
+from agents import agent_tags, connected_agents, idle_agent_tags
+
+AGENTS = [
+    {"name": "docker-1", "connection_state": "connected", "meta_data": ["queue=docker", "build-cache-shard=0"], "job": None},
+    {"name": "docker-2", "connection_state": "connected", "meta_data": ["queue=docker", "build-cache-shard=1"], "job": {"id": "job-1"}},
+    {"name": "docker-3", "connection_state": "disconnected", "meta_data": ["queue=docker", "build-cache-shard=2"]},
+]
+
+
+class Response(io.BytesIO):
+    def __init__(this, body, link=""):
+        super().__init__(json.dumps(body).encode())
+        this.headers = {"Link": link} if link else {}
+
+
+class TestAgents(TestCase):
+    def test_connected_agents_follows_pages(this):
+        pages = [
+            Response(AGENTS[0:2], '<https://api.buildkite.com/v2/organizations/catch/agents?page=2&per_page=100>; rel="next"'),
+            Response(AGENTS[2:]),
+        ]
+        with mock.patch("urllib.request.urlopen", side_effect=pages) as urlopen:
+            agents = connected_agents("catch", "token")
+
+        this.assertEqual([agent["name"] for agent in agents], ["docker-1", "docker-2"])
+        requests = [call.args[0] for call in urlopen.call_args_list]
+        this.assertEqual(
+            [request.full_url for request in requests],
+            ["https://api.buildkite.com/v2/organizations/catch/agents?per_page=100", "https://api.buildkite.com/v2/organizations/catch/agents?page=2&per_page=100"],
+        )
+        this.assertEqual(requests[0].get_header("Authorization"), "Bearer token")
+
+    def test_idle_agent_tags(this):
+        this.assertEqual(idle_agent_tags(AGENTS[0:2]), [{"queue": "docker", "build-cache-shard": "0"}])
+        this.assertEqual(agent_tags({"meta_data": ["queue=docker", "malformed", "os=linux=6"]}), {"queue": "docker", "os": "linux=6"})
+
+
+if __name__ == "__main__":
+    main()
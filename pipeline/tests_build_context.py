@@ -0,0 +1,133 @@
+import os
+import tempfile
+from unittest import main, TestCase
+
+from build_context import (
+    compile_dockerignore,
+    context_files,
+    fingerprint,
+    is_ignored,
+    largest_paths,
+    read_dockerignore,
+    unused_paths,
+)
+
+
+class TestDockerignore(TestCase):
+    def assertIgnored(this, patterns, path, expected=True):
+        this.assertEqual(is_ignored(path, compile_dockerignore(patterns)), expected, path)
+
+    def test_plain_names_match_at_the_root_only(this):
+        this.assertIgnored(["node_modules"], "node_modules")
+        this.assertIgnored(["node_modules"], "node_modules/left-pad/index.js")
+        this.assertIgnored(["node_modules"], "app/node_modules", expected=False)
+
+    def test_leading_slash_and_comments(this):
+        this.assertIgnored(["# comment", "/build"], "build/output.bin")
+        this.assertIgnored(["# comment", "/build"], "# comment", expected=False)
+
+    def test_single_star_does_not_cross_directories(this):
+        this.assertIgnored(["*.log"], "debug.log")
+        this.assertIgnored(["*.log"], "logs/debug.log", expected=False)
+        this.assertIgnored(["*/*.log"], "logs/debug.log")
+
+    def test_double_star(this):
+        this.assertIgnored(["**/*.pyc"], "module.pyc")
+        this.assertIgnored(["**/*.pyc"], "package/sub/module.pyc")
+        this.assertIgnored(["docs/**"], "docs/a/b/c.md")
+
+    def test_exceptions_are_applied_in_order(this):
+        patterns = ["*.md", "!README.md"]
+        this.assertIgnored(patterns, "CHANGELOG.md")
+        this.assertIgnored(patterns, "README.md", expected=False)
+        this.assertIgnored(patterns + ["README*"], "README.md")
+
+    def test_character_classes_and_question_marks(this):
+        this.assertIgnored(["file[0-9].txt"], "file1.txt")
+        this.assertIgnored(["file[!0-9].txt"], "file1.txt", expected=False)
+        this.assertIgnored(["file?.txt"], "fileA.txt")
+
+
+class TestContext(TestCase):
+    def setUp(this):
+        directory = tempfile.TemporaryDirectory()
+        this.addCleanup(directory.cleanup)
+        this.directory = directory.name
+        for path in ["Dockerfile", "app/main.py", "app/main.pyc", "node_modules/x/index.js", "docs/keep.md", "docs/drop.md"]:
+            this.write(path, path)
+
+    def write(this, path, content):
+        full_path = os.path.join(this.directory, path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        with open(full_path, "w", encoding="utf8") as file:
+            file.write(content)
+
+    def test_context_files(this):
+        files = list(context_files(this.directory, ["node_modules", "**/*.pyc", "docs", "!docs/keep.md"]))
+
+        this.assertEqual(files, ["Dockerfile", "app/main.py", "docs/keep.md"])
+
+    def test_read_dockerignore_prefers_dockerfile_specific_file(this):
+        this.write(".dockerignore", "node_modules\n")
+        dockerfile = os.path.join(this.directory, "Dockerfile")
+        this.assertEqual(read_dockerignore(dockerfile, this.directory), ["node_modules"])
+
+        this.write("Dockerfile.dockerignore", "docs\n")
+        this.assertEqual(read_dockerignore(dockerfile, this.directory), ["docs"])
+
+    def test_fingerprint_ignores_excluded_files(this):
+        this.write(".dockerignore", "node_modules\n")
+        dockerfile = os.path.join(this.directory, "Dockerfile")
+        before = fingerprint(dockerfile, this.directory)
+
+        this.write("node_modules/x/index.js", "changed")
+        this.assertEqual(fingerprint(dockerfile, this.directory), before)
+
+        this.write("app/main.py", "changed")
+        this.assertNotEqual(fingerprint(dockerfile, this.directory), before)
+
+    def test_fingerprint_includes_extra_inputs(this):
+        dockerfile = os.path.join(this.directory, "Dockerfile")
+
+        this.assertEqual(
+            fingerprint(dockerfile, this.directory, ["a"]),
+            fingerprint(dockerfile, this.directory, ["a"]),
+        )
+        this.assertNotEqual(
+            fingerprint(dockerfile, this.directory, ["a"]),
+            fingerprint(dockerfile, this.directory, ["b"]),
+        )
+
+
+class TestContextSize(TestCase):
+    sizes = [
+        ("Dockerfile", 100),
+        ("app/main.py", 2000),
+        ("app/lib/util.py", 3000),
+        ("app/lib/data.bin", 5000),
+        ("fixtures/big.sql", 9000),
+        ("README.md", 10),
+    ]
+
+    def test_largest_paths(this):
+        this.assertEqual(
+            largest_paths(this.sizes, depth=1, count=3),
+            [("app/", 10000), ("fixtures/", 9000), ("Dockerfile", 100)],
+        )
+        this.assertEqual(
+            largest_paths(this.sizes, depth=2, count=3),
+            [("fixtures/big.sql", 9000), ("app/lib/", 8000), ("app/main.py", 2000)],
+        )
+
+    def test_unused_paths(this):
+        this.assertEqual(
+            unused_paths(this.sizes, ["app/lib", "app/*.py", "READ*"]),
+            [("fixtures/", 9000), ("Dockerfile", 100)],
+        )
+
+    def test_whole_context_copied(this):
+        this.assertEqual(unused_paths(this.sizes, ["app", ""]), [])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+from unittest import main, TestCase
+
+from dockerfile import base_images, consumes_arg, context_sources, declared_args, parse, split_flags, ArgDeclaration, Instruction
+
+
+class TestParse(TestCase):
+    def test_continuations_and_comments(this):
+        instructions = parse(
+            "# syntax=docker/dockerfile:1\n"
+            "FROM python:3.12 AS base\n"
+            "\n"
+            "# install\n"
+            "RUN apt-get update && \\\n"
+            "    # not the end of the instruction\n"
+            "\n"
+            "    apt-get install -y git\n"
+            "copy . /app\n"
+        )
+
+        this.assertEqual(
+            instructions,
+            [
+                Instruction("FROM", "python:3.12 AS base", 2),
+                Instruction("RUN", "apt-get update && apt-get install -y git", 5),
+                Instruction("COPY", ". /app", 9),
+            ],
+        )
+
+    def test_escape_directive(this):
+        instructions = parse("# escape=`\nFROM mcr.microsoft.com/windows\nRUN dir `\n  C:\\\\\n")
+
+        this.assertEqual(instructions[1], Instruction("RUN", "dir C:\\\\", 3))
+
+    def test_heredocs_are_skipped(this):
+        instructions = parse(
+            "FROM alpine\n"
+            "RUN <<EOF\n"
+            "COPY not-an-instruction /\n"
+            "EOF\n"
+            "COPY <<-'CONFIG' /etc/app.conf\n"
+            "\tkey=value\n"
+            "\tCONFIG\n"
+            "COPY app /app\n"
+        )
+
+        this.assertEqual([instruction.name for instruction in instructions], ["FROM", "RUN", "COPY", "COPY"])
+        this.assertEqual(instructions[-1].arguments, "app /app")
+
+    def test_split_flags(this):
+        this.assertEqual(split_flags("--chown=1:1 --link a 'b c' /dest"), (["--chown=1:1", "--link"], ["a", "b c", "/dest"]))
+        this.assertEqual(split_flags('--from=build ["/app", "/app"]'), (["--from=build"], ["/app", "/app"]))
+
+
+class TestContextSources(TestCase):
+    def test_copy_add_and_bind_mounts(this):
+        instructions = parse(
+            "FROM node:20 AS build\n"
+            "COPY --chown=node package.json ./package-lock.json ./\n"
+            'COPY ["src/", "/app/src"]\n'
+            "ADD https://example.com/archive.tgz /tmp/\n"
+            "ADD vendor.tgz /opt/\n"
+            "RUN --mount=type=bind,source=scripts,target=/scripts --mount=type=cache,target=/root/.npm npm ci\n"
+            "RUN --mount=type=bind,from=build,source=/app,target=/app true\n"
+            "COPY --from=build /app /app\n"
+            "COPY <<EOF /etc/motd\n"
+            "hello\n"
+            "EOF\n"
+        )
+
+        this.assertEqual(context_sources(instructions), ["package.json", "package-lock.json", "src", "vendor.tgz", "scripts"])
+
+    def test_whole_context(this):
+        this.assertEqual(context_sources(parse("FROM alpine\nCOPY ./ /app\n")), [""])
+        this.assertEqual(context_sources(parse("FROM alpine\nRUN --mount=type=bind,target=/src make\n")), [""])
+
+
+class TestDeclaredArgs(TestCase):
+    def test_args_by_stage(this):
+        instructions = parse(
+            "ARG BASE=python:3.12\n"
+            "FROM $BASE AS build\n"
+            "ARG BUILD_DATE VERSION=1\n"
+            "RUN make\n"
+            "RUN make install\n"
+            "FROM alpine\n"
+            "ARG BUILDKITE_COMMIT\n"
+            "COPY --from=build /out /\n"
+        )
+
+        this.assertEqual(
+            declared_args(instructions),
+            [
+                ArgDeclaration("BASE", None, 1, 0),
+                ArgDeclaration("BUILD_DATE", "build", 3, 2),
+                ArgDeclaration("VERSION", "build", 3, 2),
+                ArgDeclaration("BUILDKITE_COMMIT", "1", 7, 1),
+            ],
+        )
+
+    def test_consumes_arg(this):
+        this.assertTrue(consumes_arg("VERSION", ["VERSION"]))
+        this.assertTrue(consumes_arg("HTTPS_PROXY", []))
+        this.assertTrue(consumes_arg("BUILDKIT_INLINE_CACHE", []))
+        this.assertFalse(consumes_arg("BUILD_DATE", ["VERSION"]))
+
+
+class TestBaseImages(TestCase):
+    def test_stages_and_scratch_are_left_out(this):
+        instructions = parse(
+            "FROM --platform=$BUILDPLATFORM golang:1.22 AS Build\n"
+            "RUN go build\n"
+            "FROM build AS test\n"
+            "FROM scratch\n"
+            "COPY --from=build /out /\n"
+            "FROM golang:1.22\n"
+        )
+
+        this.assertEqual(base_images(instructions), ["golang:1.22"])
+
+    def test_global_args(this):
+        instructions = parse(
+            "ARG REGISTRY=docker.io\n"
+            "ARG BASE_TAG\n"
+            "FROM ${REGISTRY}/catch/base:${BASE_TAG:-latest}\n"
+            "ARG REGISTRY=ignored\n"
+            "FROM $REGISTRY/catch/tools\n"
+        )
+
+        this.assertEqual(base_images(instructions), ["docker.io/catch/base:latest", "docker.io/catch/tools"])
+        this.assertEqual(
+            base_images(instructions, {"REGISTRY": "ecr", "BASE_TAG": "1.0"}),
+            ["ecr/catch/base:1.0", "ecr/catch/tools"],
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+import json
+import os
+import stat
+import subprocess
+import tempfile
+from unittest import main, TestCase
+
+HOOK = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "hooks", "command")
+
+# Records each call, answers `pipeline upload --dry-run` with the file unchanged and saves whatever is uploaded
+AGENT_STUB = """#!/bin/bash
+echo "$*" >> agent.log
+case "$1 $2" in
+  "pipeline upload")
+    if [[ "$3" == "--dry-run" ]]; then cat "$4"; else cat "${4:-/dev/stdin}" > uploaded.json; fi ;;
+  "artifact upload")
+    exit "${ARTIFACT_UPLOAD_STATUS:-0}" ;;
+  "annotate "*)
+    cat > /dev/null; echo "Annotation created" ;;
+esac
+"""
+
+
+class TestCommandHook(TestCase):
+    def setUp(this):
+        directory = tempfile.TemporaryDirectory()
+        this.addCleanup(directory.cleanup)
+        this.directory = directory.name
+        bin_directory = os.path.join(this.directory, "bin")
+        os.mkdir(bin_directory)
+        agent = os.path.join(bin_directory, "buildkite-agent")
+        with open(agent, "w", encoding="utf8") as file:
+            file.write(AGENT_STUB)
+        os.chmod(agent, os.stat(agent).st_mode | stat.S_IEXEC)
+        with open(os.path.join(this.directory, "Dockerfile"), "w", encoding="utf8") as file:
+            file.write("FROM alpine\nARG release\n")
+        this.environ = {
+            "PATH": f'{bin_directory}:{os.environ["PATH"]}',
+            "BUILDKITE_PIPELINE_NAME": "testcase",
+            "BUILDKITE_COMMIT": "1234567890abcdef",
+            "BUILDKITE_BRANCH": "main",
+            "RELEASE": "v1.2.3",
+        }
+
+    def run_hook(this, plugin_config, **environ):
+        # The agent exposes the configuration both as JSON and as a variable per option
+        options = {
+            f'BUILDKITE_PLUGIN_BUILD_AND_PUSH_{name.upper().replace("-", "_")}': json.dumps(value) if isinstance(value, bool) else str(value)
+            for name, value in plugin_config.items()
+        }
+        result = subprocess.run(
+            ["bash", HOOK],
+            cwd=this.directory,
+            env=this.environ | {"BUILDKITE_PLUGIN_CONFIGURATION": json.dumps(plugin_config)} | options | environ,
+            capture_output=True,
+            text=True,
+            check=False,
+        )
+        calls = []
+        if os.path.exists(os.path.join(this.directory, "agent.log")):
+            with open(os.path.join(this.directory, "agent.log"), encoding="utf8") as file:
+                calls = file.read().splitlines()
+        return result, calls
+
+    def read(this, name):
+        with open(os.path.join(this.directory, name), encoding="utf8") as file:
+            return file.read()
+
+    def test_dry_run(this):
+        result, calls = this.run_hook({})
+
+        this.assertEqual(result.returncode, 0, result.stderr)
+        this.assertEqual(
+            calls,
+            [
+                "pipeline upload --dry-run pipeline.yaml",
+                "artifact upload build_pipeline.yaml",
+                "pipeline upload --no-interpolation build_pipeline.yaml",
+            ],
+        )
+
+    def test_stream(this):
+        result, calls = this.run_hook(
+            {"build-args": "release=$RELEASE", "context-analysis": True, "upload-mode": "stream"}
+        )
+
+        this.assertEqual(result.returncode, 0, result.stderr)
+        # Archiving runs alongside the upload, so the two calls can be in either order
+        this.assertEqual(calls[0], "annotate --style info --context build-and-push-context-testcase")
+        this.assertCountEqual(calls[1:], ["artifact upload build_pipeline.yaml", "pipeline upload --no-interpolation"])
+        this.assertFalse(os.path.exists(os.path.join(this.directory, "pipeline.yaml")))
+
+        uploaded = this.read("uploaded.json")
+        this.assertEqual(uploaded, this.read("build_pipeline.yaml"))
+        this.assertNotIn("$$", uploaded)
+        build_step = json.loads(uploaded)["steps"][0]["steps"][0]
+        this.assertIn(" --build-arg release=v1.2.3 ", build_step["command"][1])
+
+    def test_stream_without_archive(this):
+        result, calls = this.run_hook({"upload-mode": "stream", "archive-pipeline": False})
+
+        this.assertEqual(result.returncode, 0, result.stderr)
+        this.assertEqual(calls, ["pipeline upload --no-interpolation"])
+
+    def test_stream_archive_failure(this):
+        result, calls = this.run_hook({"upload-mode": "stream"}, ARTIFACT_UPLOAD_STATUS="1")
+
+        this.assertEqual(result.returncode, 0, result.stderr)
+        this.assertIn("pipeline upload --no-interpolation", calls)
+        this.assertIn("Unable to archive build_pipeline.yaml", result.stderr)
+
+    def test_stream_generation_failure(this):
+        result, calls = this.run_hook({"upload-mode": "stream", "push-mode": "unknown"})
+
+        this.assertNotEqual(result.returncode, 0)
+        this.assertEqual(calls, [])
+
+
+if __name__ == "__main__":
+    main()
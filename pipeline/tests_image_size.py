@@ -0,0 +1,115 @@
+import gzip
+import io
+import json
+import os
+from unittest import mock, main, TestCase
+
+from fake_registry import FakeRegistry
+from image_size import annotation, check_image, main as image_size_main, uncompressed_size
+from registry import OCI_INDEX, RegistryClient
+
+GZIP_LAYER = "application/vnd.oci.image.layer.v1.tar+gzip"
+ZSTD_LAYER = "application/vnd.oci.image.layer.v1.tar+zstd"
+
+SPEC = {
+    "image-name": "testcase",
+    "repository": "catch/testcase",
+    "context": "build-and-push-image-size",
+    "platforms": [{"name": "x86", "tag": "multi-platform-1234567890-x86"}],
+    "baselines": ["cache_main", "cache_master"],
+    "budgets": {"size": 0, "size-growth": 0, "layers": 0, "layer-growth": 0},
+}
+
+
+def put_layered_image(registry, tag, architecture, layers, media_type=GZIP_LAYER):
+    """Store an image with a gzipped layer for each entry of layers, returning its manifest entry for an index"""
+    config = json.dumps({"architecture": architecture, "os": "linux"}).encode()
+    config_digest = registry.put_blob("catch/testcase", config)
+    descriptors = []
+    for content in layers:
+        blob = gzip.compress(content) if media_type == GZIP_LAYER else content
+        descriptors.append({"mediaType": media_type, "digest": registry.put_blob("catch/testcase", blob), "size": len(blob)})
+    manifest = {
+        "schemaVersion": 2,
+        "mediaType": "application/vnd.oci.image.manifest.v1+json",
+        "config": {"digest": config_digest, "size": len(config)},
+        "layers": descriptors,
+    }
+    manifest_digest = registry.put_manifest("catch/testcase", tag, manifest)
+    return {"mediaType": manifest["mediaType"], "digest": manifest_digest, "platform": {"architecture": architecture, "os": "linux"}}
+
+
+class TestImageSize(TestCase):
+    def test_compared_with_baseline(this):
+        with FakeRegistry() as registry:
+            put_layered_image(registry, "multi-platform-1234567890-x86", "amd64", [b"a" * 1000, b"b" * 2000, b"c" * 3000])
+            # The baseline is the x86 image in the default branch's index
+            arm = put_layered_image(registry, "arm", "arm64", [b"a" * 100])
+            x86 = put_layered_image(registry, "x86", "amd64", [b"a" * 1000, b"b" * 1000])
+            registry.put_manifest("catch/testcase", "cache_master", {"mediaType": OCI_INDEX, "manifests": [arm, x86]})
+
+            with RegistryClient(registry.host, secure=False) as client:
+                rows, failures = check_image(SPEC, client)
+
+        this.assertEqual(failures, [])
+        this.assertEqual(rows[0]["baseline-tag"], "cache_master")
+        this.assertEqual(rows[0]["stats"]["uncompressed"], 6000)
+        this.assertEqual(rows[0]["stats"]["layers"], 3)
+        this.assertEqual(rows[0]["baseline"]["uncompressed"], 2000)
+        this.assertEqual(rows[0]["baseline"]["layers"], 2)
+
+        markdown = annotation(SPEC, rows, failures)
+        this.assertIn("compared with `cache_master`", markdown)
+        this.assertIn("| x86 | ", markdown)
+        this.assertIn("| 5.9 KB | +3.9 KB (+200.0%) | 3 | +1 (+50.0%) |", markdown)
+
+    def test_budgets(this):
+        budgets = {"size": 1, "size-growth": 10, "layers": 2, "layer-growth": 0}
+        with FakeRegistry() as registry:
+            put_layered_image(registry, "multi-platform-1234567890-x86", "amd64", [os.urandom(1024 * 1024), b"b", b"c"])
+            put_layered_image(registry, "cache_main", "amd64", [b"a"])
+
+            with RegistryClient(registry.host, secure=False) as client:
+                _, failures = check_image(SPEC | {"budgets": budgets}, client)
+
+        this.assertEqual(len(failures), 3)
+        this.assertRegex(failures[0], r"^x86: compressed size 1\.0 MB is over the budget of 1 MB$")
+        this.assertEqual(failures[1], "x86: 3 layers is over the budget of 2")
+        this.assertRegex(failures[2], r"^x86: compressed size grew [0-9.]+%, over the budget of 10%$")
+
+    def test_without_baseline(this):
+        with FakeRegistry() as registry:
+            put_layered_image(registry, "multi-platform-1234567890-x86", "amd64", [b"a"], media_type=ZSTD_LAYER)
+
+            with RegistryClient(registry.host, secure=False) as client:
+                rows, failures = check_image(SPEC | {"budgets": SPEC["budgets"] | {"size-growth": 10}}, client)
+
+        # Growth can't exceed a budget without something to grow from
+        this.assertEqual(failures, [])
+        this.assertIsNone(rows[0]["baseline"])
+        this.assertIsNone(rows[0]["stats"]["uncompressed"])
+        markdown = annotation(SPEC, rows, failures)
+        this.assertIn("no baseline image found", markdown)
+        this.assertIn("| unknown | - |", markdown)
+
+    def test_uncompressed_size_of_tar_layers(this):
+        layer = {"mediaType": "application/vnd.docker.image.rootfs.diff.tar", "digest": "sha256:aaaa", "size": 1234}
+        this.assertEqual(uncompressed_size(None, "catch/testcase", layer), 1234)
+
+    def test_main(this):
+        over_budget = SPEC | {"budgets": SPEC["budgets"] | {"layers": 1}}
+
+        with FakeRegistry() as registry, mock.patch("sys.stdout", io.StringIO()), mock.patch("subprocess.run") as run:
+            put_layered_image(registry, "multi-platform-1234567890-x86", "amd64", [b"a", b"b"])
+            with mock.patch.dict(os.environ, {"BUILDKITE_PLUGIN_CONFIGURATION": json.dumps({"image-sizes": [SPEC]})}):
+                this.assertEqual(image_size_main(RegistryClient(registry.host, secure=False)), 0)
+            this.assertEqual(run.call_args.args[0], ["buildkite-agent", "annotate", "--style", "info", "--context", "build-and-push-image-size"])
+
+            with mock.patch.dict(os.environ, {"BUILDKITE_PLUGIN_CONFIGURATION": json.dumps({"image-sizes": [over_budget]})}):
+                this.assertEqual(image_size_main(RegistryClient(registry.host, secure=False)), 1)
+            this.assertEqual(run.call_args.args[0][3], "error")
+            this.assertIn("- x86: 2 layers is over the budget of 1", run.call_args.kwargs["input"])
+
+
+if __name__ == "__main__":
+    main()
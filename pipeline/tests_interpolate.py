@@ -0,0 +1,56 @@
+from unittest import main, TestCase
+
+from interpolate import interpolate, interpolate_string, InterpolationError
+
+ENVIRON = {"NAME": "value", "EMPTY": "", "COMMIT": "1234567890abcdef"}
+
+
+class TestInterpolate(TestCase):
+    def test_references(this):
+        this.assertEqual(interpolate_string("$NAME ${NAME} $MISSING-${MISSING}.", ENVIRON), "value value -.")
+
+    def test_escapes(this):
+        this.assertEqual(interpolate_string("$$NAME \\$NAME $$(date) $${NAME}", ENVIRON), "$NAME $NAME $(date) ${NAME}")
+
+    def test_defaults(this):
+        this.assertEqual(interpolate_string("${EMPTY:-default} ${EMPTY-default}", ENVIRON), "default ")
+        this.assertEqual(interpolate_string("${MISSING:-$NAME} ${MISSING-fallback}", ENVIRON), "value fallback")
+
+    def test_required(this):
+        this.assertEqual(interpolate_string("${NAME:?must be set}", ENVIRON), "value")
+        this.assertEqual(interpolate_string("${EMPTY?must be set}", ENVIRON), "")
+        with this.assertRaisesRegex(InterpolationError, "EMPTY: must be set"):
+            interpolate_string("${EMPTY:?must be set}", ENVIRON)
+        with this.assertRaisesRegex(InterpolationError, "MISSING: not set"):
+            interpolate_string("${MISSING?}", ENVIRON)
+
+    def test_substrings(this):
+        this.assertEqual(interpolate_string("${COMMIT:0:7} ${COMMIT:10} ${COMMIT: -4} ${COMMIT:2:-12}", ENVIRON), "1234567 abcdef cdef 34")
+
+    def test_pipeline(this):
+        pipeline = {
+            "steps": [
+                {
+                    "label": "Build $NAME",
+                    "command": ["echo $$BUILDKITE_JOB_ID"],
+                    "plugins": [{"example#${NAME}": {"enabled": True, "retries": 2}}],
+                }
+            ]
+        }
+
+        this.assertEqual(
+            interpolate(pipeline, ENVIRON),
+            {
+                "steps": [
+                    {
+                        "label": "Build value",
+                        "command": ["echo $BUILDKITE_JOB_ID"],
+                        "plugins": [{"example#value": {"enabled": True, "retries": 2}}],
+                    }
+                ]
+            },
+        )
+
+
+if __name__ == "__main__":
+    main()
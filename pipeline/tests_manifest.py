@@ -0,0 +1,106 @@
+import io
+import json
+import os
+from unittest import mock, main, TestCase
+
+from fake_registry import FakeRegistry
+from manifest import create_tags, delete_tags, main as manifest_main
+from registry import OCI_INDEX, RegistryClient
+from tests_registry import put_image
+
+SPEC = {
+    "repository": "catch/testcase",
+    "sources": ["multi-platform-1234567890-arm", "multi-platform-1234567890-x86"],
+    "tags": [
+        {"tag": "1234567890", "replace": True, "optional": False},
+        {"tag": "cache_main", "replace": True, "optional": False},
+        {"tag": "cache_123456789010", "replace": False, "optional": True},
+    ],
+}
+
+
+class TestCreateTags(TestCase):
+    def setUp(this):
+        this.deleted = []
+
+    def delete(this, repository, tags):
+        this.deleted.append((repository, tags))
+
+    def images(this, registry):
+        return [
+            put_image(registry, "multi-platform-1234567890-arm", "arm64"),
+            put_image(registry, "multi-platform-1234567890-x86", "amd64"),
+        ]
+
+    def test_every_tag_shares_one_index(this):
+        with FakeRegistry() as registry, mock.patch("sys.stdout", io.StringIO()):
+            images = this.images(registry)
+            with RegistryClient(registry.host, secure=False) as client:
+                this.assertEqual(create_tags(SPEC, client, this.delete), [])
+
+            index = registry.get_manifest("catch/testcase", "1234567890")
+            this.assertEqual(index, {"schemaVersion": 2, "mediaType": OCI_INDEX, "manifests": images})
+            this.assertEqual(registry.get_manifest("catch/testcase", "cache_main"), index)
+            this.assertEqual(registry.get_manifest("catch/testcase", "cache_123456789010"), index)
+            this.assertEqual(registry.connections, 1)
+            # The sources are read once, however many tags are written
+            this.assertEqual(
+                [request for request in registry.requests if request[0] == "GET" and "/manifests/" in request[1]],
+                [("GET", "/v2/catch/testcase/manifests/multi-platform-1234567890-arm"), ("GET", "/v2/catch/testcase/manifests/multi-platform-1234567890-x86")],
+            )
+
+        # Replaced tags are removed in one batch
+        this.assertEqual(this.deleted, [("catch/testcase", ["1234567890", "cache_main"])])
+
+    def test_immutable_tags(this):
+        with FakeRegistry(immutable=True) as registry, mock.patch("sys.stdout", io.StringIO()), mock.patch("sys.stderr", io.StringIO()) as stderr:
+            this.images(registry)
+            registry.put_manifest("catch/testcase", "cache_123456789010", {"schemaVersion": 2})
+            registry.put_manifest("catch/testcase", "1234567890", {"schemaVersion": 2})
+            with RegistryClient(registry.host, secure=False) as client:
+                # The fake registry doesn't remove the replaced tags, so the image tag can't be created
+                failed = create_tags(SPEC, client, this.delete)
+
+        this.assertEqual(failed, ["catch/testcase:1234567890"])
+        this.assertIn("Unable to create catch/testcase:cache_123456789010, continuing", stderr.getvalue())
+
+    def test_missing_source(this):
+        with FakeRegistry() as registry, mock.patch("sys.stderr", io.StringIO()):
+            put_image(registry, "multi-platform-1234567890-arm", "arm64")
+            with RegistryClient(registry.host, secure=False) as client:
+                failed = create_tags(SPEC, client, this.delete)
+
+            this.assertNotIn(("catch/testcase", "1234567890"), registry.manifests)
+
+        this.assertEqual(failed, ["catch/testcase:1234567890", "catch/testcase:cache_main"])
+        # Existing tags are left alone when the sources can't be read
+        this.assertEqual(this.deleted, [])
+
+    def test_delete_tags(this):
+        with mock.patch("subprocess.run") as run:
+            run.return_value.returncode = 0
+            delete_tags("catch/testcase", ["1234567890", "cache_main"])
+
+        this.assertEqual(
+            run.call_args.args[0],
+            [
+                "aws", "ecr", "batch-delete-image", "--registry-id", "362995399210", "--repository-name", "catch/testcase",
+                "--image-ids", "imageTag=1234567890", "imageTag=cache_main",
+            ],
+        )
+
+    def test_main(this):
+        missing = SPEC | {"sources": ["absent"]}
+
+        with FakeRegistry() as registry, mock.patch("sys.stdout", io.StringIO()), mock.patch("sys.stderr", io.StringIO()), mock.patch("manifest.delete_tags"):
+            this.images(registry)
+            with mock.patch.dict(os.environ, {"BUILDKITE_PLUGIN_CONFIGURATION": json.dumps({"manifest": [SPEC]})}):
+                this.assertEqual(manifest_main(RegistryClient(registry.host, secure=False)), 0)
+            this.assertIn(("catch/testcase", "1234567890"), registry.manifests)
+
+            with mock.patch.dict(os.environ, {"BUILDKITE_PLUGIN_CONFIGURATION": json.dumps({"manifest": [SPEC, missing]})}):
+                this.assertEqual(manifest_main(RegistryClient(registry.host, secure=False)), 1)
+
+
+if __name__ == "__main__":
+    main()
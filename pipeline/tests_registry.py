@@ -0,0 +1,134 @@
+import json
+from unittest import main, TestCase
+
+from fake_registry import digest, FakeRegistry
+from registry import DOCKER_MANIFEST, DOCKER_MANIFEST_LIST, OCI_INDEX, RegistryClient, RegistryError
+
+OCI_MANIFEST = "application/vnd.oci.image.manifest.v1+json"
+
+
+def put_image(registry, tag, architecture, variant=None, media_type=OCI_MANIFEST):
+    """Store an image manifest and its config, returning the index entry expected for it"""
+    config = {"architecture": architecture, "os": "linux", **({"variant": variant} if variant else {})}
+    config_digest = registry.put_blob("catch/testcase", json.dumps(config).encode())
+    manifest = {"schemaVersion": 2, "mediaType": media_type, "config": {"digest": config_digest}, "layers": []}
+    content = json.dumps(manifest).encode()
+    registry.put_manifest("catch/testcase", tag, manifest)
+    platform = {"architecture": architecture, "os": "linux", **({"variant": variant} if variant else {})}
+    return {"mediaType": media_type, "digest": digest(content), "size": len(content), "platform": platform}
+
+
+class TestRegistryClient(TestCase):
+    def test_manifest_exists(this):
+        with FakeRegistry() as registry:
+            registry.put_manifest("catch/testcase", "present", {"schemaVersion": 2})
+
+            with RegistryClient(registry.host, secure=False) as client:
+                this.assertTrue(client.manifest_exists("catch/testcase", "present"))
+                this.assertFalse(client.manifest_exists("catch/testcase", "absent"))
+
+            this.assertEqual(registry.connections, 1)
+
+    def test_basic_authentication(this):
+        with FakeRegistry("AWS", "token") as registry:
+            registry.put_manifest("catch/testcase", "present", {"schemaVersion": 2})
+
+            with RegistryClient(registry.host, "AWS", "token", secure=False) as client:
+                this.assertTrue(client.manifest_exists("catch/testcase", "present"))
+                this.assertTrue(client.manifest_exists("catch/testcase", "present"))
+
+            # Only the first request should have been challenged
+            this.assertEqual(len(registry.requests), 3)
+
+    def test_missing_credentials(this):
+        with FakeRegistry("AWS", "token") as registry:
+            with RegistryClient(registry.host, secure=False) as client:
+                with this.assertRaises(RegistryError):
+                    client.manifest_exists("catch/testcase", "present")
+
+class TestManifests(TestCase):
+    def test_put_manifest(this):
+        content = json.dumps({"schemaVersion": 2, "mediaType": OCI_INDEX, "manifests": []}).encode()
+
+        with FakeRegistry() as registry:
+            with RegistryClient(registry.host, secure=False) as client:
+                this.assertEqual(client.put_manifest("catch/testcase", "latest", OCI_INDEX, content), digest(content))
+                this.assertEqual(client.get_manifest("catch/testcase", "latest"), (OCI_INDEX, content))
+                with this.assertRaises(RegistryError):
+                    client.get_manifest("catch/testcase", "absent")
+
+    def test_build_index_from_images(this):
+        with FakeRegistry() as registry:
+            arm = put_image(registry, "multi-platform-arm", "arm64", "v8")
+            x86 = put_image(registry, "multi-platform-x86", "amd64")
+
+            with RegistryClient(registry.host, secure=False) as client:
+                media_type, content = client.build_index("catch/testcase", ["multi-platform-arm", "multi-platform-x86"])
+
+            # Every manifest and config was fetched over a single connection
+            this.assertEqual(registry.connections, 1)
+
+        this.assertEqual(media_type, OCI_INDEX)
+        this.assertEqual(json.loads(content), {"schemaVersion": 2, "mediaType": OCI_INDEX, "manifests": [arm, x86]})
+
+    def test_build_manifest_list_from_docker_images(this):
+        with FakeRegistry() as registry:
+            put_image(registry, "multi-platform-arm", "arm64", media_type=DOCKER_MANIFEST)
+            put_image(registry, "multi-platform-x86", "amd64", media_type=DOCKER_MANIFEST)
+
+            with RegistryClient(registry.host, secure=False) as client:
+                media_type, content = client.build_index("catch/testcase", ["multi-platform-arm", "multi-platform-x86"])
+
+        this.assertEqual(media_type, DOCKER_MANIFEST_LIST)
+        this.assertEqual(json.loads(content)["mediaType"], DOCKER_MANIFEST_LIST)
+
+    def test_build_index_reuses_single_index(this):
+        index = {"schemaVersion": 2, "mediaType": OCI_INDEX, "manifests": [{"digest": "sha256:aaaa"}]}
+
+        with FakeRegistry() as registry:
+            registry.put_manifest("catch/testcase", "fingerprint-abc", index)
+
+            with RegistryClient(registry.host, secure=False) as client:
+                this.assertEqual(
+                    client.build_index("catch/testcase", ["fingerprint-abc"]),
+                    (OCI_INDEX, json.dumps(index).encode()),
+                )
+
+    def test_build_index_merges_indexes(this):
+        attestation = {"mediaType": OCI_MANIFEST, "digest": "sha256:cccc", "annotations": {"vnd.docker.reference.type": "attestation-manifest"}}
+
+        with FakeRegistry() as registry:
+            arm = put_image(registry, "multi-platform-arm", "arm64")
+            registry.put_manifest("catch/testcase", "arm", {"mediaType": OCI_INDEX, "manifests": [arm, attestation]})
+            registry.put_manifest("catch/testcase", "also-arm", {"mediaType": OCI_INDEX, "manifests": [arm]})
+            x86 = put_image(registry, "multi-platform-x86", "amd64")
+
+            with RegistryClient(registry.host, secure=False) as client:
+                _, content = client.build_index("catch/testcase", ["arm", "also-arm", "multi-platform-x86"])
+
+        this.assertEqual(json.loads(content)["manifests"], [arm, attestation, x86])
+
+
+class TestBlobs(TestCase):
+    def test_blob_tail(this):
+        with FakeRegistry() as registry:
+            blob = registry.put_blob("catch/testcase", b"layer content")
+
+            with RegistryClient(registry.host, secure=False) as client:
+                this.assertEqual(client.blob_tail("catch/testcase", blob, 4), b"tent")
+                with this.assertRaises(RegistryError):
+                    client.blob_tail("catch/testcase", "sha256:absent", 4)
+
+    def test_redirected_blobs(this):
+        with FakeRegistry("AWS", "token", redirect_blobs=True) as registry:
+            blob = registry.put_blob("catch/testcase", b"layer content")
+
+            with RegistryClient(registry.host, "AWS", "token", secure=False) as client:
+                this.assertEqual(client.get_blob("catch/testcase", blob), b"layer content")
+                this.assertEqual(client.blob_tail("catch/testcase", blob, 4), b"tent")
+
+            this.assertIn(("GET", f"/storage/catch/testcase/{blob}"), registry.requests)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+import io
+import json
+import os
+import tempfile
+from unittest import mock, main, TestCase
+
+from pipeline import generate
+from simulate import flatten, main as simulate_main, simulate
+import tests
+
+# Synthetic history: arm builds are slower than x86 and the scans are quick
+DURATIONS = {
+    "build-and-push-build-push-arm": [400, 500, 600],
+    "build-and-push-build-push-x86": [200, 300, 900],
+    "build-and-push-scan-*": 60,
+    "build-and-push-manifest": 30,
+}
+
+
+class TestSimulate(TestCase):
+    config = tests.TestPipelineGeneration.config | {"build-x86": True, "push-to-ecr": True, "scan-image": True}
+
+    def test_generated_pipeline(this):
+        result = simulate(generate(this.config), DURATIONS)
+
+        this.assertEqual(result["duration_s"], 560)
+        this.assertEqual(
+            [(step["key"], step["start_s"], step["finish_s"]) for step in result["critical_path"]],
+            [("build-and-push-build-push-arm", 0, 500), ("build-and-push-scan-arm", 500, 560)],
+        )
+        this.assertEqual(result["agent_minutes"], {"default": 0.5, "docker": 6.0, "docker-arm": 560 / 60})
+
+    def test_percentile(this):
+        result = simulate(generate(this.config), DURATIONS, fraction=0.9)
+
+        this.assertEqual(result["duration_s"], 960)
+        this.assertEqual(result["critical_path"][0]["key"], "build-and-push-build-push-x86")
+
+    def test_comparing_variants(this):
+        # Blocking on scans puts them in front of the manifest
+        blocking = simulate(generate(this.config | {"block-on-container-scan": True}), DURATIONS)
+        arm_only = simulate(generate(this.config | {"build-x86": False, "scan-image": False}), DURATIONS)
+
+        this.assertEqual(blocking["duration_s"], 590)
+        this.assertEqual([step["key"] for step in blocking["critical_path"]][1:], ["build-and-push-scan-arm", "build-and-push-manifest"])
+        this.assertEqual(arm_only["duration_s"], 530)
+        this.assertEqual([step["key"] for step in arm_only["critical_path"]], ["build-and-push-build-push-arm", "build-and-push-manifest"])
+        this.assertEqual(arm_only["agent_minutes"], {"default": 0.5, "docker-arm": 500 / 60})
+
+    def test_groups_waits_and_parallelism(this):
+        pipeline = {
+            "steps": [
+                {"label": "lint", "agents": ["queue=small"]},
+                "wait",
+                {"group": "tests", "key": "tests", "steps": [{"key": "unit", "parallelism": 4}, {"key": "e2e", "depends_on": [{"step": "unit"}]}]},
+                {"key": "deploy", "depends_on": "tests"},
+                {"key": "notify", "depends_on": ["upstream-pipeline-step"]},
+            ]
+        }
+
+        steps = flatten(pipeline)
+        this.assertEqual({key: step["depends_on"] for key, step in steps.items()}, {
+            "lint": [],
+            "unit": ["lint"],
+            "e2e": ["lint", "unit"],
+            "deploy": ["lint", "unit", "e2e"],
+            "notify": ["lint"],
+        })
+
+        result = simulate(pipeline, {"lint": 30, "unit": 120, "e2e": 300, "*": 15})
+        this.assertEqual(result["duration_s"], 465)
+        this.assertEqual([step["key"] for step in result["critical_path"]], ["lint", "unit", "e2e", "deploy"])
+        this.assertEqual(result["agent_minutes"], {"default": 13.5, "small": 0.5})
+
+    def test_missing_durations_and_cycles(this):
+        with this.assertRaisesRegex(ValueError, "No duration for step\\(s\\) build-and-push-build-push-x86"):
+            simulate(generate(this.config), DURATIONS | {"build-and-push-build-push-x86": []})
+
+        with this.assertRaisesRegex(ValueError, "depend on each other"):
+            simulate({"steps": [{"key": "a", "depends_on": "b"}, {"key": "b", "depends_on": "a"}]}, {"*": 1})
+
+    def test_main(this):
+        directory = tempfile.TemporaryDirectory()
+        this.addCleanup(directory.cleanup)
+        paths = {
+            "durations.json": json.dumps(DURATIONS),
+            "both.json": json.dumps(generate(this.config)),
+            "arm.yaml": "steps:\n  - key: build-and-push-build-push-arm\n  - key: build-and-push-manifest\n    depends_on: build-and-push-build-push-arm\n",
+        }
+        for name, content in paths.items():
+            with open(os.path.join(directory.name, name), "w", encoding="utf8") as file:
+                file.write(content)
+        durations, both, arm = (os.path.join(directory.name, name) for name in paths)
+
+        with mock.patch("sys.stdout", io.StringIO()) as stdout:
+            this.assertEqual(simulate_main(["--durations", durations, both, arm]), 0)
+        this.assertIn(f"{both}: 9m 20s end to end", stdout.getvalue())
+        this.assertIn(f"{arm}: 8m 50s end to end\nCritical path:\n    0m 00s -   8m 20s  build-and-push-build-push-arm\n", stdout.getvalue())
+
+        with mock.patch("sys.stdout", io.StringIO()) as stdout:
+            this.assertEqual(simulate_main(["--durations", durations, "--json", arm]), 0)
+        this.assertEqual(json.loads(stdout.getvalue())[arm]["agent_minutes"], {"default": 530 / 60})
+
+        with mock.patch("sys.stderr", io.StringIO()) as stderr:
+            this.assertEqual(simulate_main(["--durations", arm, arm]), 1)
+        this.assertIn("No duration for step(s)", stderr.getvalue())
+
+
+if __name__ == "__main__":
+    main()
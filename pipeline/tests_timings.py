@@ -0,0 +1,147 @@
+import io
+import json
+import os
+import stat
+import subprocess
+import tempfile
+from unittest import mock, main, TestCase
+
+from manifest_steps import create_oci_manifest_step
+from pipeline import create_build_step, generate
+import tests
+from timings import format_table, main as timings_main, read_records, summarise
+
+
+def record(phase, duration_ms, job_id="job-1", exit_status=0, **fields):
+    return {"phase": phase, "platform": "arm", "image": "testcase", "tag": "1234567890", "job_id": job_id, "duration_ms": duration_ms, "exit_status": exit_status, **fields}
+
+
+class TestPhaseTimingCommands(TestCase):
+    config = tests.TestPipelineGeneration.config | {"phase-timings": True}
+
+    def run_step(this, step, failing=""):
+        """Run a step's commands the way the agent does, with docker and buildkite-agent stubbed out"""
+        directory = tempfile.TemporaryDirectory()
+        this.addCleanup(directory.cleanup)
+        bin_directory = os.path.join(directory.name, "bin")
+        os.mkdir(bin_directory)
+        stubs = {
+            "docker": f'[[ "$*" == *"{failing or "no-failure"}"* ]] && exit 3; exit 0',
+            "buildkite-agent": f'echo "$*" >> {directory.name}/agent.log',
+        }
+        for name, body in stubs.items():
+            path = os.path.join(bin_directory, name)
+            with open(path, "w", encoding="utf8") as file:
+                file.write(f"#!/bin/bash\n{body}\n")
+            os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+
+        # Buildkite interpolation turns $$ into $ before the agent runs the script
+        script = "\n".join(step["command"]).replace("$$", "$")
+        result = subprocess.run(
+            ["bash", "-e", "-c", script],
+            cwd=directory.name,
+            env={"PATH": f'{bin_directory}:{os.environ["PATH"]}', "BUILDKITE_JOB_ID": "job-1", "BUILDKITE_BUILD_NUMBER": "110", "BUILDKITE_PIPELINE_SLUG": "testcase"},
+            capture_output=True,
+            text=True,
+            check=False,
+        )
+        with open(os.path.join(directory.name, "agent.log"), encoding="utf8") as file:
+            agent_log = file.read()
+        return result.returncode, read_records([os.path.join(directory.name, "phase-timings-job-1.jsonl")]), agent_log
+
+    def test_build_step_records_phases(this):
+        status, records, agent_log = this.run_step(create_build_step("arm", "docker-arm", this.config))
+
+        this.assertEqual(status, 0)
+        this.assertEqual([item["phase"] for item in records], ["builder", "build", "push", "meta-data"])
+        this.assertEqual(records[0]["image"], "")
+        this.assertEqual(
+            {key: value for key, value in records[1].items() if key not in ["started_at", "duration_ms"]},
+            {"phase": "build", "platform": "arm", "image": "testcase", "tag": "1234567890", "pipeline": "testcase", "build_number": "110", "job_id": "job-1", "exit_status": 0, "affinity": "", "builder": ""},
+        )
+        this.assertIn("artifact upload phase-timings-job-1.jsonl", agent_log)
+
+    def test_build_step_records_builder_affinity(this):
+        step = generate(this.config | {"builder-affinity-shards": 4})["steps"][0]["steps"][0]
+        status, records, _ = this.run_step(step)
+
+        this.assertEqual(status, 0)
+        # The stub agent has no shard tag and docker finds the builder
+        this.assertEqual({(item["affinity"], item["builder"]) for item in records}, {("miss", "warm")})
+
+    def test_failed_phase_is_recorded_and_fails_the_step(this):
+        status, records, agent_log = this.run_step(create_build_step("arm", "docker-arm", this.config), failing="image push")
+
+        this.assertEqual(status, 3)
+        this.assertEqual([(item["phase"], item["exit_status"]) for item in records], [("builder", 0), ("build", 0), ("push", 3)])
+        this.assertIn("artifact upload phase-timings-job-1.jsonl", agent_log)
+
+    def test_manifest_step_records_phases(this):
+        status, records, _ = this.run_step(create_oci_manifest_step(this.config | {"mutate-image-tag": True}))
+
+        this.assertEqual(status, 0)
+        this.assertEqual([item["phase"] for item in records], ["untag", "manifest", "untag", "manifest"])
+        this.assertEqual({item["platform"] for item in records}, {"all"})
+
+
+class TestSummarise(TestCase):
+    def test_groups_by_phase(this):
+        records = [
+            record("build", 60000, "job-1"),
+            record("build", 120000, "job-2"),
+            record("push", 5000, "job-1"),
+            record("push", 7000, "job-2", exit_status=1),
+        ]
+
+        summary = summarise(records)
+        this.assertEqual([row["phase"] for row in summary], ["build", "push"])
+        this.assertEqual(
+            summary[0],
+            {"phase": "build", "jobs": 2, "failures": 0, "total_s": 180.0, "mean_s": 90.0, "p50_s": 60.0, "p90_s": 120.0, "max_s": 120.0},
+        )
+        this.assertEqual(summary[1]["failures"], 1)
+
+    def test_phase_commands_count_once_per_job(this):
+        records = [record("scan", 1000), record("scan", 29000), record("scan", 10000, "job-2")]
+
+        this.assertEqual(
+            [(row["jobs"], row["total_s"], row["max_s"]) for row in summarise(records)],
+            [(2, 40.0, 30.0)],
+        )
+
+    def test_groups_by_several_fields(this):
+        records = [record("build", 1000), record("build", 3000, "job-2", platform="x86")]
+
+        summary = summarise(records, ["phase", "platform"])
+        this.assertEqual([(row["phase"], row["platform"]) for row in summary], [("build", "x86"), ("build", "arm")])
+        this.assertIn("build  x86       1     0         3.0", format_table(summary, ["phase", "platform"]))
+
+    def test_read_records_skips_malformed_lines(this):
+        with tempfile.TemporaryDirectory() as directory:
+            os.mkdir(os.path.join(directory, "build-110"))
+            with open(os.path.join(directory, "build-110", "phase-timings-job-1.jsonl"), "w", encoding="utf8") as file:
+                file.write(json.dumps(record("build", 1000)) + "\n")
+                file.write('{"phase": "push", "dura\n')
+                file.write("\n")
+                file.write('{"phase": "push"}\n')
+
+            with mock.patch("sys.stderr", io.StringIO()) as stderr:
+                records = read_records([directory])
+
+        this.assertEqual(records, [record("build", 1000)])
+        this.assertIn("phase-timings-job-1.jsonl:2", stderr.getvalue())
+        this.assertIn("phase-timings-job-1.jsonl:4", stderr.getvalue())
+
+    def test_main_json(this):
+        with tempfile.NamedTemporaryFile("w", suffix=".jsonl", delete=False) as file:
+            file.write(json.dumps(record("build", 2000)) + "\n")
+        this.addCleanup(os.unlink, file.name)
+
+        with mock.patch("sys.stdout", io.StringIO()) as stdout:
+            this.assertEqual(timings_main([file.name, "--json", "--by", "phase,image"]), 0)
+
+        this.assertEqual(json.loads(stdout.getvalue())[0]["image"], "testcase")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+"""Summarise the phase timing records written by build steps generated with `phase-timings`
+
+Usage: python3 pipeline/timings.py [--by phase,platform,image] [--json] <file or directory>...
+
+Records are JSON lines, one per timed command, uploaded as phase-timings-<job id>.jsonl artifacts.
+"""
+import argparse
+import json
+import math
+import os
+import sys
+
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+GROUP_FIELDS: List[str] = ["phase", "platform", "image", "tag", "pipeline", "affinity", "builder"]
+
+
+def record_files(paths: Iterable[str]) -> List[str]:
+    """Expand directories into the .jsonl files inside them"""
+    files: List[str] = []
+    for path in paths:
+        if not os.path.isdir(path):
+            files.append(path)
+            continue
+        for root, dirs, names in os.walk(path):
+            dirs.sort()
+            files.extend(os.path.join(root, name) for name in sorted(names) if name.endswith(".jsonl"))
+    return files
+
+
+def read_records(paths: Iterable[str]) -> List[Dict[str, Any]]:
+    """Load every record, skipping lines that aren't valid records such as one cut short by a cancelled job"""
+    records: List[Dict[str, Any]] = []
+    for path in record_files(paths):
+        with open(path, encoding="utf8") as file:
+            for number, line in enumerate(file, start=1):
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    print(f"Skipping malformed record at {path}:{number}", file=sys.stderr)
+                    continue
+                if not isinstance(record, dict) or "phase" not in record or "duration_ms" not in record:
+                    print(f"Skipping incomplete record at {path}:{number}", file=sys.stderr)
+                    continue
+                records.append(record)
+    return records
+
+
+def percentile(values: Sequence[float], fraction: float) -> float:
+    """Nearest-rank percentile of sorted values"""
+    return values[max(0, math.ceil(fraction * len(values)) - 1)]
+
+
+def summarise(records: Iterable[Dict[str, Any]], group_by: Sequence[str] = ("phase",)) -> List[Dict[str, Any]]:
+    """Duration statistics per group, the groups taking the most time in total first
+
+    A phase made up of several commands, such as a scan, is counted once per job with the sum of its commands.
+    """
+    per_job: Dict[Tuple[Any, ...], Dict[str, Any]] = {}
+    for record in records:
+        group = tuple(record.get(field, "") for field in group_by)
+        key = (record.get("job_id", ""), *group)
+        entry = per_job.setdefault(key, {"group": group, "duration_ms": 0, "failed": False})
+        entry["duration_ms"] += record["duration_ms"]
+        entry["failed"] = entry["failed"] or record.get("exit_status", 0) != 0
+
+    groups: Dict[Tuple[Any, ...], List[Dict[str, Any]]] = {}
+    for entry in per_job.values():
+        groups.setdefault(entry["group"], []).append(entry)
+
+    summary: List[Dict[str, Any]] = []
+    for group, entries in groups.items():
+        durations = sorted(entry["duration_ms"] / 1000 for entry in entries)
+        summary.append(
+            {
+                **dict(zip(group_by, group)),
+                "jobs": len(entries),
+                "failures": sum(1 for entry in entries if entry["failed"]),
+                "total_s": sum(durations),
+                "mean_s": sum(durations) / len(durations),
+                "p50_s": percentile(durations, 0.5),
+                "p90_s": percentile(durations, 0.9),
+                "max_s": durations[-1],
+            }
+        )
+
+    return sorted(summary, key=lambda row: (-row["total_s"], [str(row[field]) for field in group_by]))
+
+
+def format_table(summary: List[Dict[str, Any]], group_by: Sequence[str]) -> str:
+    """Render a summary as an aligned text table"""
+    headers = [*group_by, "jobs", "failures", "total_s", "mean_s", "p50_s", "p90_s", "max_s"]
+    rows = [
+        [
+            str(value) if isinstance(value, (str, int)) else f"{value:.1f}"
+            for value in (row[header] for header in headers)
+        ]
+        for row in summary
+    ]
+    widths = [max(len(header), *(len(row[i]) for row in rows)) for i, header in enumerate(headers)]
+    lines = ["  ".join(header.ljust(width) for header, width in zip(headers, widths))]
+    lines.extend("  ".join(value.ljust(width) for value, width in zip(row, widths)) for row in rows)
+    return "\n".join(lines)
+
+
+def main(argv: Optional[Sequence[str]] = None) -> int:
+    """Print a summary of the records found in the given files and directories"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("paths", nargs="+", help="phase-timings-*.jsonl files, or directories containing them")
+    parser.add_argument("--by", default="phase", help=f'comma-delimited fields to group by, any of {", ".join(GROUP_FIELDS)} (default: phase)')
+    parser.add_argument("--json", action="store_true", help="print the summary as JSON")
+    args = parser.parse_args(argv)
+
+    group_by = args.by.split(",")
+    unknown = sorted(set(group_by) - set(GROUP_FIELDS))
+    if unknown:
+        parser.error(f'unknown --by field(s) {", ".join(unknown)}')
+
+    summary = summarise(read_records(args.paths), group_by)
+    if not summary:
+        print("No phase timing records found", file=sys.stderr)
+        return 1
+
+    if args.json:
+        json.dump(summary, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+    else:
+        print(format_table(summary, group_by))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())